@@ -7,6 +7,7 @@ import shutil
 import time
 from pathlib import Path
 from sys import stderr
+from threading import Thread
 
 server_path = Path("/app/server")
 server_config = server_path / "config"
@@ -342,6 +343,12 @@ def do_migrations():
     if not exec_cmd("python3 manage.py migrate"):
         print("ERROR: Error migrating.", file=stderr)
         return False
+    if not exec_cmd("python3 manage.py convert_dependencies"):
+        print("ERROR: Error converting package dependencies.", file=stderr)
+        return False
+    if not exec_cmd("python3 manage.py purge_db_sessions"):
+        print("ERROR: Error purging the database sessions.", file=stderr)
+        return False
     shutil.copytree(script_migrations, server_migrations, dirs_exist_ok=True)
     print("SAVE migrations")
     print("Migrations OK.")
@@ -364,6 +371,25 @@ def compile_messages():
     return True
 
 
+def supervise_job_worker():
+    """
+    Run the job worker, and restart it whenever it stops.
+    """
+    import subprocess
+
+    delay = 5
+    while True:
+        started = time.monotonic()
+        code = subprocess.run("python3 manage.py run_jobs", shell=True).returncode
+        print(
+            f"ERROR: job worker exited with code {code}, restarting in {delay}s.",
+            file=stderr,
+        )
+        time.sleep(delay)
+        # back off while it keeps failing at start
+        delay = 5 if time.monotonic() - started > 60 else min(delay * 2, 300)
+
+
 def start_server():
     """
     Start of the Server
@@ -396,6 +422,8 @@ def start_server():
 
         os.setgid(group_info["id"])
         os.setuid(user_info["id"])
+        print("Starting job worker:")
+        Thread(target=supervise_job_worker, daemon=True).start()
         print(f"Executing: {cmd} as {user_info['name']}:{group_info['name']}")
         subprocess.run(cmd, shell=True, check=True)
     except KeyboardInterrupt:
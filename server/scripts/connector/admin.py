@@ -0,0 +1,29 @@
+"""
+Definition of admin.
+"""
+
+from django.contrib import admin
+
+from .models import ApiToken
+
+
+class ApiTokenAdmin(admin.ModelAdmin):
+    """
+    Admin page for the API tokens
+    """
+
+    list_display = (
+        "name",
+        "user",
+        "prefix",
+        "scope",
+        "created",
+        "last_used",
+        "revoked",
+    )
+    list_filter = ("scope", "revoked")
+    search_fields = ("name", "user__username", "prefix")
+    readonly_fields = ("prefix", "digest", "created", "last_used")
+
+
+admin.site.register(ApiToken, ApiTokenAdmin)
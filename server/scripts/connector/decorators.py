@@ -5,10 +5,14 @@ Decorators for user permissions.
 from functools import wraps
 
 from django.contrib import messages
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Permission, User
+from django.db import transaction
 from django.shortcuts import redirect
 from django.utils.translation import gettext_lazy as _
 
+from .models import ApiToken
+from .tokens import bump_token_generation
+
 
 def user_capability_required(capability):
     """
@@ -107,6 +111,7 @@ def toggle_capability(request, user, capability):
         for perm in perm_map_unset[capability]:
             ido = Permission.objects.get(codename=perm.split(".")[1])
             user.user_permissions.remove(ido)
+        forget_capabilities(user)
         user.save()
 
         messages.success(
@@ -120,6 +125,7 @@ def toggle_capability(request, user, capability):
         for perm in perm_map_set[capability]:
             ido = Permission.objects.get(codename=perm.split(".")[1])
             user.user_permissions.add(ido)
+        forget_capabilities(user)
         user.save()
 
         messages.success(
@@ -128,45 +134,99 @@ def toggle_capability(request, user, capability):
                 f"Capability '{capability}' has been granted to user {user.username} by {request.user.username}."
             ),
         )
+    # the verified API tokens keep the permissions of their user: forget them
+    # once the modification is visible to the other processes
+    transaction.on_commit(bump_token_generation)
+
+
+# permissions needed by each capability
+CAPABILITY_PERMISSIONS = {
+    # to view a package, one must only have the view permission
+    "can_view_package": [
+        "pack.view_packageentry",
+    ],
+    # to add a package, one must be able to view it
+    "can_add_package": [
+        "pack.view_packageentry",
+        "pack.add_packageentry",
+    ],
+    # to delete a package, one must be able to view and add it
+    "can_delete_package": [
+        "pack.view_packageentry",
+        "pack.add_packageentry",
+        "pack.delete_packageentry",
+    ],
+    # to view a user, one must only have the view permission
+    "can_view_user": ["auth.view_user"],
+    # to delete a user, one must be able to view it
+    "can_delete_user": ["auth.view_user", "auth.delete_user"],
+}
+
+
+def load_capabilities(users):
+    """
+    Resolve the capabilities of a batch of users, with a single query for all
+    their permissions (direct and by group).
+
+    The capabilities are kept on the user objects, which live for one request;
+    toggle_capability forgets them.
+    :param users: The user objects.
+    """
+    users = [user for user in users if not hasattr(user, "_capabilities")]
+    perms = {user.pk: set() for user in users if user.pk is not None}
+    if len(perms) > 0:
+        direct = User.user_permissions.through.objects.filter(
+            user_id__in=perms
+        ).values_list(
+            "user_id",
+            "permission__content_type__app_label",
+            "permission__codename",
+        )
+        by_group = User.groups.through.objects.filter(
+            user_id__in=perms, group__permissions__isnull=False
+        ).values_list(
+            "user_id",
+            "group__permissions__content_type__app_label",
+            "group__permissions__codename",
+        )
+        for pk, app_label, codename in direct.union(by_group):
+            perms[pk].add(f"{app_label}.{codename}")
+    for user in users:
+        user_perms = perms.get(user.pk, set())
+        capabilities = {}
+        for capability, needed in CAPABILITY_PERMISSIONS.items():
+            # same rules as user.has_perm with the model backend
+            capabilities[capability] = user.is_active and (
+                user.is_superuser or all(perm in user_perms for perm in needed)
+            )
+        capabilities["is_admin"] = user.is_superuser
+        user._capabilities = capabilities
+
+
+def forget_capabilities(user):
+    """
+    Forget the resolved capabilities of a user, after a modification.
+    :param user: The user object.
+    """
+    user.__dict__.pop("_capabilities", None)
+    # the permissions cached by the authentication backend
+    for cache in ("_perm_cache", "_user_perm_cache", "_group_perm_cache"):
+        user.__dict__.pop(cache, None)
 
 
 def has_capability(user, capability):
     """
-    Retrieve the capabilities of a user.
+    Check a capability of a user.
     :param user: The user object.
     :param capability: The capability to check.
-    :return: A dictionary with capabilities as keys and boolean values indicating if the user has that capability.
+    :return: True if the user has that capability.
     """
-    perm_map = {
-        # to view a package, one must only have the view permission
-        "can_view_package": [
-            "pack.view_packageentry",
-        ],
-        # to add a package, one must be able to view it
-        "can_add_package": [
-            "pack.view_packageentry",
-            "pack.add_packageentry",
-        ],
-        # to delete a package, one must be able to view and add it
-        "can_delete_package": [
-            "pack.view_packageentry",
-            "pack.add_packageentry",
-            "pack.delete_packageentry",
-        ],
-        # to view a user, one must only have the view permission
-        "can_view_user": ["auth.view_user"],
-        # to delete a user, one must be able to view it
-        "can_delete_user": ["auth.view_user", "auth.delete_user"],
-    }
-    if capability == "is_admin":
-        return user.is_superuser
-    if capability in perm_map:
-        perms = perm_map[capability]
-        for perm in perms:
-            if not user.has_perm(perm):
-                return False
-        return True
-    return False
+    scope = getattr(user, "token_scope", None)
+    if scope is not None and capability not in ApiToken.scope_capabilities[scope]:
+        # authenticated by an API token, restricted to its scope
+        return False
+    load_capabilities([user])
+    return user._capabilities.get(capability, False)
 
 
 def get_capability(user):
@@ -175,15 +235,7 @@ def get_capability(user):
     :param user: The user object.
     :return: A dictionary with capabilities as keys and boolean values indicating if the user has that capability.
     """
-    perms = [
-        "can_view_package",
-        "can_add_package",
-        "can_delete_package",
-        "can_view_user",
-        "can_delete_user",
-        "is_admin",
-    ]
-    capabilities = {}
-    for capability in perms:
-        capabilities[capability] = has_capability(user, capability)
-    return capabilities
+    return {
+        capability: has_capability(user, capability)
+        for capability in [*CAPABILITY_PERMISSIONS, "is_admin"]
+    }
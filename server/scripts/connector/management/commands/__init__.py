@@ -0,0 +1,3 @@
+"""
+Init module.
+"""
@@ -0,0 +1,35 @@
+"""
+Create an API token for a user.
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from connector.decorators import has_capability
+from connector.models import ApiToken
+
+
+class Command(BaseCommand):
+    """
+    Create an API token, e.g. for a CI runner; the token is only printed once.
+    """
+
+    help = "Create an API token for a user, restricted to a capability."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--name", default="API")
+        parser.add_argument(
+            "--scope",
+            choices=list(ApiToken.scope_capabilities),
+            default="can_view_package",
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"]).first()
+        if user is None:
+            raise CommandError(f"No user {options['username']}.")
+        if not has_capability(user, options["scope"]):
+            raise CommandError(f"The user does not have {options['scope']}.")
+        _, raw = ApiToken.create_token(user, options["name"], options["scope"])
+        self.stdout.write(raw)
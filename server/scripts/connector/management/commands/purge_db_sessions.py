@@ -0,0 +1,53 @@
+"""
+Delete the sessions stored in database.
+"""
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    """
+    Delete the expired sessions, like the ones left in database by the API calls
+    of the former versions (one session per call), in small transactions.
+    """
+
+    help = "Delete the expired sessions stored in database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Delete the valid sessions too (every user is logged out).",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=1000,
+            help="Number of sessions deleted per transaction.",
+        )
+        parser.add_argument(
+            "--vacuum",
+            action="store_true",
+            help="Give the freed space back to the file system.",
+        )
+
+    def handle(self, *args, **options):
+        sessions = Session.objects.all()
+        if not options["all"]:
+            sessions = sessions.filter(expire_date__lt=timezone.now())
+        deleted = 0
+        while True:
+            # small transactions: the server keeps running during the purge
+            keys = list(
+                sessions.values_list("session_key", flat=True)[: options["batch"]]
+            )
+            if len(keys) == 0:
+                break
+            deleted += Session.objects.filter(session_key__in=keys).delete()[0]
+        if options["vacuum"] and deleted > 0 and connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+        self.stdout.write(f"Deleted {deleted} sessions.")
@@ -0,0 +1,136 @@
+"""
+Models of the user connection.
+"""
+
+import hmac
+from hashlib import sha256
+from secrets import token_urlsafe
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .tokens import bump_token_generation
+
+TOKEN_PREFIX = "dms_"
+
+
+def token_digest(raw: str):
+    """
+    Keyed digest of an API token, as stored in database.
+
+    The tokens are long random strings: a fast keyed hash is enough, unlike the
+    passwords that need a slow hasher.
+    :param raw: The token.
+    :return: The hexadecimal digest.
+    """
+    return hmac.new(settings.SECRET_KEY.encode(), raw.encode(), sha256).hexdigest()
+
+
+class ApiToken(models.Model):
+    """
+    Token of a user for the API, with a restricted capability (scope).
+    """
+
+    ScopeType = (
+        ("can_view_package", "Pull packages"),
+        ("can_add_package", "Push packages"),
+        ("can_delete_package", "Delete packages"),
+    )
+    # capabilities given by each scope, like the package capabilities of a user
+    scope_capabilities = {
+        "can_view_package": ["can_view_package"],
+        "can_add_package": ["can_view_package", "can_add_package"],
+        "can_delete_package": [
+            "can_view_package",
+            "can_add_package",
+            "can_delete_package",
+        ],
+    }
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="api_tokens")
+    name = models.CharField(max_length=60, verbose_name="Token name")
+    prefix = models.CharField(
+        max_length=12, editable=False, verbose_name="Beginning of the token"
+    )
+    digest = models.CharField(
+        max_length=64, unique=True, editable=False, verbose_name="Token digest"
+    )
+    scope = models.CharField(
+        max_length=20, choices=ScopeType, default="can_view_package"
+    )
+    created = models.DateTimeField(default=timezone.now)
+    last_used = models.DateTimeField(null=True, blank=True)
+    revoked = models.BooleanField(default=False)
+
+    class Meta:
+        """
+        Metadata for the tokens
+        """
+
+        verbose_name = "API token"
+        ordering = ["-created"]
+
+    @classmethod
+    def create_token(cls, user: User, name: str, scope: str = "can_view_package"):
+        """
+        Create a new token; only its digest is stored.
+        :param user: The owner of the token.
+        :param name: The token name.
+        :param scope: The capability given by the token.
+        :return: The token entry, and the token itself.
+        """
+        raw = TOKEN_PREFIX + token_urlsafe(32)
+        token = cls.objects.create(
+            user=user,
+            name=name,
+            prefix=raw[:12],
+            digest=token_digest(raw),
+            scope=scope,
+        )
+        return token, raw
+
+    def revoke(self):
+        """
+        Revoke the token, in all the server processes.
+        """
+        self.revoked = True
+        self.save(update_fields=["revoked"])
+
+
+@receiver(post_save, sender=ApiToken)
+@receiver(post_delete, sender=ApiToken)
+def token_changed(sender, instance, **kwargs):
+    """
+    Forget the verified tokens when one is modified (e.g. revoked) or deleted
+    (e.g. with its user).
+    """
+    bump_token_generation()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Group)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    """
+    Forget the verified tokens when a user is modified (e.g. deactivated), or a
+    group deleted: the verified tokens keep their user and its capabilities.
+    """
+    if update_fields is not None and set(update_fields) == {"last_login"}:
+        return
+    transaction.on_commit(bump_token_generation)
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def permissions_changed(sender, action, **kwargs):
+    """
+    Forget the verified tokens when permissions are given or removed, directly
+    or by group (e.g. from the administration site).
+    """
+    if action.startswith("post_"):
+        transaction.on_commit(bump_token_generation)
@@ -0,0 +1,69 @@
+"""
+Verification of the API tokens.
+
+The verified tokens are kept in the memory of each server process, with their
+user, so that an API call does not need any database access to authenticate.
+They are forgotten after TOKEN_VERIFY_TTL seconds, and as soon as the token
+generation, kept in the shared cache, changes (revocation or capability change).
+"""
+
+from time import monotonic, time_ns
+
+from django.core.cache import cache
+from django.utils import timezone
+
+TOKEN_GENERATION_KEY = "connector:tokens:generation"
+TOKEN_VERIFY_TTL = 300
+
+_verified = {}
+
+
+def get_token_generation():
+    """
+    Get the current generation of the tokens.
+    :return: The generation token.
+    """
+    generation = cache.get(TOKEN_GENERATION_KEY)
+    if generation is None:
+        generation = f"{time_ns():x}"
+        if not cache.add(TOKEN_GENERATION_KEY, generation, None):
+            generation = cache.get(TOKEN_GENERATION_KEY, generation)
+    return generation
+
+
+def bump_token_generation():
+    """
+    Invalidate the verified tokens of all the processes.
+    """
+    cache.set(TOKEN_GENERATION_KEY, f"{time_ns():x}", None)
+
+
+def verify_token(raw: str):
+    """
+    Get the user of an API token.
+    :param raw: The token, as given by the client.
+    :return: The user, with the scope of the token (token_scope); None if the
+        token is not valid.
+    """
+    # the models use the generation of this module
+    from .models import ApiToken, token_digest
+
+    digest = token_digest(raw)
+    generation = get_token_generation()
+    verified = _verified.get(digest)
+    if verified is not None and verified[0] == generation and verified[1] > monotonic():
+        return verified[2]
+    _verified.pop(digest, None)
+    token = (
+        ApiToken.objects.select_related("user")
+        .filter(digest=digest, revoked=False)
+        .first()
+    )
+    if token is None or not token.user.is_active:
+        return None
+    # recorded once per verification, not at each call
+    ApiToken.objects.filter(pk=token.pk).update(last_used=timezone.now())
+    user = token.user
+    user.token_scope = token.scope
+    _verified[digest] = (generation, monotonic() + TOKEN_VERIFY_TTL, user)
+    return user
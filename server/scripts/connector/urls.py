@@ -10,7 +10,14 @@ from django.contrib.auth.views import (
 )
 from django.urls import path
 
-from .views import profile, CustomPasswordResetView, register, profile_edit
+from .views import (
+    profile,
+    CustomPasswordResetView,
+    register,
+    profile_edit,
+    token_create,
+    token_revoke,
+)
 
 urlpatterns = [
     path("", profile, name="profile"),
@@ -38,4 +45,6 @@ urlpatterns = [
     ),
     path("register/", register, name="register"),
     path("edit/", profile_edit, name="profile_edit"),
+    path("token/new", token_create, name="token_create"),
+    path("token/<int:pk>/revoke", token_revoke, name="token_revoke"),
 ]
@@ -1,34 +1,51 @@
 """Fichier main.users.users_view.py les vues users."""
 
+from django.contrib import messages
 from django.contrib.auth import login
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import PasswordResetView
 from django.shortcuts import render, redirect, reverse
+from django.utils.cache import add_never_cache_headers
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import require_POST
 
 from scripts.settings import SITE_API_VERSION, SITE_HASH, SITE_VERSION
 from . import settings
-from .decorators import get_capability
+from .decorators import get_capability, has_capability
 from .forms import CustomUserCreationForm, CustomUserChangeForm
+from .models import ApiToken
+
+
+def _profile_context(request):
+    """
+    Context of the profile page.
+    :param request: The HTTP request object.
+    :return: The context dictionary.
+    """
+    return {
+        **settings.base_info,
+        "title": "Profile",
+        "page": "connexion",
+        "version": {
+            "number": SITE_VERSION,
+            "hash": SITE_HASH,
+            "api": SITE_API_VERSION,
+        },
+        "user_capabilities": get_capability(request.user),
+        "user": request.user,
+        "tokens": request.user.api_tokens.filter(revoked=False),
+        "token_scopes": [
+            (scope, label)
+            for scope, label in ApiToken.ScopeType
+            if has_capability(request.user, scope)
+        ],
+    }
 
 
 def profile(request):
     """User wants to view its profile."""
     if request.user.is_authenticated:
-        return render(
-            request,
-            "registration/profile.html",
-            {
-                **settings.base_info,
-                "title": "Profile",
-                "page": "connexion",
-                "version": {
-                    "number": SITE_VERSION,
-                    "hash": SITE_HASH,
-                    "api": SITE_API_VERSION,
-                },
-                "user_capabilities": get_capability(request.user),
-                "user": request.user,
-            },
-        )
+        return render(request, "registration/profile.html", _profile_context(request))
     else:
         return register(request)
 
@@ -105,6 +122,43 @@ def profile_edit(request):
     )
 
 
+@login_required(login_url="login")
+@require_POST
+def token_create(request):
+    """
+    User creates an API token; it is only shown once.
+    """
+    scope = request.POST.get("scope", "can_view_package")
+    name = request.POST.get("name", "").strip()[:60]
+    if scope not in ApiToken.scope_capabilities or not has_capability(
+        request.user, scope
+    ):
+        messages.error(request, _("Capability not recognized."))
+        return redirect(reverse("profile"))
+    token, raw = ApiToken.create_token(request.user, name or "API", scope)
+    # shown in this response only: not stored in a message (cookie or session)
+    response = render(
+        request,
+        "registration/profile.html",
+        _profile_context(request) | {"new_token": raw},
+    )
+    add_never_cache_headers(response)
+    return response
+
+
+@login_required(login_url="login")
+@require_POST
+def token_revoke(request, pk):
+    """
+    User revokes one of its API tokens.
+    """
+    token = request.user.api_tokens.filter(pk=pk).first()
+    if token is not None:
+        token.revoke()
+        messages.success(request, _("API token revoked."))
+    return redirect(reverse("profile"))
+
+
 class CustomPasswordResetView(PasswordResetView):
     """
     Custom class for password reset.
@@ -0,0 +1,85 @@
+"""
+Catalog generation management.
+
+The generation changes each time the package catalog is modified. It is kept in
+the shared cache, so it can be checked by any worker without database access.
+Each package name also has its own generation, to invalidate only what is cached
+on the packages that changed.
+"""
+
+from time import time, time_ns
+
+from django.core.cache import cache
+
+GENERATION_KEY = "pack:catalog:generation"
+NAME_GENERATION_KEY = "pack:catalog:name:{}"
+
+
+def _new_generation():
+    """
+    Create a new, unique, generation.
+    :return: Dictionary with the generation token and its date.
+    """
+    return {"token": f"{time_ns():x}", "date": time()}
+
+
+def get_generation():
+    """
+    Get the current generation of the catalog.
+    :return: Dictionary with the generation token and its date.
+    """
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = _new_generation()
+        if not cache.add(GENERATION_KEY, generation, None):
+            generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+def get_last_modified(generation):
+    """
+    Get the date to send as Last-Modified for a generation.
+
+    HTTP dates have a one-second granularity: a generation created during the
+    current second could be followed by another one with the same HTTP date, and
+    a client checking If-Modified-Since would miss it. Such a date is not sent,
+    the client relies on the ETag.
+    :param generation: The catalog generation.
+    :return: The date in seconds since epoch, or None if the second is not over.
+    """
+    date = int(generation["date"])
+    if date + 1 > time():
+        return None
+    return date
+
+
+def get_name_generations(names):
+    """
+    Get the current generation of some package names.
+    :param names: The package names.
+    :return: Dictionary of the generation tokens by name.
+    """
+    keys = {NAME_GENERATION_KEY.format(name): name for name in names}
+    found = cache.get_many(keys.keys())
+    generations = {}
+    for key, name in keys.items():
+        if key not in found:
+            token = _new_generation()["token"]
+            if not cache.add(key, token, None):
+                token = cache.get(key, token)
+            found[key] = token
+        generations[name] = found[key]
+    return generations
+
+
+def bump_generation(*names):
+    """
+    Mark the catalog as modified, invalidating everything cached on it.
+    :param names: The modified package names.
+    """
+    generation = _new_generation()
+    cache.set(GENERATION_KEY, generation, None)
+    cache.set_many(
+        {NAME_GENERATION_KEY.format(name): generation["token"] for name in names},
+        None,
+    )
@@ -2,82 +2,285 @@
 Functions to import data from another server
 """
 
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
+from re import compile as re_compile
+from threading import Lock
 
 import requests
+from django.conf import settings
 
-from scripts.settings import MEDIA_ROOT
 from .logger import logger
-from .models import PackageEntry
+from .models import PackageEntry, compute_sha256
 
+CHUNK_SIZE = 1024 * 1024
+# ETag of the files of this server: the SHA-256 checksum of the archive
+sha256_etag = re_compile(r'^"[0-9a-f]{64}"$')
+
+
+def parse_index_line(line: str):
+    """
+    Parse a line of the API index of a server.
+    :param line: The index line.
+    :return: Dictionary with the entry data, None if the line is not valid.
+    """
+    data = {}
+    try:
+        predicate, idata = line.strip().split(" ", 1)
+        name, version = predicate.split("/", 1)
+        data["name"] = name.strip()
+        data["version"] = version.strip()
+        if " | deps: " in idata:
+            idata, data["dependencies"] = idata.split(" | deps: ", 1)
+        date = ""
+        if ")" in idata:
+            date, idata = idata.split(")")
+            date = date.replace("(", "").strip()
+        data["date"] = date
+        items = idata.replace("[", "").replace("]", "").replace(",", "").split()
+        if len(items) not in [4, 5]:
+            logger.error(
+                f"WARNING: Bad Line format: '{data}': '{name}' '{version}' '{date}' {items}",
+            )
+            return None
+        data["glibc"] = items[4] if len(items) == 5 else ""
+        data["abi"] = items[3][0].lower()  # only the first character is the ABI code
+        data["os"] = items[2][0].lower()  # only the first character is the OS code
+        # arch
+        if items[0] == "x86_64":
+            data["arch"] = "x"
+        if items[0] == "aarch64":
+            data["arch"] = "a"
+        if items[0] == "any":
+            data["arch"] = "y"
+        # kind
+        if items[1] == "shared":
+            data["kind"] = "r"
+        if items[1] == "static":
+            data["kind"] = "t"
+        if items[1] == "header":
+            data["kind"] = "h"
+        if items[1] == "any":
+            data["kind"] = "a"
+    except Exception as err:
+        logger.error(f"ERROR: bad line format '{line}' ({err})")
+        return None
+    return data
+
+
+def download_file(session: requests.Session, url: str, part: Path, target: Path):
+    """
+    Download a file in chunks through a partial file, resuming it if it exists.
+
+    The partial file is renamed into the target only once complete, so a present
+    target is always a complete download. The ETag of the file is kept next to
+    the partial file: a download is only resumed if the remote file is unchanged
+    (If-Range), and checked when the ETag is the checksum of the file.
+    :param session: The HTTP session.
+    :param url: The file url.
+    :param part: The partial file path.
+    :param target: The final file path.
+    :return: True if the file is downloaded.
+    """
+    etag_file = part.with_name(f"{part.name}.etag")
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+    if offset > 0 and etag_file.exists():
+        headers["If-Range"] = etag_file.read_text()
+    with session.get(url, headers=headers, stream=True, timeout=60) as resp:
+        if resp.status_code == 416:
+            # the partial file is not consistent with the remote one: restart
+            logger.warning(f"Cannot resume download of {url}, restarting.")
+            part.unlink()
+            etag_file.unlink(missing_ok=True)
+            return download_file(session, url, part, target)
+        if resp.status_code not in [200, 206]:
+            logger.error(
+                f"Failed to download package file {url}: {resp.status_code} - {resp.text}"
+            )
+            return False
+        if resp.status_code == 206:
+            logger.debug(f"Resuming download of {url} at {offset} bytes.")
+        etag = resp.headers.get("ETag", "")
+        if etag.startswith('"'):
+            # only the strong ETags identify the content
+            etag_file.write_text(etag)
+        else:
+            etag_file.unlink(missing_ok=True)
+        with open(part, "ab" if resp.status_code == 206 else "wb") as fp:
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                fp.write(chunk)
+    etag_file.unlink(missing_ok=True)
+    if sha256_etag.match(etag) is not None:
+        with open(part, "rb") as fp:
+            checksum = compute_sha256(iter(lambda: fp.read(CHUNK_SIZE), b""))
+        if f'"{checksum}"' != etag:
+            logger.error(f"Corrupted download of {url}: checksum differs from {etag}.")
+            part.unlink()
+            return False
+    os.replace(part, target)
+    return True
 
-def long_import(url: str, user: str, password: str):
-    logger.debug(f"Importing from database {url} with user {user}")
 
-    api_url = "/api2"
-    resp = requests.get(
-        f"{url}{api_url}", auth=(user, password), timeout=10, verify=False
+def import_path(url: str):
+    """
+    Local path of a remote package file during an import, named after its url:
+    the remote file names may not be unique (e.g. /download/<id> on several
+    servers). The partial download has the '.part' suffix.
+    :param url: The full url of the remote file.
+    :return: The path of the downloaded file.
+    """
+    return (
+        Path(settings.MEDIA_ROOT) / "_import" / f"{compute_sha256([url.encode()])}.tgz"
     )
+
+
+def check_download(session: requests.Session, url: str, file: Path):
+    """
+    Check that a file downloaded by a former import is still the remote file, by
+    its checksum if the ETag gives it, by its size otherwise.
+    :param session: The HTTP session.
+    :param url: The file url.
+    :param file: The downloaded file.
+    :return: True if the file can be used.
+    """
+    try:
+        resp = session.head(url, allow_redirects=True, timeout=10)
+    except requests.RequestException as err:
+        logger.warning(f"Cannot check the download of {url}: {err}")
+        return False
     if resp.status_code != 200:
-        api_url = "/api"
-        resp = requests.get(
-            f"{url}{api_url}", auth=(user, password), timeout=10, verify=False
+        return False
+    etag = resp.headers.get("ETag", "")
+    if sha256_etag.match(etag) is not None:
+        with open(file, "rb") as fp:
+            checksum = compute_sha256(iter(lambda: fp.read(CHUNK_SIZE), b""))
+        return f'"{checksum}"' == etag
+    return resp.headers.get("Content-Length") == str(file.stat().st_size)
+
+
+class SharedDownloads:
+    """
+    Downloads of an import, by remote file: several entries may reference the
+    same file (e.g. servers storing one archive for many flavors), which must be
+    downloaded only once, not concurrently into the same part file.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._downloads = {}
+
+    def get(self, key: str, download):
+        """
+        Download a file, or wait for its download by another thread.
+        :param key: The remote file.
+        :param download: Function doing the download.
+        :return: The result of the download.
+        """
+        with self._lock:
+            future = self._downloads.get(key)
+            first = future is None
+            if first:
+                future = self._downloads[key] = Future()
+        if first:
+            try:
+                future.set_result(download())
+            except BaseException as err:
+                future.set_exception(err)
+        return future.result()
+
+
+def fetch_package(
+    session: requests.Session,
+    url: str,
+    api_url: str,
+    data: dict,
+    downloads: SharedDownloads = None,
+):
+    """
+    Get the package file of an entry from the remote server.
+    :param session: The HTTP session.
+    :param url: The server url.
+    :param api_url: The API url of the server.
+    :param data: The entry data.
+    :param downloads: The downloads shared by the entries of the import.
+    :return: The path of the downloaded file, None in case of failure.
+    """
+    post_data = {"action": "pull"} | {
+        key: val for key, val in data.items() if key != "dependencies"
+    }
+    resp = session.post(api_url, data=post_data, timeout=10)
+    if resp.status_code != 200:
+        logger.error(
+            f"Failed to get package file URL for {data['name']} {data['version']}: {resp.status_code} - {resp.text}"
         )
+        return None
+    file_url = f"{url}{resp.text.strip()}"
+    new_path = import_path(file_url)
+
+    def download():
+        if new_path.exists():
+            if check_download(session, file_url, new_path):
+                logger.debug(f"Package file {file_url} already downloaded.")
+                return new_path
+            logger.warning(f"Outdated download of {file_url}, downloading it again.")
+            new_path.unlink()
+        if not download_file(
+            session, file_url, new_path.with_suffix(".part"), new_path
+        ):
+            return None
+        return new_path
+
+    if downloads is None:
+        return download()
+    return downloads.get(file_url, download)
+
+
+def long_import(url: str, user: str, password: str, workers: int = None, progress=None):
+    """
+    Import the packages of another server, downloading them in parallel.
+
+    The import can be resumed: entries already in database and downloaded files
+    are skipped, and partial downloads are continued.
+    :param url: The server url.
+    :param user: The login on the server.
+    :param password: The password on the server.
+    :param workers: Number of concurrent downloads.
+    :param progress: Function called with the done and total steps, and a message.
+    :return: The number of imported packages.
+    """
+    if progress is None:
+        progress = lambda done, total, message="": None
+    logger.debug(f"Importing from database {url} with user {user}")
+    if workers is None:
+        workers = settings.IMPORT_WORKERS
+    session = requests.Session()
+    session.auth = (user, password)
+    session.verify = False
+    session.headers["X-API-Version"] = settings.SITE_API_VERSION
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    api_url = f"{url}/api2"
+    resp = session.get(api_url, timeout=10)
+    if resp.status_code != 200:
+        api_url = f"{url}/api"
+        resp = session.get(api_url, timeout=10)
         if resp.status_code != 200:
             logger.error(
                 f"Failed to connect to {url}: {resp.status_code} - {resp.text}"
             )
-            return
+            return 0
         else:
-            logger.info(f"Using legacy API at {url}{api_url}")
+            logger.info(f"Using legacy API at {api_url}")
     http_data = resp.text.splitlines(keepends=False)
     logger.debug(f"Received {len(http_data)} lines of data from {url}")
-    added = 0
-    for index, line in enumerate(http_data):
-        logger.info(f"Processing {index+1}/{len(http_data)}: {line}")
-        data = {}
-        try:
-            predicate, idata = line.strip().split(" ", 1)
-            predicate.strip()
-            idata.strip()
-            name, version = predicate.split("/", 1)
-            data["name"] = name.strip()
-            data["version"] = version.strip()
-            date = ""
-            if ")" in idata:
-                date, idata = idata.split(")")
-                date = date.replace("(", "").strip()
-                idata.strip()
-            data["date"] = date
-            items = idata.replace("[", "").replace("]", "").replace(",", "").split()
-            if len(items) not in [4, 5]:
-                logger.error(
-                    f"WARNING: Bad Line format: '{data}': '{name}' '{version}' '{date}' {items}",
-                )
-                continue
-            data["glibc"] = items[4] if len(items) == 5 else ""
-            data["abi"] = items[3][
-                0
-            ].lower()  # only the first character is the ABI code
-            data["os"] = items[2][0].lower()  # only the first character is the OS code
-            # arch
-            if items[0] == "x86_64":
-                data["arch"] = "x"
-            if items[0] == "aarch64":
-                data["arch"] = "a"
-            if items[0] == "any":
-                data["arch"] = "y"
-            # kind
-            if items[1] == "shared":
-                data["kind"] = "r"
-            if items[1] == "static":
-                data["kind"] = "t"
-            if items[1] == "header":
-                data["kind"] = "h"
-            if items[1] == "any":
-                data["kind"] = "a"
-        except Exception as err:
-            logger.error(f"ERROR: bad line format '{line}' ({err})")
+    to_import = []
+    for line in http_data:
+        data = parse_index_line(line)
+        if data is None:
             continue
         exists = PackageEntry.objects.filter(
             name=data["name"],
@@ -92,55 +295,63 @@ def long_import(url: str, user: str, password: str):
         if exists:
             logger.debug(f"Package {data['name']} {data['version']} already exists.")
             continue
-        else:
-            logger.debug(f"Downloading package {data['name']} {data['version']}")
-        try:
-            # request the package file url
-            post_data = {"action": "pull"} | data
-            resp = requests.post(
-                f"{url}{api_url}",
-                data=post_data,
-                auth=(user, password),
-                timeout=10,
-                verify=False,
+        to_import.append(data)
+    logger.info(
+        f"{len(to_import)} packages to import from {url} with {workers} workers."
+    )
+    (Path(settings.MEDIA_ROOT) / "_import").mkdir(parents=True, exist_ok=True)
+    added = 0
+    stored = {}
+    progress(0, len(to_import), f"Importing from {url}")
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        downloads = SharedDownloads()
+        futures = {
+            executor.submit(fetch_package, session, url, api_url, data, downloads): data
+            for data in to_import
+        }
+        for index, future in enumerate(as_completed(futures)):
+            data = futures[future]
+            logger.info(
+                f"Processing {index + 1}/{len(to_import)}: {data['name']} {data['version']}"
             )
-            if resp.status_code != 200:
-                logger.error(
-                    f"Failed to get package file URL for {data['name']} {data['version']}: {resp.status_code} - {resp.text}"
+            progress(index, len(to_import), f"{data['name']} {data['version']}")
+            try:
+                new_path = future.result()
+                if new_path is None:
+                    continue
+                # database is only written from this thread
+                entry = PackageEntry(
+                    name=data["name"],
+                    version=data["version"],
+                    os=data["os"],
+                    arch=data["arch"],
+                    kind=data["kind"],
+                    abi=data["abi"],
+                    glibc=data["glibc"],
+                    build_date=data["date"],
+                    dependencies=data.get("dependencies", ""),
                 )
-                continue
-            file_url = resp.text.strip()
-            filename = file_url.rsplit("/", 1)[-1]
-            resp = requests.get(
-                f"{url}{file_url}", auth=(user, password), stream=True, verify=False
-            )
-            if resp.status_code != 200:
+                if new_path in stored:
+                    # same remote file as a previous entry, already stored
+                    entry.package, entry.size, entry.sha256 = stored[new_path]
+                else:
+                    entry.store_file(new_path)
+                    stored[new_path] = entry.package.name, entry.size, entry.sha256
+                entry.save()
+                logger.debug(
+                    f"Package {data['name']} {data['version']} saved to {entry.package.name}"
+                )
+            except Exception as err:
                 logger.error(
-                    f"Failed to download package file for {data['name']} {data['version']}: {resp.status_code} - {resp.text}"
+                    f"ERROR: Failed to download package file for {data['name']} {data['version']}: {err}"
                 )
                 continue
-            new_path = Path(MEDIA_ROOT) / "packages" / filename
-            with open(new_path, "wb") as fp:
-                fp.write(resp.content)
-            logger.debug(
-                f"Package {data['name']} {data['version']} saved to {new_path}"
-            )
-            entry = PackageEntry(
-                name=data["name"],
-                version=data["version"],
-                os=data["os"],
-                arch=data["arch"],
-                kind=data["kind"],
-                abi=data["abi"],
-                glibc=data["glibc"],
-                build_date=data["date"],
-                package=str(new_path),
-            )
-            entry.save()
-        except Exception as err:
-            logger.error(
-                f"ERROR: Failed to download package file for {data['name']} {data['version']}: {err}"
-            )
-            continue
-        added += 1
+            added += 1
+    finally:
+        # on cancellation, do not wait for the pending downloads
+        executor.shutdown(cancel_futures=True)
+    session.close()
+    progress(len(to_import), len(to_import), f"Imported {added} packages")
     logger.info(f"Imported {added} packages from {url}")
+    return added
@@ -1,54 +1,138 @@
 """
 Simple locking system for the database
 """
-from datetime import datetime
+
+import os
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
 from pathlib import Path
+from time import monotonic, sleep
 
 from scripts.settings import DATABASES_LOCK_PATH
 
 
 class DbLocking:
     """
-    Simple lock file management.
+    Cross-process lock of the database for the maintenance tasks.
+
+    The locks are ``flock`` locks on two files, so they are released by the system
+    if the holding process dies:
+
+    * the write lock file is locked exclusively by any maintenance, and shared
+      by the modifications of the database: a maintenance cannot start during a
+      modification, and modifications are refused during a maintenance;
+    * the lock file is also locked by an exclusive maintenance, during which
+      the database cannot be read either.
+
+    The state seen by the other processes is cached for ``state_ttl`` seconds.
+    Probing the state takes a shared lock for an instant, so the maintenance
+    retries its lock for ``probe_grace`` seconds before giving up.
     """
 
-    def __init__(self):
-        self.lockfile = Path(DATABASES_LOCK_PATH).resolve()
+    def __init__(self, lockfile: Path = None):
+        self.lockfile = Path(lockfile or DATABASES_LOCK_PATH).resolve()
         if not self.lockfile.parent.exists():
             self.lockfile.parent.mkdir(parents=True)
-        self.lock_timeout = 300
+        self.write_lockfile = self.lockfile.with_suffix(".wlock")
+        self.state_ttl = 1.0
+        self.probe_grace = 0.2
+        self._state = None
+        self._held = []
 
-    def is_locked(self):
+    def _open(self, path: Path):
         """
-        Check if the database is locked.
-        Remove the lock is the lock file is older thant the timeout.
-        :return: True if lock file exists and valid.
-        """
-        if self.lockfile.exists():
-            if (
-                datetime.fromtimestamp(self.lockfile.stat().st_mtime) - datetime.now()
-            ).total_seconds() > self.lock_timeout:
-                self.lockfile.unlink()
-                return False
+        Open a lock file.
+        :param path: The lock file.
+        :return: The file descriptor.
+        """
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _is_held(self, path: Path):
+        """
+        Check if a lock file is exclusively locked.
+        :param path: The lock file.
+        :return: True if the file is locked.
+        """
+        fd = self._open(path)
+        try:
+            flock(fd, LOCK_SH | LOCK_NB)
+        except BlockingIOError:
             return True
+        finally:
+            os.close(fd)
         return False
 
-    def get_lock(self):
+    def is_locked(self, writing: bool = False):
+        """
+        Check if the database is locked.
+        :param writing: If the database is to be modified.
+        :return: True if the database cannot be accessed.
+        """
+        if self._state is None or self._state[0] < monotonic():
+            self._state = (
+                monotonic() + self.state_ttl,
+                self._is_held(self.lockfile),
+                self._is_held(self.write_lockfile),
+            )
+        return self._state[2] if writing else self._state[1]
+
+    def get_lock(self, exclusive: bool = True):
         """
         Try to lock the database if not already lock
+        :param exclusive: If the database cannot be read during the maintenance
+            (operations moving or deleting package files).
         :return: True if the lock is given, False if the database is already locked.
         """
-        if self.is_locked():
+        if len(self._held) > 0:
             return False
-        self.lockfile.touch()
+        paths = [self.write_lockfile]
+        if exclusive:
+            paths.append(self.lockfile)
+        for path in paths:
+            fd = self._open(path)
+            deadline = monotonic() + self.probe_grace
+            while True:
+                try:
+                    flock(fd, LOCK_EX | LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if monotonic() >= deadline:
+                        os.close(fd)
+                        self.release_lock()
+                        return False
+                    # possibly a probe of another process: retry
+                    sleep(0.01)
+            self._held.append(fd)
+        self._state = None
         return True
 
     def release_lock(self):
         """
         Release the lock.
         """
-        if self.lockfile.exists():
-            self.lockfile.unlink()
+        while len(self._held) > 0:
+            fd = self._held.pop()
+            flock(fd, LOCK_UN)
+            os.close(fd)
+        self._state = None
+
+    @contextmanager
+    def writing(self):
+        """
+        Context of a modification of the database, during which no maintenance
+        can start.
+        :return: True if the database can be modified.
+        """
+        fd = self._open(self.write_lockfile)
+        try:
+            try:
+                flock(fd, LOCK_SH | LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
 
 
 locker = DbLocking()
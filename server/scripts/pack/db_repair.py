@@ -2,17 +2,101 @@
 Database Repairing actions.
 """
 
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from multiprocessing import get_context
 from pathlib import Path
 
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.timezone import now
+
 from .logger import logger
-from .models import PackageEntry, old_date, safe_create
+from .models import (
+    ArchiveFingerprint,
+    PackageEntry,
+    PackageInspection,
+    fill_package_names,
+    old_date,
+    prune_tombstones,
+    rebuild_statistics,
+    safe_create,
+)
+
+# number of archives checked in one database transaction
+REPAIR_BATCH_SIZE = 100
+# metadata files of the package archives
+METADATA_FILES = ["info.yaml", "edp.info", "description.md"]
+# maximal size of a metadata file
+METADATA_MAX_SIZE = 1024 * 1024
+# position in the archive content after which the metadata are not searched
+METADATA_READ_BUDGET = 16 * 1024 * 1024
+
+
+def _parse_date(value):
+    """
+    Convert a build date of the metadata, UTC if no time zone is given.
+    :param value: The date, as a string or as parsed by yaml.
+    :return: The date.
+    """
+    if isinstance(value, datetime):
+        return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+    value = str(value)
+    if "+" not in value:
+        value += "+0000"
+    return datetime.fromisoformat(value)
 
 
-def get_file_infos(file: Path):
+def _parse_info_yaml(content: bytes, data: dict):
+    """
+    Read the metadata of the new format (info.yaml).
+    :param content: The file content.
+    :param data: The metadata to fill.
+    """
+    import yaml
+
+    infos = yaml.safe_load(content) or {}
+    for key in data.keys():
+        if key in infos.keys():
+            if key == "build_date":
+                data[key] = _parse_date(infos[key])
+                continue
+            data[key] = infos[key] if isinstance(infos[key], str) else str(infos[key])
+
+
+def _parse_edp_info(content: bytes, data: dict):
+    """
+    Read the metadata of the old format (edp.info).
+    :param content: The file content.
+    :param data: The metadata to fill.
+    """
+    for line in content.decode("utf-8").splitlines(keepends=False):
+        if "#" in line:
+            line = line.split("#")[0].strip()
+        if "=" not in line:
+            continue
+        key, val = [it.strip() for it in line.split("=", 1)]
+        if key == "compiler":
+            key = "abi"  # we use abi instead of compiler
+        if key in data.keys():
+            if key == "build_date":
+                data[key] = _parse_date(val)
+                continue
+            data[key] = val
+
+
+def get_file_infos(file: Path, file_list: list = None):
     """
     Try to open archive file to get package metadata.
+
+    The archive is read as a stream, and the reading stops as soon as info.yaml
+    and description.md are found, or after METADATA_READ_BUDGET bytes of content:
+    the metadata are expected at the beginning of the archive. When the file list
+    is asked, the whole archive is read.
     :param file: The file name.
+    :param file_list: List to fill with the paths of the archive content.
     :return: The data read in archive.
     """
     import tarfile
@@ -20,74 +104,261 @@ def get_file_infos(file: Path):
     if file.suffix != ".tgz":
         logger.warning(f"Non-archive file in package dir: {file.name}")
         return {}
-    with tarfile.open(file, "r:gz") as archive:
+    contents = {}
+    with tarfile.open(file, "r|gz") as archive:
         logger.info(f"getting info for archive: {archive.name}")
-        try:
-            data = {
-                "name": "",
-                "version": "",
-                "os": "",
-                "arch": "",
-                "kind": "",
-                "abi": "",
-                "glibc": "",
-                "build_date": old_date,
-                "dependencies": "",
-                "description": "",
-            }
-            # test if info.yaml is present
-            if "./info.yaml" in archive.getnames():
-                logger.info(f"Archive has new format info.yaml.")
-                infos = archive.extractfile("./info.yaml")
-                import yaml
-
-                with open(infos, "r") as infos_file:
-                    content = yaml.safe_load(infos)
-                    for key in data.keys():
-                        if key in content.keys():
-                            if key == "build_date":
-                                if "+" not in content[key]:
-                                    content[key] += "+0000"
-                                data[key] = datetime.fromisoformat(content[key])
-                                continue
-                            data[key] = content[key]
-            else:
-                logger.warn("Archive has old format info.")
-                infos = archive.extractfile("./edp.info")
-                content = infos.read().decode("utf-8")
-                # for line in infos.readlines():
-                #    line = line.decode("utf-8")
-                for line in content.splitlines(keepends=False):
-                    if "#" in line:
-                        line = line.split("#")[0].strip()
-                    if "=" not in line:
-                        continue
-                    key, val = [it.strip() for it in line.split("=", 1)]
-                    if key == "compiler":
-                        key = "abi"  # we use abi instead of compiler
-                    if key in data.keys():
-                        if key == "build_date":
-                            if "+" not in val:
-                                val += "+0000"
-                            data[key] = datetime.fromisoformat(val)
-                            continue
-                        data[key] = val
-            if "./description.md" in archive.getnames():
-                desc_file = archive.extractfile("./description.md")
-                description = desc_file.read().decode("utf-8")
-                data["description"] = description
-            return data
-        except KeyError:
+        for member in archive:
+            name = member.name.removeprefix("./")
+            if file_list is not None and name not in ["", "."]:
+                file_list.append(name)
+            if name in METADATA_FILES and member.isfile():
+                if member.size > METADATA_MAX_SIZE:
+                    logger.warning(f"Archive {file.name}: {name} is too large.")
+                    continue
+                contents[name] = archive.extractfile(member).read()
+                # info.yaml takes precedence over edp.info: keep looking for it
+                if (
+                    file_list is None
+                    and "description.md" in contents
+                    and "info.yaml" in contents
+                ):
+                    break
+            if (
+                file_list is None
+                and member.offset_data + member.size > METADATA_READ_BUDGET
+            ):
+                break
+    data = {
+        "name": "",
+        "version": "",
+        "os": "",
+        "arch": "",
+        "kind": "",
+        "abi": "",
+        "glibc": "",
+        "build_date": old_date,
+        "dependencies": "",
+        "description": "",
+    }
+    if "info.yaml" in contents:
+        logger.info(f"Archive has new format info.yaml.")
+        _parse_info_yaml(contents["info.yaml"], data)
+    elif "edp.info" in contents:
+        logger.warning("Archive has old format info.")
+        _parse_edp_info(contents["edp.info"], data)
+    else:
+        logger.warning(
+            f"Archive file {file.name} does not seems to have informations file"
+        )
+        return {}
+    if "description.md" in contents:
+        data["description"] = contents["description.md"].decode("utf-8")
+    return data
+
+
+def inspect_archive(file: Path):
+    """
+    Get the metadata of an archive, without failing on bad archives.
+    :param file: The archive file.
+    :return: The file and the data read in archive (empty in case of error).
+    """
+    try:
+        return file, get_file_infos(file)
+    except Exception as err:
+        logger.error(f"Cannot read archive {file.name}: {err}")
+        return file, {}
+
+
+def inspect_archives(files: list, workers: int = None):
+    """
+    Read the metadata of archives in parallel, in a pool of processes.
+    :param files: The archive files.
+    :param workers: Number of processes, 1 to read in the current process.
+    :return: Generator of the files and their data, in the order of the files.
+    """
+    if workers is None:
+        workers = settings.REPAIR_WORKERS
+    if workers <= 1:
+        yield from map(inspect_archive, files)
+        return
+    # the workers only read files: forking does not need a new Django setup
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork"))
+    try:
+        yield from executor.map(inspect_archive, files, chunksize=4)
+    finally:
+        # when interrupted, do not wait for the pending inspections
+        executor.shutdown(cancel_futures=True)
+
+
+def _check_file(counter: int, file: Path, data: dict, in_db: list, do_correct: bool):
+    """
+    Check an archive against its database entries.
+    :param counter: Index of the file, for the logs.
+    :param file: The archive file.
+    :param data: The data read in the archive.
+    :param in_db: The entries referencing the file.
+    :param do_correct: If the errors must be corrected.
+    :return: The number of errors and of corrected errors, and the path of the
+        archive (moved into the content-addressed store when an entry is created).
+    """
+    error_count = 0
+    error_corrected = 0
+    file_error_count = 0
+    file_error_corrected = 0
+    if len(in_db) == 0:
+        logger.warning(
+            f"{counter:08d} file: {file.name} not referenced in the database, need to be added {data}."
+        )
+        error_count += 1
+        # nothing to create from an unreadable archive
+        if do_correct and len(data) > 0:
+            entry = safe_create(data, file)
+            if entry is not None:
+                error_corrected += 1
+                file = Path(entry.package.path)
+        return error_count, error_corrected, file
+    elif len(in_db) > 1:
+        # an archive is shared by the entries of identical content: only the
+        # entries of the same flavor are duplicates
+        unique = {}
+        for entry in in_db:
+            unique.setdefault(tuple(entry.get_identity().values()), entry)
+        if len(unique) < len(in_db):
             logger.warning(
-                f"Archive file {file.name} does not seems to have informations file"
+                f"{counter:08d} file: {file.name} referenced multiple times by the same flavor, keep only one entry."
             )
-    return {}
+            error_count += 1
+            if do_correct:
+                for entry in in_db:
+                    if entry not in unique.values():
+                        entry.delete(keep_file=True)
+                error_corrected += 1
+            in_db = list(unique.values())
+    if len(data) == 0:
+        error_count += 1
+        return error_count, error_corrected, file
+    # the metadata of a shared archive cannot match all its entries
+    do_correct = do_correct and len(in_db) == 1
+    for pack in in_db:
+        db_data = get_entry_infos(pack)
+        pack_error_corrected = 0
+        for key in data.keys():
+            if data[key] != db_data[key]:
+                logger.warning(
+                    f"{counter:08d} file: {file.name} different {key}: {data[key]} vs. {db_data[key]}."
+                )
+                if do_correct:
+                    try:
+                        setattr(pack, key, data[key])
+                        pack.save()
+                        pack_error_corrected += 1
+                    except Exception as err:
+                        logger.error(f"While trying to correct file: {err}")
+                file_error_count += 1
+        if pack_error_corrected > 0:
+            # the flagged mismatches are outdated
+            PackageInspection.objects.filter(entry=pack).update(date=None)
+        file_error_corrected += pack_error_corrected
+    if file_error_count > 0:
+        error_count += 1
+        if file_error_count == file_error_corrected:
+            error_corrected += 1
+    return error_count, error_corrected, file
 
 
-def long_repair(do_correct: bool = False, skip_large_files: bool = True):
+def get_entry_infos(pack: PackageEntry):
+    """
+    Get the metadata of an entry, as they are written in its archive.
+    :param pack: The entry.
+    :return: The metadata.
+    """
+    return {
+        "name": pack.name,
+        "version": pack.version,
+        "os": pack.get_os_display(),
+        "arch": pack.get_arch_display(),
+        "kind": pack.get_kind_display(),
+        "abi": pack.get_abi_display().split("-")[0],
+        "glibc": pack.glibc,
+        "build_date": pack.build_date,
+        "dependencies": pack.dependencies,
+        "description": pack.description,
+    }
+
+
+def _to_json(value):
+    """
+    Convert a metadata value for its storage as JSON.
+    :param value: The value.
+    :return:
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def inspect_package(inspection: PackageInspection):
+    """
+    Read the archive of a pushed entry: store its metadata and content, and flag
+    the metadata differing from the entry. The entry is not modified.
+    :param inspection: The pending inspection.
+    :return: The list of the differing fields.
+    """
+    pack = inspection.entry
+    files = []
+    inspection.mismatches = []
+    inspection.error = ""
+    try:
+        data = get_file_infos(Path(pack.package.path), files)
+        if len(data) == 0:
+            inspection.error = "No metadata in the archive."
+    except Exception as err:
+        data = {}
+        inspection.error = f"Cannot read the archive: {err}"[:255]
+    if inspection.error != "":
+        logger.warning(f"Inspection of entry {pack.pk}: {inspection.error}")
+    db_data = get_entry_infos(pack)
+    for key in data.keys():
+        if data[key] != db_data[key]:
+            logger.warning(
+                f"Inspection of entry {pack.pk} ({pack.name}/{pack.version}): different {key}: {data[key]} vs. {db_data[key]}."
+            )
+            inspection.mismatches.append(
+                {
+                    "field": key,
+                    "archive": _to_json(data[key]),
+                    "database": _to_json(db_data[key]),
+                }
+            )
+    inspection.metadata = {key: _to_json(value) for key, value in data.items()}
+    inspection.files = "\n".join(files)
+    inspection.date = now()
+    inspection.save()
+    return [mismatch["field"] for mismatch in inspection.mismatches]
+
+
+def long_repair(
+    do_correct: bool = False,
+    skip_large_files: bool = True,
+    progress=None,
+    workers: int = None,
+    full: bool = False,
+):
     """
     Repair the database by looking into files.
+
+    The archives are read in parallel, the database is checked and corrected in
+    the current process, by batches. The archives unchanged since their last
+    successful check (same size, modification time and inode) are not read again,
+    unless a full repair is asked.
+    :param do_correct: If the errors must be corrected.
+    :param skip_large_files: If the large archives must not be checked.
+    :param progress: Function called with the done and total steps, and a message.
+    :param workers: Number of processes reading the archives.
+    :param full: If all the archives must be read.
     """
+    if progress is None:
+        progress = lambda done, total, message="": None
     start = datetime.now()
     total_error_count = 0
     total_error_corrected = 0
@@ -96,86 +367,82 @@ def long_repair(do_correct: bool = False, skip_large_files: bool = True):
         # FIRST PASS: check if local file correspond to database entry
         #
         logger.info("Starting database repair...")
+        filled = fill_package_names()
+        if filled > 0:
+            logger.info(f"Filled the package file name of {filled} entries.")
         logger.info("Checking local files against database entries...")
         query = PackageEntry.objects.all()
         if len(query) == 0:
             logger.info("Nothing in the query.")
             return
-        pack_dir = Path(query[0].package.path).parent
-        counter = -1
-        for file in pack_dir.iterdir():
-            counter += 1
-            if skip_large_files and file.stat().st_size > 6 * 1024 * 1024:
+        # flat folder of the old stores, content-addressed tree otherwise
+        pack_dir = Path(default_storage.path("packages"))
+        files = sorted(file for file in pack_dir.rglob("*") if file.is_file())
+        total = len(files) + len(query)
+        # all the entries at once, instead of a query per file
+        entries = {}
+        for entry in query:
+            entries.setdefault(entry.package_name, []).append(entry)
+        fingerprints = {fp.path: fp for fp in ArchiveFingerprint.objects.all()}
+        stats = {}
+        to_inspect = []
+        for counter, file in enumerate(files):
+            stats[str(file)] = ArchiveFingerprint.get_stat(file)
+            if skip_large_files and stats[str(file)][0] > 6 * 1024 * 1024:
                 logger.warning(f"{counter:08d} file: {file.name} skipping large file.")
                 continue
-            file_error_count = 0
-            file_error_corrected = 0
-            in_db = PackageEntry.objects.filter(package__endswith=f"/{file.name}")
-            data = get_file_infos(file)
-            if len(in_db) == 0:
-                logger.warning(
-                    f"{counter:08d} file: {file.name} not referenced in the database, need to be added {data}."
-                )
-                total_error_count += 1
-                if do_correct:
-                    entry = safe_create(data, file)
-                    if entry is not None:
-                        entry.save()
-                        total_error_corrected += 1
-                continue
-            elif len(in_db) > 1:
-                logger.warning(
-                    f"{counter:08d} file: {file.name} referenced multiple times in the database, keep only the best entry."
-                )
-                total_error_count += 1
-                if do_correct:
-                    for i in range(len(in_db)):
-                        if i == 0:
-                            continue  # we keep thi one
-                        in_db[i].delete(keep_file=True)
-                    total_error_corrected += 1
-            pack = in_db[0]
-            db_data = {
-                "name": pack.name,
-                "version": pack.version,
-                "os": pack.get_os_display(),
-                "arch": pack.get_arch_display(),
-                "kind": pack.get_kind_display(),
-                "abi": pack.get_abi_display().split("-")[0],
-                "glibc": pack.glibc,
-                "build_date": pack.build_date,
-                "dependencies": pack.dependencies,
-                "description": pack.description,
-            }
-            if len(data) == 0:
-                total_error_count += 1
+            fingerprint = fingerprints.get(str(file))
+            if (
+                not full
+                and fingerprint is not None
+                and fingerprint.matches(stats[str(file)])
+                and file.name in entries
+            ):
                 continue
-            for key in data.keys():
-                if data[key] != db_data[key]:
-                    logger.warning(
-                        f"{counter:08d} file: {file.name} different {key}: {data[key]} vs. {db_data[key]}."
+            to_inspect.append(file)
+        logger.info(
+            f"{len(to_inspect)} archives to read, {len(files) - len(to_inspect)} skipped."
+        )
+        results = enumerate(inspect_archives(to_inspect, workers))
+        while batch := list(islice(results, REPAIR_BATCH_SIZE)):
+            checked = []
+            with transaction.atomic():
+                for counter, (file, data) in batch:
+                    progress(counter, total, f"Checking file {file.name}")
+                    errors, corrected, path = _check_file(
+                        counter, file, data, entries.get(file.name, []), do_correct
                     )
-                    if do_correct:
-                        try:
-                            setattr(pack, key, data[key])
-                            pack.save()
-                            file_error_corrected += 1
-                        except Exception as err:
-                            logger.error(f"While trying to correct file: {err}")
-                    file_error_count += 1
-            if file_error_count > 0:
-                total_error_count += 1
-                if file_error_count == file_error_corrected:
-                    total_error_corrected += 1
-            else:
-                pass
+                    total_error_count += errors
+                    total_error_corrected += corrected
+                    if len(data) > 0 and errors == corrected:
+                        # same file after a move into the store
+                        size, mtime, inode = stats[str(file)]
+                        checked.append(
+                            ArchiveFingerprint(
+                                path=str(path), size=size, mtime=mtime, inode=inode
+                            )
+                        )
+                ArchiveFingerprint.objects.bulk_create(
+                    checked,
+                    update_conflicts=True,
+                    unique_fields=["path"],
+                    update_fields=["size", "mtime", "inode", "date"],
+                )
+        # forget the removed archives
+        removed = [fp.pk for path, fp in fingerprints.items() if path not in stats]
+        for index in range(0, len(removed), REPAIR_BATCH_SIZE):
+            ArchiveFingerprint.objects.filter(
+                pk__in=removed[index : index + REPAIR_BATCH_SIZE]
+            ).delete()
         #
         # SECOND PASS: check database entries
         #
         logger.info("Checking database entries...")
         # redo the query after first corrections
         query = PackageEntry.objects.all()
-        for item in query:
+        total = len(files) + len(query)
+        for index, item in enumerate(query):
+            progress(len(files) + index, total, f"Checking entry {item.pk}")
             if item.package.path in ["", None]:
                 logger.warning(f"Database entry {item.pk}: field 'file' is empty.")
                 total_error_count += 1
@@ -186,6 +453,27 @@ def long_repair(do_correct: bool = False, skip_large_files: bool = True):
                 )
                 total_error_count += 1
                 continue
+            if item.sha256 == "" or item.size != Path(item.package.path).stat().st_size:
+                logger.warning(
+                    f"Database entry {item.pk}: size or checksum of the file is outdated."
+                )
+                total_error_count += 1
+                if do_correct:
+                    item.update_file_infos()
+                    PackageEntry.objects.filter(pk=item.pk).update(
+                        size=item.size, sha256=item.sha256
+                    )
+                    total_error_corrected += 1
+        # the corrections above do not update the statistics
+        statistics = rebuild_statistics()
+        logger.info(
+            f"Statistics rebuilt: {statistics.packages} packages, {statistics.flavors} flavors."
+        )
+        if do_correct:
+            pruned = prune_tombstones(settings.TOMBSTONE_RETENTION)
+            if pruned > 0:
+                logger.info(f"Pruned {pruned} removal traces.")
+        progress(total, total, "Repair done")
 
     except Exception as err:
         logger.error(f"Exception during database repair: {err}.")
@@ -12,3 +12,29 @@ def require_not_locked(view_func):
         return view_func(request, *args, **kwargs)
 
     return _wrapped
+
+
+def require_writable(view_func):
+    @wraps(view_func)
+    def _wrapped(request, *args, **kwargs):
+        from pack.db_locking import locker
+
+        if locker.is_locked(writing=True):
+            return redirect("maintenance")
+        return view_func(request, *args, **kwargs)
+
+    return _wrapped
+
+
+def read_only_database(view_func):
+    @wraps(view_func)
+    def _wrapped(request, *args, **kwargs):
+        from pack.routers import reading_only
+
+        token = reading_only.set(True)
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            reading_only.reset(token)
+
+    return _wrapped
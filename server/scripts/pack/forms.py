@@ -1,8 +1,9 @@
 """Packages forms"""
 
+from django.core.files.uploadedfile import UploadedFile
 from django.forms import ModelForm
 
-from .models import PackageEntry
+from .models import PackageEntry, compute_sha256
 
 
 class PackageEntryForm(ModelForm):
@@ -24,3 +25,18 @@ class PackageEntryForm(ModelForm):
             "package",
             "dependencies",
         ]
+
+    def save(self, commit=True):
+        """
+        Save the entry, with the size and checksum of the uploaded file.
+        :param commit: If the entry must be saved in database.
+        :return: The entry.
+        """
+        entry = super(PackageEntryForm, self).save(commit=False)
+        upload = self.cleaned_data.get("package")
+        if isinstance(upload, UploadedFile):
+            entry.size = upload.size
+            entry.sha256 = compute_sha256(upload.chunks())
+        if commit:
+            entry.save()
+        return entry
@@ -0,0 +1,90 @@
+"""
+Measure the database writes of the API calls.
+"""
+
+from base64 import b64encode
+from secrets import token_hex
+
+from django.contrib.auth.models import Permission, User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from connector.models import ApiToken
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class WriteCounter:
+    """
+    Database wrapper counting the write statements and the transactions that
+    contain them.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.transactions = 0
+        self._blocks = set()
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+            self.statements += 1
+            if not connection.in_atomic_block:
+                # autocommit: each statement is a transaction
+                self.transactions += 1
+            elif id(connection.atomic_blocks[0]) not in self._blocks:
+                self._blocks.add(id(connection.atomic_blocks[0]))
+                self.transactions += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    """
+    Call the API with a temporary user, by password and by token, and report
+    the write statements and transactions the calls needed.
+    """
+
+    help = "Count the database writes per 1,000 API calls."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=1000)
+        parser.add_argument("--url", default="/api", help="The API call to make.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        password = token_hex(16)
+        user = User.objects.create_user(f"bench-{token_hex(4)}", password=password)
+        try:
+            user.user_permissions.add(
+                Permission.objects.get(codename="view_packageentry")
+            )
+            _, raw = ApiToken.create_token(user, "bench")
+            basic = b64encode(f"{user.username}:{password}".encode()).decode("ascii")
+            for kind, auth in (("Basic", f"Basic {basic}"), ("Token", f"Bearer {raw}")):
+                self.bench(kind, auth, options["url"], options["calls"])
+        finally:
+            user.delete()
+            teardown_test_environment()
+
+    def bench(self, kind: str, auth: str, url: str, calls: int):
+        """
+        Make the API calls and report their writes.
+        :param kind: Name of the authentication.
+        :param auth: The authorization header.
+        :param url: The API call.
+        :param calls: Number of calls.
+        """
+        counter = WriteCounter()
+        with connection.execute_wrapper(counter):
+            for _ in range(calls):
+                # no cookie kept between the calls, like the API clients
+                response = Client().get(url, HTTP_AUTHORIZATION=auth)
+                if response.status_code != 200:
+                    self.stderr.write(f"{kind}: status {response.status_code}.")
+                    return
+        self.stdout.write(
+            f"{kind}: {counter.statements * 1000 / calls:.0f} write statements, "
+            f"{counter.transactions * 1000 / calls:.0f} write transactions "
+            f"per 1,000 calls."
+        )
@@ -0,0 +1,117 @@
+"""
+Benchmark of the package lookups with and without database indexes.
+"""
+
+import sqlite3
+from datetime import timedelta
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from pack.models import PackageEntry, old_date
+
+
+class Command(BaseCommand):
+    """
+    Build a synthetic SQLite database and time the lookups done by the server.
+    """
+
+    help = "Benchmark package lookups on synthetic rows, before and after indexing."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        repeat = options["repeat"]
+        with connection.schema_editor(collect_sql=True) as editor:
+            editor.create_model(PackageEntry)
+        table_sql = [sql for sql in editor.collected_sql if "INDEX" not in sql]
+        index_sql = [sql for sql in editor.collected_sql if "INDEX" in sql]
+        samples = [rows // 7, rows // 2, rows - 1]
+        lookups = {
+            "flavor tuple (import)": lambda i: PackageEntry.objects.filter(
+                name=f"pack{i // 40:05d}",
+                version=f"{i % 40 // 8}.0.0",
+                os="l",
+                arch="x" if i % 2 == 0 else "a",
+                kind="r" if i % 8 < 4 else "t",
+                abi="g",
+                glibc="",
+                build_date=old_date + timedelta(hours=i),
+            ).values_list("pk")[:1],
+            "name (detail)": lambda i: PackageEntry.objects.filter(
+                name=f"pack{i // 40:05d}"
+            ),
+            "file name (repair)": lambda i: PackageEntry.objects.filter(
+                package_name=f"pack-{i:07d}.tgz"
+            ),
+        }
+        with TemporaryDirectory() as tmp_dir:
+            db = sqlite3.connect(f"{tmp_dir}/bench.db")
+            for sql in table_sql:
+                db.execute(sql)
+            self.stdout.write(f"Creating {rows} synthetic rows...")
+            # every column, with its default when not set here
+            fields = [
+                field
+                for field in PackageEntry._meta.concrete_fields
+                if not field.primary_key
+            ]
+            db.executemany(
+                f"INSERT INTO {PackageEntry._meta.db_table}"
+                f" ({', '.join(field.column for field in fields)})"
+                f" VALUES ({', '.join('?' * len(fields))})",
+                (
+                    [
+                        field.get_db_prep_save(
+                            values.get(field.name, field.get_default()), connection
+                        )
+                        for field in fields
+                    ]
+                    for values in (
+                        {
+                            "name": f"pack{i // 40:05d}",
+                            "version": f"{i % 40 // 8}.0.0",
+                            "os": "l",
+                            "arch": "x" if i % 2 == 0 else "a",
+                            "kind": "r" if i % 8 < 4 else "t",
+                            "abi": "g",
+                            "build_date": old_date + timedelta(hours=i),
+                            "date": old_date,
+                            "package": f"packages/pack-{i:07d}.tgz",
+                            "package_name": f"pack-{i:07d}.tgz",
+                        }
+                        for i in range(rows)
+                    )
+                ),
+            )
+            db.commit()
+            results = {}
+            for step in ["without indexes", "with indexes"]:
+                if step == "with indexes":
+                    for sql in index_sql:
+                        db.execute(sql)
+                    db.execute("ANALYZE")
+                for label, lookup in lookups.items():
+                    queries = [
+                        lookup(i).query.sql_with_params() for i in samples * repeat
+                    ]
+                    start = perf_counter()
+                    for sql, params in queries:
+                        found = db.execute(sql.replace("%s", "?"), params).fetchall()
+                        if len(found) == 0:
+                            raise RuntimeError(f"Lookup '{label}' found nothing.")
+                    duration = perf_counter() - start
+                    results.setdefault(label, {})[step] = duration / len(queries)
+            db.close()
+        self.stdout.write(f"{'lookup':<24}{'without':>14}{'with':>14}{'speedup':>10}")
+        for label, timing in results.items():
+            before = timing["without indexes"] * 1e6
+            after = timing["with indexes"] * 1e6
+            self.stdout.write(
+                f"{label:<24}{before:>11.1f} us{after:>11.1f} us{before / after:>9.0f}x"
+            )
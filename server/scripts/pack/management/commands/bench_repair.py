@@ -0,0 +1,90 @@
+"""
+Benchmark of the archive inspection of the database repair.
+"""
+
+import os
+import tarfile
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from pack.db_repair import inspect_archives
+
+
+class Command(BaseCommand):
+    """
+    Build synthetic package archives and time their inspection with an
+    increasing number of processes.
+    """
+
+    help = "Benchmark the parallel reading of package archives by the repair."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--archives", type=int, default=200)
+        parser.add_argument(
+            "--size", type=int, default=2048, help="Archive content size, in KiB."
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            nargs="+",
+            default=None,
+            help="Process counts to compare (default: powers of 2 up to the CPU count).",
+        )
+
+    def handle(self, *args, **options):
+        workers_list = options["workers"]
+        if workers_list is None:
+            workers_list = [1]
+            while workers_list[-1] * 2 <= (os.cpu_count() or 1):
+                workers_list.append(workers_list[-1] * 2)
+        with TemporaryDirectory() as tmp_dir:
+            self.stdout.write(
+                f"Creating {options['archives']} archives of {options['size']} KiB..."
+            )
+            files = [
+                self.make_archive(Path(tmp_dir), index, options["size"] * 1024)
+                for index in range(options["archives"])
+            ]
+            reference = None
+            for workers in workers_list:
+                begin = perf_counter()
+                results = list(inspect_archives(files, workers))
+                duration = perf_counter() - begin
+                if reference is None:
+                    reference = duration
+                if any(len(data) == 0 for _, data in results):
+                    self.stderr.write("Some archives could not be read.")
+                self.stdout.write(
+                    f"{workers:3d} processes: {duration:8.3f} s"
+                    f" ({len(files) / duration:8.1f} archives/s, x{reference / duration:.2f})"
+                )
+
+    @staticmethod
+    def make_archive(folder: Path, index: int, size: int):
+        """
+        Create a synthetic package archive, with metadata and incompressible content.
+        :param folder: The destination folder.
+        :param index: Index of the package.
+        :param size: Size of the content.
+        :return: The archive path.
+        """
+        path = folder / f"bench-{index:06d}.tgz"
+        info = (
+            f"name = bench{index}\nversion = 1.0.0\nos = Linux\narch = x86_64\n"
+            f"kind = static\nabi = gnu\nglibc = 2.35\n"
+            f"build_date = 2024-01-01T00:00:00\n"
+        ).encode()
+        with tarfile.open(path, "w:gz") as archive:
+            for name, content in [
+                ("./edp.info", info),
+                ("./description.md", f"# bench{index}\n".encode()),
+                ("./lib/libbench.a", os.urandom(size)),
+            ]:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                archive.addfile(member, BytesIO(content))
+        return path
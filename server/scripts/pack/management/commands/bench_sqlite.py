@@ -0,0 +1,177 @@
+"""
+Measure the read throughput of SQLite while an import is writing.
+"""
+
+import sqlite3
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from scripts.settings import DATA_DIR, SQLITE_INIT_COMMAND
+
+CATALOG_QUERY = (
+    "SELECT name, version, os, arch, kind, abi, glibc, build_date FROM catalog"
+    " ORDER BY name, version"
+)
+
+
+class Command(BaseCommand):
+    """
+    Run readers (index queries) while a writer imports entries (one transaction
+    per entry, as long_import does), on a scratch database, with the SQLite
+    defaults of Django then with the configured pragmas.
+    """
+
+    help = "Compare the read throughput during an import, with and without the SQLite tuning."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--duration", type=float, default=5.0)
+        parser.add_argument("--readers", type=int, default=6)
+        parser.add_argument(
+            "--entries", type=int, default=2000, help="Size of the catalog."
+        )
+
+    def handle(self, *args, **options):
+        configurations = [
+            # Django defaults: rollback journal, deferred transactions
+            ("default", "", "", "BEGIN"),
+            (
+                "tuned",
+                SQLITE_INIT_COMMAND,
+                settings.DATABASES["readonly"]["OPTIONS"]["init_command"],
+                "BEGIN IMMEDIATE",
+            ),
+        ]
+        # on the disk of the server database
+        with TemporaryDirectory(dir=DATA_DIR) as tmp:
+            for name, init, read_init, begin in configurations:
+                path = f"{tmp}/{name}.db"
+                self.create(path, options["entries"])
+                result = self.bench(
+                    path,
+                    init,
+                    read_init,
+                    begin,
+                    options["readers"],
+                    options["duration"],
+                )
+                self.stdout.write(
+                    f"{name:>8}: {result['reads'] / options['duration']:8.1f} reads/s"
+                    f" (p95 {result['p95'] * 1000:.1f} ms,"
+                    f" {result['read_errors']} errors),"
+                    f" {result['writes'] / options['duration']:8.1f} writes/s"
+                    f" ({result['write_errors']} errors)"
+                )
+
+    @staticmethod
+    def connect(path: str, init: str):
+        """
+        Open a connection like Django does, then apply the initialization.
+        :param path: The database file.
+        :param init: The initialization statements.
+        :return: The connection, in autocommit mode.
+        """
+        connection = sqlite3.connect(path, isolation_level=None)
+        for statement in init.split(";"):
+            if statement.strip() != "":
+                connection.execute(statement).fetchall()
+        return connection
+
+    def create(self, path: str, entries: int):
+        """
+        Create the scratch database.
+        :param path: The database file.
+        :param entries: Number of entries in the catalog.
+        """
+        connection = self.connect(path, "")
+        connection.executescript(
+            """
+            CREATE TABLE catalog (
+                id INTEGER PRIMARY KEY, name TEXT, version TEXT, os TEXT,
+                arch TEXT, kind TEXT, abi TEXT, glibc TEXT, build_date TEXT,
+                dependencies TEXT
+            );
+            CREATE INDEX catalog_name ON catalog (name, version);
+            CREATE TABLE dependency (id INTEGER PRIMARY KEY, entry_id INTEGER, name TEXT);
+            CREATE TABLE revision (value INTEGER);
+            INSERT INTO revision VALUES (0);
+            """
+        )
+        connection.executemany(
+            "INSERT INTO catalog (name, version, os, arch, kind, abi, glibc,"
+            " build_date, dependencies) VALUES (?, ?, 'l', 'x', 'r', 'g', '',"
+            " '2026-01-01', ?)",
+            (
+                (f"pack{index % 300}", f"1.{index}", "x" * 200)
+                for index in range(entries)
+            ),
+        )
+        connection.close()
+
+    def bench(self, path, init, read_init, begin, readers, duration):
+        """
+        Run the readers and the writer.
+        :param path: The database file.
+        :param init: The initialization of the writer connection.
+        :param read_init: The initialization of the reader connections.
+        :param begin: The statement beginning the write transactions.
+        :param readers: Number of reader threads.
+        :param duration: Duration of the run in seconds.
+        :return: Dictionary of the results.
+        """
+        stop = Event()
+        result = {"reads": 0, "read_errors": 0, "writes": 0, "write_errors": 0}
+        latencies = []
+
+        def read():
+            connection = self.connect(path, read_init)
+            while not stop.is_set():
+                start = perf_counter()
+                try:
+                    connection.execute(CATALOG_QUERY).fetchall()
+                except sqlite3.OperationalError:
+                    result["read_errors"] += 1
+                    continue
+                latencies.append(perf_counter() - start)
+                result["reads"] += 1
+            connection.close()
+
+        def write():
+            connection = self.connect(path, init)
+            index = 0
+            while not stop.is_set():
+                index += 1
+                try:
+                    connection.execute(begin)
+                    connection.execute("UPDATE revision SET value = value + 1")
+                    entry = connection.execute(
+                        "INSERT INTO catalog (name, version, os, arch, kind, abi,"
+                        " glibc, build_date, dependencies) VALUES (?, '1.0', 'w',"
+                        " 'x', 'r', 'm', '', '2026-01-01', ?)",
+                        (f"imported{index}", "x" * 200),
+                    ).lastrowid
+                    connection.executemany(
+                        "INSERT INTO dependency (entry_id, name) VALUES (?, ?)",
+                        ((entry, f"dep{dep}") for dep in range(3)),
+                    )
+                    connection.execute("COMMIT")
+                    result["writes"] += 1
+                except sqlite3.OperationalError:
+                    result["write_errors"] += 1
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK")
+            connection.close()
+
+        threads = [Thread(target=write)] + [Thread(target=read) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        result["p95"] = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        return result
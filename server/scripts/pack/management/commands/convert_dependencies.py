@@ -0,0 +1,35 @@
+"""
+Convert the dependencies text of the entries into dependency rows.
+"""
+
+from django.core.management.base import BaseCommand
+
+from pack.models import PackageEntry
+
+
+class Command(BaseCommand):
+    """
+    Fill the PackageDependency table from the dependencies pushed as text.
+    """
+
+    help = "Convert the dependencies text of the entries into dependency rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Convert every entry, not only the ones without dependency rows.",
+        )
+
+    def handle(self, *args, **options):
+        query = PackageEntry.objects.exclude(dependencies="")
+        if not options["all"]:
+            query = query.filter(requirements__isnull=True)
+        entries = 0
+        dependencies = 0
+        for entry in query.iterator(chunk_size=500):
+            dependencies += entry.update_dependencies()
+            entries += 1
+        self.stdout.write(
+            f"Converted {dependencies} dependencies of {entries} entries."
+        )
@@ -0,0 +1,123 @@
+"""
+Move the package files into the content-addressed store.
+"""
+
+import os
+from pathlib import Path
+from shutil import copyfile
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from pack.catalog import bump_generation
+from pack.db_locking import locker
+from pack.models import (
+    PackageEntry,
+    blob_name,
+    blob_name_re,
+    compute_sha256,
+    rebuild_statistics,
+)
+
+
+class Command(BaseCommand):
+    """
+    Convert a store of archives named after their upload into the
+    content-addressed store (packages/ab/cd/<sha256>.tgz), keeping a single copy
+    of the identical archives.
+    """
+
+    help = "Deduplicate the package files into the content-addressed store."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be moved and freed.",
+        )
+
+    def handle(self, *args, **options):
+        # the files move: no download during the conversion
+        if not locker.get_lock(exclusive=True):
+            raise CommandError("The database is already under maintenance.")
+        try:
+            self.dedup(options["dry_run"])
+        finally:
+            locker.release_lock()
+
+    @staticmethod
+    def store(file: Path, target: Path):
+        """
+        Put a copy of an archive in the store, keeping the archive.
+        :param file: The archive.
+        :param target: The path in the store.
+        """
+        target.parent.mkdir(parents=True, exist_ok=True)
+        partial = target.with_suffix(".part")
+        try:
+            os.link(file, partial)
+        except OSError:
+            # other file system
+            copyfile(file, partial)
+        partial.replace(target)
+
+    def dedup(self, dry_run: bool):
+        """
+        Move the archives of the entries into the store.
+        :param dry_run: If nothing must be modified.
+        """
+        # entries referencing each stored file
+        files = {}
+        for pk, name in PackageEntry.objects.exclude(package="").values_list(
+            "pk", "package"
+        ):
+            if blob_name_re.match(name) is None:
+                files.setdefault(name, []).append(pk)
+        moved = 0
+        dropped = 0
+        freed = 0
+        missing = 0
+        names = set()
+        stored = set()
+        for name, pks in files.items():
+            file = Path(default_storage.path(name))
+            if not file.exists():
+                self.stderr.write(f"Missing file {name}, referenced by {pks}.")
+                missing += 1
+                continue
+            size = file.stat().st_size
+            with open(file, "rb") as fp:
+                sha256 = compute_sha256(iter(lambda: fp.read(1024 * 1024), b""))
+            target = Path(default_storage.path(blob_name(sha256)))
+            if target.exists() or sha256 in stored:
+                dropped += 1
+                freed += size
+            else:
+                moved += 1
+            stored.add(sha256)
+            if dry_run:
+                continue
+            if not target.exists():
+                self.store(file, target)
+            with transaction.atomic():
+                query = PackageEntry.objects.filter(pk__in=pks)
+                names.update(query.values_list("name", flat=True))
+                # not a new revision: the index does not show the file names
+                query.update(
+                    package=blob_name(sha256),
+                    package_name=target.name,
+                    size=size,
+                    sha256=sha256,
+                )
+            # no entry references the old file once committed
+            file.unlink()
+        if len(names) > 0:
+            # the sizes are updated in bulk
+            rebuild_statistics()
+            bump_generation(*names)
+        self.stdout.write(
+            f"{'Would move' if dry_run else 'Moved'} {moved} files, "
+            f"{'would drop' if dry_run else 'dropped'} {dropped} duplicates "
+            f"({freed / 1024 / 1024:.1f} MiB), {missing} missing files."
+        )
@@ -0,0 +1,44 @@
+"""
+Fill the size and checksum of the package files in the database.
+"""
+
+from django.core.management.base import BaseCommand
+
+from pack.models import PackageEntry, rebuild_statistics
+
+
+class Command(BaseCommand):
+    """
+    Backfill the file information of entries pushed before they were stored.
+    """
+
+    help = "Fill the size and SHA-256 checksum of the package files in database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute the information of every entry, not only the missing ones.",
+        )
+
+    def handle(self, *args, **options):
+        query = PackageEntry.objects.all()
+        if not options["all"]:
+            query = query.filter(sha256="")
+        filled = 0
+        missing = 0
+        for entry in query.iterator(chunk_size=500):
+            if not entry.update_file_infos():
+                self.stderr.write(
+                    f"Entry {entry.pk} ({entry.name}/{entry.version}): missing file."
+                )
+                missing += 1
+                continue
+            # update only these fields, to not touch the upload date
+            PackageEntry.objects.filter(pk=entry.pk).update(
+                size=entry.size, sha256=entry.sha256
+            )
+            filled += 1
+        if filled > 0:
+            rebuild_statistics()
+        self.stdout.write(f"Filled {filled} entries, {missing} with missing file.")
@@ -0,0 +1,45 @@
+"""
+Repair the database from the package files.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pack.db_locking import locker
+from pack.db_repair import long_repair
+
+
+class Command(BaseCommand):
+    """
+    Run a database repair in the current process, e.g. from a nightly cron job.
+    """
+
+    help = "Check the package files against the database, and correct it."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Read all the archives, even the ones unchanged since their last check.",
+        )
+        parser.add_argument(
+            "--check-only",
+            action="store_true",
+            help="Only report the errors, without correcting them.",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=None, help="Processes reading the archives."
+        )
+
+    def handle(self, *args, **options):
+        # a correcting repair deletes entries: no reading meanwhile
+        if not locker.get_lock(exclusive=not options["check_only"]):
+            raise CommandError("The database is already under maintenance.")
+        try:
+            long_repair(
+                do_correct=not options["check_only"],
+                skip_large_files=False,
+                workers=options["workers"],
+                full=options["full"],
+            )
+        finally:
+            locker.release_lock()
@@ -0,0 +1,48 @@
+"""
+Run the queued maintenance jobs.
+"""
+
+from time import sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pack.task import (
+    acquire_worker_lock,
+    inspect_pending_packages,
+    recover_jobs,
+    run_pending_jobs,
+)
+
+
+class Command(BaseCommand):
+    """
+    Job worker, running the maintenance jobs one at a time, and inspecting the
+    archives of the pushed packages.
+    """
+
+    help = (
+        "Run the queued maintenance jobs (repair, import) and the inspections"
+        " of the pushed packages, forever by default."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run the currently queued jobs and exit.",
+        )
+
+    def handle(self, *args, **options):
+        if not acquire_worker_lock():
+            raise CommandError("Another job worker is running.")
+        recovered = recover_jobs()
+        if recovered > 0:
+            self.stderr.write(f"{recovered} interrupted jobs marked as failed.")
+        while True:
+            count = run_pending_jobs()
+            inspected = inspect_pending_packages()
+            if options["once"]:
+                self.stdout.write(f"Ran {count} jobs, inspected {inspected} packages.")
+                return
+            sleep(settings.JOB_POLL_INTERVAL)
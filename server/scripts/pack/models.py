@@ -2,17 +2,52 @@
 Package models.
 """
 
-from datetime import datetime
+import ast
+import hashlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from fnmatch import translate
+from functools import reduce
+from heapq import merge
+from itertools import groupby
+from operator import itemgetter, or_
 from pathlib import Path
+from re import compile as re_compile
+from shutil import move
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, F, Q, Sum
 from django.utils import timezone
 
+from pack.catalog import bump_generation
 from pack.logger import logger
 from scripts.settings import MEDIA_ROOT
 
 old_date = datetime.fromisoformat("2000-01-01T00:00:00+0000")
 
+# content-addressed name of the package archives, relative to MEDIA_ROOT
+BLOB_NAME = "packages/{0:.2}/{1:.2}/{0}.tgz"
+blob_name_re = re_compile(r"^packages/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.tgz$")
+
+
+def blob_name(sha256: str):
+    """
+    Get the storage name of an archive from its checksum.
+    :param sha256: The SHA-256 checksum of the archive.
+    :return: The name, relative to MEDIA_ROOT.
+    """
+    return BLOB_NAME.format(sha256, sha256[2:])
+
+
+def blob_upload_to(instance, filename: str):
+    """
+    Storage name of an uploaded archive: the original file name is not used.
+    :param instance: The entry, its checksum must be known.
+    :param filename: The uploaded file name.
+    :return: The name, relative to MEDIA_ROOT.
+    """
+    return blob_name(instance.sha256)
+
 
 # Create your models here.
 class PackageEntry(models.Model):
@@ -47,7 +82,31 @@ class PackageEntry(models.Model):
         verbose_name="Date of Build",
     )
     date = models.DateTimeField(default=timezone.now, verbose_name="Date of Upload")
-    package = models.FileField(upload_to="packages", verbose_name="Package file")
+    package = models.FileField(upload_to=blob_upload_to, verbose_name="Package file")
+    package_name = models.CharField(
+        max_length=255,
+        default="",
+        db_index=True,
+        editable=False,
+        verbose_name="Package file base name",
+    )
+    size = models.BigIntegerField(
+        default=0, editable=False, verbose_name="Package file size"
+    )
+    sha256 = models.CharField(
+        max_length=64,
+        default="",
+        blank=True,
+        editable=False,
+        verbose_name="Package file SHA-256 checksum",
+    )
+
+    revision = models.BigIntegerField(
+        default=0,
+        db_index=True,
+        editable=False,
+        verbose_name="Catalog revision of the last modification",
+    )
 
     dependencies = models.TextField(
         default="", verbose_name="Package dependencies", blank=True
@@ -62,6 +121,22 @@ class PackageEntry(models.Model):
         """
 
         verbose_name = "C++ Package repository item"
+        indexes = [
+            # flavor identity, also serves the lookups on name alone
+            models.Index(
+                fields=[
+                    "name",
+                    "version",
+                    "os",
+                    "arch",
+                    "kind",
+                    "abi",
+                    "glibc",
+                    "build_date",
+                ],
+                name="pack_flavor_idx",
+            ),
+        ]
 
     def check_file(self):
         """
@@ -84,6 +159,24 @@ class PackageEntry(models.Model):
             self.save(update_fields=["package"])
             logger.info(f"Corrected absolute path to relative: {relative_path}")
 
+    identity_fields = [
+        "name",
+        "version",
+        "os",
+        "arch",
+        "kind",
+        "abi",
+        "glibc",
+        "build_date",
+    ]
+
+    def get_identity(self):
+        """
+        Values identifying the entry in the API index.
+        :return: Dictionary of the identity fields.
+        """
+        return {key: getattr(self, key) for key in self.identity_fields}
+
     def save(self, *args, **kwargs):
         """
         Overload of the save procedure to check the date
@@ -91,18 +184,107 @@ class PackageEntry(models.Model):
         :param kwargs:
         """
         self.date = timezone.now()
-        super(PackageEntry, self).save(*args, **kwargs)
+        uploaded = self.package and not self.package._committed
+        if uploaded and self.sha256 == "":
+            self.size = self.package.size
+            self.sha256 = compute_sha256(self.package.chunks())
+        with transaction.atomic():
+            # in the transaction: the removal of an identical archive (see
+            # delete_unreferenced_file) cannot happen meanwhile
+            if uploaded and self.package.storage.exists(blob_name(self.sha256)):
+                # identical archive already stored
+                self.package = blob_name(self.sha256)
+            elif uploaded:
+                # store the uploaded file first to know its final name
+                self.package.save(self.package.name, self.package.file, save=False)
+            self.package_name = Path(self.package.name or "").name
+            self.revision = next_revision()
+            stored_identity = getattr(self, "_stored_identity", None)
+            names = {self.name}
+            if stored_identity is not None and stored_identity != self.get_identity():
+                names.add(stored_identity["name"])
+                # the former entry disappears from the index
+                PackageTombstone.objects.create(
+                    entry_id=self.pk, revision=self.revision, **stored_identity
+                )
+            stored = _statistic_values(self.pk)
+            super(PackageEntry, self).save(*args, **kwargs)
+            values = {key: getattr(self, key) for key in statistic_fields}
+            if stored != values:
+                update_statistics(stored, values)
+            if (
+                "dependencies" in self.__dict__
+                and getattr(self, "_stored_dependencies", None) != self.dependencies
+            ):
+                self.update_dependencies()
+            # after the outermost commit: nothing cached on the former catalog
+            # under the new generation
+            transaction.on_commit(lambda: bump_generation(*names))
+        self._stored_identity = self.get_identity()
 
-    def delete(self, keep_file: bool = False, *args, **kwargs):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Overload of the loading from database to remember the stored dependencies.
+        :param db:
+        :param field_names:
+        :param values:
+        :return:
         """
+        instance = super(PackageEntry, cls).from_db(db, field_names, values)
+        instance._stored_dependencies = instance.__dict__.get("dependencies")
+        if all(key in instance.__dict__ for key in cls.identity_fields):
+            instance._stored_identity = instance.get_identity()
+        return instance
 
-        :param keep_file:
+    def update_dependencies(self):
+        """
+        Parse the dependencies text and store them as PackageDependency rows.
+        :return: The number of dependencies.
+        """
+        self.requirements.all().delete()
+        dependencies = []
+        for dep in parse_dependencies(self.dependencies):
+            if not isinstance(dep, dict) or dep.get("name") in ["", None]:
+                logger.warning(
+                    f"Ignoring bad dependency of ({self.name}/{self.version}): {dep}"
+                )
+                continue
+            dependencies.append(
+                PackageDependency(
+                    entry=self,
+                    position=len(dependencies),
+                    **{
+                        key: str(dep[key]) if dep.get(key) is not None else ""
+                        for key in PackageDependency.spec_fields
+                    },
+                )
+            )
+        PackageDependency.objects.bulk_create(dependencies)
+        self._stored_dependencies = self.dependencies
+        return len(dependencies)
+
+    def delete(self, keep_file: bool = False, *args, **kwargs):
+        """
+        Delete the entry, and its archive if no other entry references it.
+        :param keep_file: If the archive must be kept anyway.
         :param args:
         :param kwargs:
         """
-        if Path(self.package.path).exists() and not keep_file:
-            self.package.delete()
-        super(PackageEntry, self).delete(*args, **kwargs)
+        storage, file = self.package.storage, self.package.name
+        with transaction.atomic():
+            PackageTombstone.objects.create(
+                entry_id=self.pk,
+                revision=next_revision(),
+                **getattr(self, "_stored_identity", self.get_identity()),
+            )
+            update_statistics(_statistic_values(self.pk), None)
+            super(PackageEntry, self).delete(*args, **kwargs)
+            if file not in ["", None] and not keep_file:
+                # the references are checked again once the removal is committed
+                transaction.on_commit(lambda: delete_unreferenced_file(storage, file))
+            name = self.name
+            transaction.on_commit(lambda: bump_generation(name))
 
     def match(self, match_to):
         """
@@ -135,18 +317,58 @@ class PackageEntry(models.Model):
 
         :return:
         """
-        if self.glibc == "":
-            return f"{self.name}/{self.version} ({self.build_date.isoformat()}) [{self.get_arch_display()}, {self.get_kind_display()}, {self.get_os_display()}, {self.get_abi_display()}]"
-        return f"{self.name}/{self.version} ({self.build_date.isoformat()}) [{self.get_arch_display()}, {self.get_kind_display()}, {self.get_os_display()}, {self.get_abi_display()}, {self.glibc}]"
+        return format_dep_entry(
+            self.name,
+            self.version,
+            self.build_date,
+            self.arch,
+            self.kind,
+            self.os,
+            self.abi,
+            self.glibc,
+        )
 
-    def get_pretty_size_display(self):
+    def store_file(self, file: Path):
         """
+        Move a local archive into the package store, and reference it (entry is
+        not saved). The file is dropped if an identical archive is already stored.
+        :param file: The archive.
+        """
+        self.size = file.stat().st_size
+        with open(file, "rb") as fp:
+            self.sha256 = compute_sha256(iter(lambda: fp.read(1024 * 1024), b""))
+        self.package = blob_name(self.sha256)
+        target = Path(self.package.path)
+        if target.exists():
+            if target.resolve() != file.resolve():
+                file.unlink()
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        move(file, target)
+
+    def update_file_infos(self):
+        """
+        Read the size and the checksum of the package file (entry is not saved).
+        :return: True if the file exists.
+        """
+        if self.package.name in ["", None] or not Path(self.package.path).exists():
+            self.size = 0
+            self.sha256 = ""
+            return False
+        file = Path(self.package.path)
+        self.size = file.stat().st_size
+        with open(file, "rb") as fp:
+            self.sha256 = compute_sha256(iter(lambda: fp.read(1024 * 1024), b""))
+        return True
 
+    def get_pretty_size_display(self):
+        """
+        Human-readable size of the package file, as stored in database.
         :return:
         """
-        if not Path(self.package.path).exists():
+        if self.sha256 == "":
             return f"(void)"
-        raw_size = Path(self.package.path).stat().st_size
+        raw_size = self.size
         for unite in ["", "K", "M", "G", "T"]:
             if raw_size < 1024.0:
                 break
@@ -154,6 +376,634 @@ class PackageEntry(models.Model):
         return f"{raw_size:.2f} {unite}"
 
 
+class PackageTombstone(models.Model):
+    """
+    Trace of an entry removed from the index, for incremental synchronization.
+    """
+
+    entry_id = models.BigIntegerField(verbose_name="Removed entry's id.")
+    revision = models.BigIntegerField(
+        db_index=True, verbose_name="Catalog revision of the removal"
+    )
+    name = models.CharField(max_length=60, verbose_name="Package's Name.")
+    version = models.CharField(max_length=25, verbose_name="Package's Version.")
+    os = models.CharField(max_length=1, choices=PackageEntry.OsType)
+    arch = models.CharField(max_length=1, choices=PackageEntry.ArchType)
+    kind = models.CharField(max_length=1, choices=PackageEntry.KindType)
+    abi = models.CharField(max_length=1, choices=PackageEntry.AbiType)
+    glibc = models.CharField(max_length=25, default="")
+    build_date = models.DateTimeField(default=old_date)
+    date = models.DateTimeField(default=timezone.now, verbose_name="Date of Removal")
+
+    class Meta:
+        """
+        Metadata for the tombstones
+        """
+
+        verbose_name = "C++ Package removal"
+
+
+class CatalogRevision(models.Model):
+    """
+    Monotonic revision counter of the catalog (single row).
+    """
+
+    value = models.BigIntegerField(default=0)
+    pruned = models.BigIntegerField(
+        default=0, verbose_name="Revision up to which the tombstones are pruned"
+    )
+
+
+def next_revision():
+    """
+    Increment the catalog revision; must be called inside a transaction.
+    :return: The new revision.
+    """
+    if CatalogRevision.objects.filter(pk=1).update(value=F("value") + 1) == 0:
+        CatalogRevision.objects.create(pk=1, value=1)
+    return CatalogRevision.objects.get(pk=1).value
+
+
+def get_pruned_revision():
+    """
+    Get the revision up to which the tombstones are pruned: the clients knowing
+    an older revision cannot be synchronized incrementally.
+    :return: The revision, 0 if nothing was ever pruned.
+    """
+    return (
+        CatalogRevision.objects.filter(pk=1).values_list("pruned", flat=True).first()
+        or 0
+    )
+
+
+def prune_tombstones(keep: int):
+    """
+    Delete the tombstones older than the last revisions.
+    :param keep: Number of the last revisions whose tombstones are kept.
+    :return: The number of deleted tombstones.
+    """
+    with transaction.atomic():
+        revision = CatalogRevision.objects.filter(pk=1).first()
+        if revision is None or revision.value - keep <= revision.pruned:
+            return 0
+        revision.pruned = revision.value - keep
+        revision.save(update_fields=["pruned"])
+        return PackageTombstone.objects.filter(revision__lte=revision.pruned).delete()[
+            0
+        ]
+
+
+def get_revision():
+    """
+    Get the current catalog revision.
+    :return: The revision, 0 if nothing was ever modified.
+    """
+    return (
+        CatalogRevision.objects.filter(pk=1).values_list("value", flat=True).first()
+        or 0
+    )
+
+
+class CatalogStatistic(models.Model):
+    """
+    Aggregates of the catalog, maintained at each modification: number of
+    flavors (entries) and of archive bytes, in total and by value of a field.
+
+    The total row also counts the distinct package names, using the rows by
+    name to know when a name appears or disappears.
+    """
+
+    DimensionType = (
+        ("all", "Total"),
+        ("name", "Name"),
+        ("os", "Operating system"),
+        ("arch", "Architecture"),
+        ("kind", "Kind"),
+        ("abi", "ABI"),
+    )
+
+    dimension = models.CharField(max_length=4, choices=DimensionType)
+    value = models.CharField(max_length=60, default="")
+    flavors = models.BigIntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+    packages = models.BigIntegerField(default=0)
+
+    class Meta:
+        """
+        Metadata for the statistics
+        """
+
+        constraints = [
+            models.UniqueConstraint(
+                fields=["dimension", "value"], name="unique_catalog_statistic"
+            )
+        ]
+
+
+# fields of an entry contributing to the statistics
+statistic_fields = ["name", "os", "arch", "kind", "abi", "size"]
+
+
+def _statistic_values(pk):
+    """
+    Get the stored values of an entry contributing to the statistics.
+    :param pk: The entry's id.
+    :return: Dictionary of the values, None if the entry is not stored.
+    """
+    if pk is None:
+        return None
+    return PackageEntry.objects.filter(pk=pk).values(*statistic_fields).first()
+
+
+def update_statistics(old: dict, new: dict):
+    """
+    Update the statistics with a modified entry; must be called inside a
+    transaction. Nothing is done until the statistics are built.
+    :param old: The former values of the entry, None for a new entry.
+    :param new: The new values of the entry, None for a removed entry.
+    """
+    if not CatalogStatistic.objects.filter(dimension="all").exists():
+        # not built yet: they will be computed at their first reading
+        return
+    deltas = {}
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        for dimension, _ in CatalogStatistic.DimensionType:
+            key = (dimension, "" if dimension == "all" else values[dimension])
+            flavors, size = deltas.get(key, (0, 0))
+            deltas[key] = (flavors + sign, size + sign * (values["size"] or 0))
+    total_flavors, total_size = deltas.pop(("all", ""), (0, 0))
+    # the names appearing or disappearing from the catalog
+    packages = 0
+    for (dimension, value), (flavors, size) in deltas.items():
+        if flavors == 0 and size == 0:
+            continue
+        query = CatalogStatistic.objects.filter(dimension=dimension, value=value)
+        if query.update(flavors=F("flavors") + flavors, size=F("size") + size) == 0:
+            CatalogStatistic.objects.create(
+                dimension=dimension, value=value, flavors=flavors, size=size
+            )
+        if dimension != "name" or flavors == 0:
+            continue
+        remaining = query.values_list("flavors", flat=True).first()
+        if flavors > 0 and remaining == flavors:
+            packages += 1
+        elif flavors < 0 and remaining <= 0:
+            packages -= 1
+            query.delete()
+    if total_flavors != 0 or total_size != 0 or packages != 0:
+        CatalogStatistic.objects.filter(dimension="all").update(
+            flavors=F("flavors") + total_flavors,
+            size=F("size") + total_size,
+            packages=F("packages") + packages,
+        )
+
+
+def rebuild_statistics():
+    """
+    Compute again all the statistics from the entries.
+    :return: The total row.
+    """
+    rows = []
+    for dimension, _ in CatalogStatistic.DimensionType:
+        if dimension == "all":
+            continue
+        for value, flavors, size in (
+            PackageEntry.objects.order_by()
+            .values_list(dimension)
+            .annotate(Count("id"), Sum("size"))
+        ):
+            rows.append(
+                CatalogStatistic(
+                    dimension=dimension, value=value, flavors=flavors, size=size or 0
+                )
+            )
+    total = PackageEntry.objects.aggregate(
+        flavors=Count("id"), size=Sum("size"), packages=Count("name", distinct=True)
+    )
+    rows.append(
+        CatalogStatistic(
+            dimension="all",
+            flavors=total["flavors"],
+            size=total["size"] or 0,
+            packages=total["packages"],
+        )
+    )
+    with transaction.atomic():
+        CatalogStatistic.objects.all().delete()
+        CatalogStatistic.objects.bulk_create(rows)
+    return rows[-1]
+
+
+def get_statistics(details: bool = False):
+    """
+    Get the statistics of the catalog.
+    :param details: If the breakdowns by os, arch, kind and abi are needed.
+    :return: Dictionary with the number of packages, of flavors and the size, and
+        the breakdowns as dictionaries of displayed value: (flavors, size).
+    """
+    total = CatalogStatistic.objects.filter(dimension="all").first()
+    if total is None:
+        total = rebuild_statistics()
+    statistics = {
+        "packages": total.packages,
+        "flavors": total.flavors,
+        "size": total.size,
+    }
+    if details:
+        for dimension in ["os", "arch", "kind", "abi"]:
+            statistics[dimension] = {}
+        for row in CatalogStatistic.objects.filter(
+            dimension__in=["os", "arch", "kind", "abi"], flavors__gt=0
+        ).order_by("dimension", "-flavors"):
+            labels = dict(PackageEntry._meta.get_field(row.dimension).choices)
+            statistics[row.dimension][labels.get(row.value, row.value)] = (
+                row.flavors,
+                row.size,
+            )
+    return statistics
+
+
+def iter_changes(since: int, with_dependencies: bool):
+    """
+    Iterate over the index changes after a given revision, in revision order.
+
+    Added or modified entries give a line starting with '+', removed ones a line
+    starting with '-'. A revision lower or equal to 0 gives the full index.
+    :param since: The last revision known by the client.
+    :param with_dependencies: If the dependencies must be added to the entries.
+    :return: Generator of change lines.
+    """
+    fields = ["name", "version", "build_date", "arch", "kind", "os", "abi", "glibc"]
+    entries = PackageEntry.objects.all()
+    if since > 0:
+        entries = entries.filter(revision__gt=since)
+    entries = entries.order_by("revision").values_list(
+        "revision", *fields, "dependencies"
+    )
+    removed = (
+        PackageTombstone.objects.filter(revision__gt=since)
+        .order_by("revision")
+        .values_list("revision", *fields)
+    )
+    if since <= 0:
+        removed = removed.none()
+    added_lines = (
+        (
+            row[0],
+            (
+                f"+ {format_dep_entry(*row[1:-1])} | deps: {row[-1]}"
+                if with_dependencies
+                else f"+ {format_dep_entry(*row[1:-1])}"
+            ),
+        )
+        for row in entries.iterator(chunk_size=2000)
+    )
+    removed_lines = (
+        (row[0], f"- {format_dep_entry(*row[1:])}")
+        for row in removed.iterator(chunk_size=2000)
+    )
+    for _, line in merge(removed_lines, added_lines, key=itemgetter(0)):
+        yield line
+
+
+os_display = dict(PackageEntry.OsType)
+arch_display = dict(PackageEntry.ArchType)
+kind_display = dict(PackageEntry.KindType)
+abi_display = dict(PackageEntry.AbiType)
+
+
+def format_dep_entry(name, version, build_date, arch, kind, os, abi, glibc):
+    """
+    Format an entry as a line of the API index.
+    :return: The index line.
+    """
+    flavor = f"{arch_display.get(arch, arch)}, {kind_display.get(kind, kind)}, {os_display.get(os, os)}, {abi_display.get(abi, abi)}"
+    if glibc == "":
+        return f"{name}/{version} ({build_date.isoformat()}) [{flavor}]"
+    return f"{name}/{version} ({build_date.isoformat()}) [{flavor}, {glibc}]"
+
+
+def iter_index_lines(with_dependencies: bool, chunk_size: int = 2000):
+    """
+    Iterate over the lines of the API index, without model instantiation.
+    :param with_dependencies: If the dependencies must be added to the entries.
+    :param chunk_size: Number of rows fetched at once from the database.
+    :return: Generator of index lines.
+    """
+    fields = ["name", "version", "build_date", "arch", "kind", "os", "abi", "glibc"]
+    if with_dependencies:
+        fields.append("dependencies")
+    query = PackageEntry.objects.order_by("pk").values_list(*fields)
+    for row in query.iterator(chunk_size=chunk_size):
+        if with_dependencies:
+            yield f"{format_dep_entry(*row[:-1])} | deps: {row[-1]}"
+        else:
+            yield format_dep_entry(*row)
+
+
+class PackageDependency(models.Model):
+    """
+    Dependency of a package flavor, as declared at push time.
+    """
+
+    spec_fields = ["name", "version", "os", "arch", "kind", "abi", "glibc"]
+
+    entry = models.ForeignKey(
+        PackageEntry,
+        on_delete=models.CASCADE,
+        related_name="requirements",
+        verbose_name="Dependent package",
+    )
+    position = models.PositiveIntegerField(default=0, verbose_name="Declaration rank")
+    name = models.CharField(
+        max_length=60, db_index=True, verbose_name="Dependency's Name."
+    )
+    version = models.CharField(
+        max_length=25, default="", blank=True, verbose_name="Dependency's Version."
+    )
+    os = models.CharField(max_length=25, default="", blank=True)
+    arch = models.CharField(max_length=25, default="", blank=True)
+    kind = models.CharField(max_length=25, default="", blank=True)
+    abi = models.CharField(max_length=25, default="", blank=True)
+    glibc = models.CharField(max_length=25, default="", blank=True)
+
+    class Meta:
+        """
+        Metadata for the dependencies
+        """
+
+        verbose_name = "C++ Package dependency"
+        ordering = ["entry", "position"]
+
+    def to_dict(self):
+        """
+        Dependency as a dictionary, like in the pushed dependencies.
+        :return:
+        """
+        return {key: getattr(self, key) for key in self.spec_fields}
+
+
+class ArchiveFingerprint(models.Model):
+    """
+    Identity of a package archive at its last successful check by the repair.
+    """
+
+    path = models.CharField(max_length=1024, unique=True, verbose_name="File path")
+    size = models.BigIntegerField(verbose_name="File size")
+    mtime = models.BigIntegerField(verbose_name="Modification time (ns)")
+    inode = models.BigIntegerField(verbose_name="File inode")
+    date = models.DateTimeField(default=timezone.now, verbose_name="Date of check")
+
+    @staticmethod
+    def get_stat(file: Path):
+        """
+        Get the fingerprint values of a file.
+        :param file: The file.
+        :return: Tuple of the size, modification time and inode.
+        """
+        stat = file.stat()
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def matches(self, stat: tuple):
+        """
+        Check if the file is unchanged since the fingerprint.
+        :param stat: The values given by get_stat.
+        :return:
+        """
+        return (self.size, self.mtime, self.inode) == stat
+
+
+class PackageInspection(models.Model):
+    """
+    Content of the archive of an entry, read by the job worker after the push.
+    """
+
+    entry = models.OneToOneField(
+        PackageEntry, on_delete=models.CASCADE, related_name="inspection"
+    )
+    date = models.DateTimeField(
+        null=True, blank=True, verbose_name="Date of inspection (none if pending)"
+    )
+    metadata = models.JSONField(
+        default=dict, blank=True, verbose_name="Metadata read in archive"
+    )
+    files = models.TextField(
+        default="", blank=True, verbose_name="Archive content (one path per line)"
+    )
+    mismatches = models.JSONField(
+        default=list, blank=True, verbose_name="Fields differing from the entry"
+    )
+    error = models.CharField(max_length=255, default="", blank=True)
+
+    @classmethod
+    def queue(cls, entry: PackageEntry):
+        """
+        Request the inspection of the archive of an entry.
+        :param entry: The entry.
+        :return: The inspection.
+        """
+        inspection, _ = cls.objects.update_or_create(
+            entry=entry, defaults={"date": None}
+        )
+        return inspection
+
+    def get_file_list(self):
+        """
+        Get the paths of the archive content.
+        :return:
+        """
+        return self.files.splitlines()
+
+
+class Job(models.Model):
+    """
+    Background maintenance job, run by the job worker (manage.py run_jobs).
+    """
+
+    KindType = (("repair", "Database repair"), ("import", "Repository import"))
+    StatusType = (
+        ("q", "queued"),
+        ("r", "running"),
+        ("d", "done"),
+        ("f", "failed"),
+        ("c", "cancelled"),
+    )
+
+    kind = models.CharField(max_length=10, choices=KindType, verbose_name="Job kind")
+    params = models.JSONField(default=dict, blank=True, verbose_name="Job parameters")
+    exclusive = models.BooleanField(
+        default=True, verbose_name="Job requiring the maintenance lock"
+    )
+    status = models.CharField(
+        max_length=1, choices=StatusType, default="q", db_index=True
+    )
+    cancel_requested = models.BooleanField(default=False)
+    progress = models.PositiveIntegerField(default=0, verbose_name="Done steps")
+    total = models.PositiveIntegerField(default=0, verbose_name="Total steps")
+    message = models.CharField(max_length=255, default="", blank=True)
+    pid = models.IntegerField(null=True, blank=True, verbose_name="Worker process")
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        """
+        Metadata for the jobs
+        """
+
+        verbose_name = "Maintenance job"
+        ordering = ["-created"]
+
+    def is_active(self):
+        """
+        Check if the job is waiting or running.
+        :return:
+        """
+        return self.status in ["q", "r"]
+
+    def get_log_path(self):
+        """
+        Path of the output of the job, appended while it runs instead of being
+        rewritten in database.
+        :return: The file path.
+        """
+        return Path(settings.JOB_LOG_DIR) / f"{self.pk}.log"
+
+    def get_log(self):
+        """
+        Output of the job.
+        :return: The text, empty if the job did not start.
+        """
+        path = self.get_log_path()
+        if not path.exists():
+            return ""
+        return path.read_text(encoding="utf-8", errors="replace")
+
+    def get_eta(self):
+        """
+        Estimate the remaining time of a running job, from its progress rate.
+        :return: The remaining time, None if unknown.
+        """
+        if self.status != "r" or self.started is None or self.progress == 0:
+            return None
+        if self.total <= self.progress:
+            return None
+        elapsed = timezone.now() - self.started
+        return elapsed * (self.total - self.progress) / self.progress
+
+    def to_dict(self):
+        """
+        Status of the job, as given by the API.
+        :return:
+        """
+        eta = self.get_eta()
+        return {
+            "id": self.pk,
+            "kind": self.kind,
+            "kind_display": self.get_kind_display(),
+            "status": self.get_status_display(),
+            "active": self.is_active(),
+            "cancel_requested": self.cancel_requested,
+            "progress": self.progress,
+            "total": self.total,
+            "percent": (
+                round(100 * self.progress / self.total, 1) if self.total > 0 else None
+            ),
+            "message": self.message,
+            "eta": None if eta is None else round(eta.total_seconds()),
+            "created": self.created.isoformat(),
+            "started": None if self.started is None else self.started.isoformat(),
+            "finished": None if self.finished is None else self.finished.isoformat(),
+        }
+
+
+def _parse_node(node):
+    """
+    Evaluate a node of the dependencies expression, allowing only literals and
+    date constructors.
+    :param node: The AST node.
+    :return: The value.
+    """
+    if isinstance(node, ast.List):
+        return [_parse_node(item) for item in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(_parse_node(item) for item in node.elts)
+    if isinstance(node, ast.Dict):
+        return {
+            _parse_node(key): _parse_node(value)
+            for key, value in zip(node.keys, node.values)
+        }
+    if isinstance(node, ast.Attribute) and ast.unparse(node) in [
+        "datetime.timezone.utc",
+        "timezone.utc",
+    ]:
+        return dt_timezone.utc
+    if isinstance(node, ast.Call):
+        constructors = {
+            "datetime": datetime,
+            "datetime.datetime": datetime,
+            "timedelta": timedelta,
+            "datetime.timedelta": timedelta,
+            "timezone": dt_timezone,
+            "datetime.timezone": dt_timezone,
+        }
+        func = ast.unparse(node.func)
+        if func not in constructors:
+            raise ValueError(f"Forbidden call in dependencies: {func}")
+        return constructors[func](
+            *[_parse_node(arg) for arg in node.args],
+            **{kw.arg: _parse_node(kw.value) for kw in node.keywords},
+        )
+    return ast.literal_eval(node)
+
+
+def parse_dependencies(text: str):
+    """
+    Safely parse the dependencies text sent by the client.
+    :param text: The dependencies as pushed (python-like list of dict).
+    :return: The list of dependencies, empty if not parsable.
+    """
+    if text in ["", None] or text.strip() == "":
+        return []
+    try:
+        parsed = _parse_node(ast.parse(text.strip(), mode="eval").body)
+    except Exception as err:
+        logger.warning(f"Cannot parse dependencies '{text}': {err}")
+        return []
+    if not isinstance(parsed, list):
+        logger.warning(f"Dependencies is not a list: {type(parsed)}")
+        return []
+    return parsed
+
+
+def get_dependents(name: str):
+    """
+    Get the packages having at least one flavor depending on the given package.
+    :param name: The package name.
+    :return: Sorted list of package names.
+    """
+    return list(
+        PackageEntry.objects.filter(requirements__name=name)
+        .order_by("name")
+        .values_list("name", flat=True)
+        .distinct()
+    )
+
+
+def compute_sha256(chunks):
+    """
+    Compute the SHA-256 checksum of a file content.
+    :param chunks: Iterable over the bytes of the file.
+    :return: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
 def convert_filter(get_filter: dict):
     """
     Convert the filter to a proper format.
@@ -188,12 +1038,106 @@ def convert_filter(get_filter: dict):
     return true_filter
 
 
-def safe_create(data: dict, file: Path):
+def _glob_to_query(field: str, pattern: str):
     """
+    Convert a glob pattern on a field into a query, with the same semantics as
+    ``fnmatch.translate`` (full and case-sensitive match).
 
-    :param data:
-    :param file:
-    :return:
+    Prefix patterns are expressed as a range on the column, as ``__startswith``
+    is case-insensitive on SQLite and could not use an index.
+    :param field: The model field name.
+    :param pattern: The glob pattern.
+    :return: The Q object, or None if the pattern matches everything.
+    """
+    if pattern == "*":
+        return None
+    prefix = pattern.rstrip("*")
+    if not any(char in prefix for char in "*?["):
+        if prefix == pattern:
+            return Q(**{field: pattern})
+        if prefix == "":
+            return None
+        if ord(prefix[-1]) < 0x10FFFF:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            return Q(**{f"{field}__gte": prefix, f"{field}__lt": upper})
+    return Q(**{f"{field}__regex": f"^{translate(pattern)}"})
+
+
+def filter_to_query(true_filter: dict):
+    """
+    Convert a filter (as given by convert_filter) into a database query.
+
+    This is the database counterpart of PackageEntry.match().
+    :param true_filter: The converted filter.
+    :return: The Q object to use in a queryset filter.
+    """
+    query = Q()
+    for attr in ["name", "version", "os", "arch", "kind", "abi", "glibc"]:
+        pattern = true_filter[attr]
+        if attr in ["os", "arch", "kind", "abi"]:
+            if pattern in ["any", "*"]:
+                continue
+            if len(pattern) == 1:
+                query &= Q(**{attr: pattern})
+                continue
+        sub_query = _glob_to_query(attr, pattern)
+        if sub_query is not None:
+            query &= sub_query
+    return query
+
+
+def filter_to_matcher(true_filter: dict):
+    """
+    Compile a filter (as given by convert_filter) into a predicate on entries.
+
+    Same semantics as PackageEntry.match(), but the patterns are compiled once.
+    :param true_filter: The converted filter.
+    :return: Function telling if an entry matches the filter.
+    """
+    checks = []
+    for attr in ["name", "version", "os", "arch", "kind", "abi", "glibc"]:
+        pattern = true_filter[attr]
+        flavor = attr in ["os", "arch", "kind", "abi"]
+        if flavor and (pattern in ["any", "*"]):
+            continue
+        if flavor and len(pattern) == 1:
+            checks.append((attr, flavor, None, pattern))
+        elif pattern != "*":
+            checks.append((attr, flavor, re_compile(translate(pattern)), None))
+
+    def matcher(entry):
+        for attr, flavor, regex, value in checks:
+            object_attr = getattr(entry, attr)
+            if flavor and object_attr == "any":
+                continue
+            if regex is None and object_attr != value:
+                return False
+            if regex is not None and not regex.match(object_attr):
+                return False
+        return True
+
+    return matcher
+
+
+def delete_unreferenced_file(storage, name: str):
+    """
+    Delete a package file if no entry references it.
+    :param storage: The storage of the file.
+    :param name: The file name in the storage.
+    """
+    with transaction.atomic():
+        # the database is locked: no entry can reference the file meanwhile
+        if not PackageEntry.objects.filter(package=name).exists():
+            storage.delete(name)
+
+
+def safe_create(data: dict, file: Path):
+    """
+    Create the entry of an archive found in the store, from its metadata. The
+    archive is moved into the content-addressed store.
+    :param data: The metadata read in the archive.
+    :param file: The archive.
+    :return: The saved entry, None if the metadata are not valid.
     """
     is_ok = True
     for key in [
@@ -275,7 +1219,7 @@ def safe_create(data: dict, file: Path):
         is_ok = False
     #
     if is_ok:
-        return PackageEntry.objects.create(
+        entry = PackageEntry(
             name=data["name"],
             version=data["version"],
             os=loc_os,
@@ -284,22 +1228,33 @@ def safe_create(data: dict, file: Path):
             abi=loc_abi,
             glibc=data["glibc"],
             build_date=data["build_date"],
-            package=str(file),
         )
+        entry.store_file(file)
+        entry.save()
+        return entry
     return None
 
 
-def get_entry_count():
+def fill_package_names():
     """
+    Fill the package file base name of entries created before its introduction.
+    :return: The number of updated entries.
+    """
+    count = 0
+    for q in PackageEntry.objects.filter(package_name="").exclude(package=""):
+        PackageEntry.objects.filter(pk=q.pk).update(
+            package_name=Path(q.package.name).name
+        )
+        count += 1
+    return count
 
+
+def get_entry_count():
+    """
+    Number of distinct packages, from the maintained statistics.
     :return:
     """
-    query = PackageEntry.objects.all()
-    name_list = []
-    for q in query:
-        name_list.append(q.name)
-    name_list = list(set(name_list))
-    return len(name_list)
+    return get_statistics()["packages"]
 
 
 def get_namelist(get_filter: dict):
@@ -309,15 +1264,8 @@ def get_namelist(get_filter: dict):
     :return:
     """
     true_filter = convert_filter(get_filter)
-    query = PackageEntry.objects.all()
-    name_list = []
-    for q in query:
-        if not q.match(true_filter):
-            continue
-        name_list.append(q.name)
-    name_list = list(set(name_list))
-    name_list.sort()
-    return name_list
+    query = PackageEntry.objects.filter(filter_to_query(true_filter))
+    return list(query.order_by("name").values_list("name", flat=True).distinct())
 
 
 def sort_a(infos):
@@ -373,14 +1321,17 @@ def get_package_detail(name: str, get_filter: dict = {}):
         "description": "",
     }
     true_filter = convert_filter(get_filter)
-    query = PackageEntry.objects.filter(name=name)
+    query = (
+        PackageEntry.objects.filter(name=name)
+        .filter(filter_to_query(true_filter))
+        .select_related("inspection")
+        .prefetch_related("requirements")
+    )
 
     # Collect all entries sorted by date for description search
     all_entries = []
 
     for q in query:
-        if not q.match(true_filter):
-            continue
         q.check_file()
         if q.build_date is None:
             q.build_date = old_date
@@ -398,29 +1349,12 @@ def get_package_detail(name: str, get_filter: dict = {}):
             "package": q.package,
             "package_size": q.get_pretty_size_display(),
             "pk": q.pk,
-            "dependencies": [],
+            "dependencies": [dep.to_dict() for dep in q.requirements.all()],
+            "mismatches": [],
         }
-
-        # Parse dependencies for this specific flavor
-        if q.dependencies and q.dependencies.strip():
-            try:
-                import datetime
-
-                # Log for debugging
-                logger.debug(
-                    f"Parsing dependencies for {q.name}/{q.version}: {q.dependencies}"
-                )
-                parsed_deps = eval(q.dependencies)
-                if isinstance(parsed_deps, list):
-                    combination["dependencies"] = parsed_deps
-                    logger.debug(f"Successfully parsed {len(parsed_deps)} dependencies")
-                else:
-                    logger.warning(f"Dependencies is not a list: {type(parsed_deps)}")
-            except Exception as e:
-                logger.warning(
-                    f"Cannot parse dependencies of ({q.name}/{q.version}) '{q.dependencies}' : {e}"
-                )
-                combination["dependencies"] = []
+        inspection = getattr(q, "inspection", None)
+        if inspection is not None and inspection.date is not None:
+            combination["mismatches"] = inspection.mismatches
 
         if q.version not in it["versions"].keys():
             it["versions"][q.version] = {"flavors": []}
@@ -432,26 +1366,56 @@ def get_package_detail(name: str, get_filter: dict = {}):
         if entry.description:
             it["description"] = entry.description
             break
+    it["used_by"] = get_dependents(name)
 
     return sort_a(it)
 
 
 def get_package_list(get_filter):
     """
+    Get the summary of all the packages matching the filter.
 
-    :param get_filter:
-    :return:
+    The list is built from one ordered query, grouped by name in a single pass,
+    without model instantiation nor file system access.
+    :param get_filter: Filter criteria
+    :return: List of package summaries, sorted by name.
     """
-    names = get_namelist(get_filter)
+    true_filter = convert_filter(get_filter)
+    query = (
+        PackageEntry.objects.filter(filter_to_query(true_filter))
+        .order_by("name")
+        .values_list(
+            "name", "version", "os", "arch", "kind", "abi", "glibc", "build_date", "pk"
+        )
+    )
     result = []
-    for name in names:
-        result.append(get_package_detail(name, get_filter))
+    for name, rows in groupby(query.iterator(chunk_size=2000), key=itemgetter(0)):
+        it = {
+            "name": name,
+            "versions": {},
+            "description": "",
+        }
+        for _, version, os, arch, kind, abi, glibc, build_date, pk in rows:
+            if version not in it["versions"].keys():
+                it["versions"][version] = {"flavors": []}
+            it["versions"][version]["flavors"].append(
+                {
+                    "os": os_display.get(os, os),
+                    "arch": arch_display.get(arch, arch),
+                    "kind": kind_display.get(kind, kind),
+                    "abi": abi_display.get(abi, abi),
+                    "glibc": glibc,
+                    "build_date": build_date,
+                    "pk": pk,
+                }
+            )
+        result.append(sort_a(it))
     return result
 
 
-def get_packages_urls(get_filter: dict):
+def convert_raw_filter(get_filter: dict):
     """
-
+    Convert the filter, keeping the raw values of the given keys (used by the API).
     :param get_filter:
     :return:
     """
@@ -460,32 +1424,59 @@ def get_packages_urls(get_filter: dict):
         if key in get_filter:
             if get_filter[key] not in [None, "", "any"]:
                 true_filter[key] = get_filter[key]
-    query = PackageEntry.objects.all()
+    return true_filter
+
+
+def get_packages_urls(get_filter: dict):
+    """
+
+    :param get_filter:
+    :return:
+    """
+    true_filter = convert_raw_filter(get_filter)
+    query = PackageEntry.objects.filter(filter_to_query(true_filter))
     url_list = []
     for q in query:
-        if not q.match(true_filter):
-            continue
         q.check_file()
         url_list.append(q.package)
     return url_list
 
 
+def get_packages_urls_many(get_filters: list):
+    """
+    Get the package files matching each of the filters, in one database query.
+
+    :param get_filters: List of filters.
+    :return: List of the package files, for each filter.
+    """
+    true_filters = [convert_raw_filter(get_filter) for get_filter in get_filters]
+    sub_queries = [filter_to_query(true_filter) for true_filter in true_filters]
+    query = PackageEntry.objects.all()
+    if len(sub_queries) == 0:
+        return []
+    if all(sub_queries):
+        # an empty sub-query matches everything, and would be lost in the union
+        query = query.filter(reduce(or_, sub_queries))
+    matchers = [filter_to_matcher(true_filter) for true_filter in true_filters]
+    url_lists = [[] for _ in true_filters]
+    for q in query.order_by("pk"):
+        q.check_file()
+        for matcher, url_list in zip(matchers, url_lists):
+            if matcher(q):
+                url_list.append(q.package)
+    return url_lists
+
+
 def delete_packages(delete_filter: dict):
     """
 
     :param delete_filter:
     :return:
     """
-    true_filter = convert_filter(delete_filter)
-    for key in true_filter.keys():
-        if key in delete_filter:
-            if delete_filter[key] not in [None, "", "any"]:
-                true_filter[key] = delete_filter[key]
-    query = PackageEntry.objects.all()
+    true_filter = convert_raw_filter(delete_filter)
+    query = PackageEntry.objects.filter(filter_to_query(true_filter))
     count = 0
     for q in query:
-        if not q.match(true_filter):
-            continue
         q.check_file()
         count += 1
         q.delete()
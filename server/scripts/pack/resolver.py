@@ -0,0 +1,237 @@
+"""
+Server-side resolution of the dependency closure of a package.
+
+The closure is resolved level by level: the candidates of all the package names
+of a level are loaded in one query, and each node (dependency specification in
+the context of its parent flavor) is resolved only once. Resolved closures are
+cached, and invalidated when one of the package names they involve is modified.
+"""
+
+from hashlib import sha256
+from json import dumps
+
+from django.core.cache import cache
+
+from .catalog import get_generation, get_name_generations
+from .models import PackageEntry, convert_raw_filter, filter_to_matcher, old_date
+
+CLOSURE_KEY = "pack:closure:v2:{}"
+
+# code of the flavors compatible with every value
+any_codes = {"os": "a", "arch": "y", "kind": "a", "abi": "a"}
+kind_codes = {"shared": "r", "static": "t", "header": "h"}
+
+
+def _version_key(version: str):
+    """
+    Sort key of a version, numerical parts being compared as numbers.
+    :param version: The version.
+    :return: The sort key.
+    """
+    return [
+        (0, int(part), "") if part.isdigit() else (1, 0, part)
+        for part in version.split(".")
+    ]
+
+
+def _flavor_code(key: str, value: str):
+    """
+    Get the code of a flavor value, as given in a dependency.
+    :param key: The flavor field.
+    :param value: The value, either a code or a display name.
+    :return: The code, "*" for any value, None if not given.
+    """
+    if value in [None, ""]:
+        return None
+    if value in ["any", "*"]:
+        return "*"
+    if key == "glibc":
+        return value
+    if key == "kind":
+        return kind_codes.get(value, value)
+    return value[0].lower()
+
+
+class _Node:
+    """
+    Dependency specification to resolve, in the flavor context of its parent.
+    """
+
+    def __init__(self, node_filter: dict):
+        self.filter = node_filter
+        self.key = tuple(sorted(node_filter.items()))
+        self.matcher = filter_to_matcher(
+            {key: "*" for key in node_filter}
+            | {"name": node_filter["name"], "version": node_filter["version"]}
+        )
+
+    def accepts(self, entry: PackageEntry):
+        """
+        Check if an entry satisfies the specification.
+        :param entry: The entry.
+        :return: True if the entry can be used.
+        """
+        if not self.matcher(entry):
+            return False
+        for key, code in any_codes.items():
+            if self.filter[key] != "*" and getattr(entry, key) not in [
+                self.filter[key],
+                code,
+            ]:
+                return False
+        glibc = self.filter["glibc"]
+        if glibc not in ["*", ""] and entry.glibc != "":
+            # built against an older glibc is fine
+            return _version_key(entry.glibc) <= _version_key(glibc)
+        return True
+
+    def child(self, entry: PackageEntry, dependency: dict):
+        """
+        Get the node of a dependency of the resolved entry.
+        :param entry: The resolved entry of this node.
+        :param dependency: The dependency, as pushed.
+        :return: The dependency node.
+        """
+        child_filter = {"name": dependency["name"], "version": "*", "kind": "*"}
+        for key in ["os", "arch", "abi"]:
+            inherited = self.filter[key]
+            if inherited == "*" and getattr(entry, key) != any_codes[key]:
+                inherited = getattr(entry, key)
+            child_filter[key] = inherited
+        child_filter["glibc"] = self.filter["glibc"]
+        if child_filter["glibc"] in ["*", ""] and entry.glibc != "":
+            child_filter["glibc"] = entry.glibc
+        if dependency.get("version") not in [None, ""]:
+            child_filter["version"] = dependency["version"]
+        for key in ["os", "arch", "kind", "abi", "glibc"]:
+            code = _flavor_code(key, dependency.get(key))
+            if code is not None:
+                child_filter[key] = code
+        return _Node(child_filter)
+
+
+def _best_candidate(node: _Node, candidates: list):
+    """
+    Select the most recent entry satisfying a node.
+    :param node: The node to resolve.
+    :param candidates: Entries with the name of the node.
+    :return: The selected entry, None if no entry satisfies the node.
+    """
+    accepted = [entry for entry in candidates if node.accepts(entry)]
+    if len(accepted) == 0:
+        return None
+    return max(
+        accepted,
+        key=lambda entry: (
+            _version_key(entry.version),
+            entry.build_date or old_date,
+            entry.pk,
+        ),
+    )
+
+
+def _entry_to_dict(entry: PackageEntry):
+    """
+    Description of a resolved flavor.
+    :param entry: The entry.
+    :return: Dictionary of the flavor.
+    """
+    return {
+        "name": entry.name,
+        "version": entry.version,
+        "os": entry.os,
+        "arch": entry.arch,
+        "kind": entry.kind,
+        "abi": entry.abi,
+        "glibc": entry.glibc,
+        "build_date": (entry.build_date or old_date).isoformat(),
+        "package": str(entry.package),
+        "pk": entry.pk,
+    }
+
+
+def resolve_closure(get_filter: dict):
+    """
+    Compute the transitive dependency closure of a package.
+    :param get_filter: Filter of the root package, as for a pull.
+    :return: Dictionary with the flavors ordered dependencies first ("closure"),
+        the unresolved dependencies ("missing") and the package names involved
+        ("names"); None if the root package is not found.
+    """
+    root = _Node(convert_raw_filter(dict(get_filter)))
+    candidates = {}
+    resolved = {}
+    children = {}
+    missing = []
+    level = [root]
+    while len(level) > 0:
+        names = {node.filter["name"] for node in level} - candidates.keys()
+        for name in names:
+            candidates[name] = []
+        # all the candidates of a level in one query
+        query = PackageEntry.objects.filter(name__in=names).prefetch_related(
+            "requirements"
+        )
+        for entry in query:
+            candidates[entry.name].append(entry)
+        next_level = []
+        for node in level:
+            if node.key in resolved:
+                continue
+            entry = _best_candidate(node, candidates[node.filter["name"]])
+            resolved[node.key] = entry
+            if entry is None:
+                continue
+            children[node.key] = []
+            for dependency in entry.requirements.all():
+                child = node.child(entry, dependency.to_dict())
+                children[node.key].append(child)
+                if child.key not in resolved:
+                    next_level.append(child)
+        level = next_level
+    if resolved[root.key] is None:
+        return None
+    # dependencies first, each flavor once
+    closure = []
+    seen = set()
+    visited = set()
+
+    def visit(node: _Node, parent: PackageEntry = None):
+        if node.key in visited:
+            return
+        visited.add(node.key)
+        entry = resolved[node.key]
+        if entry is None:
+            missing.append(node.filter | {"required_by": parent.name})
+            return
+        for child in children[node.key]:
+            visit(child, entry)
+        if entry.pk not in seen:
+            seen.add(entry.pk)
+            closure.append(_entry_to_dict(entry))
+
+    visit(root)
+    return {"closure": closure, "missing": missing, "names": sorted(candidates)}
+
+
+def get_closure(get_filter: dict):
+    """
+    Get the dependency closure of a package, from the cache if still valid.
+    :param get_filter: Filter of the root package, as for a pull.
+    :return: The closure, as given by resolve_closure.
+    """
+    digest = sha256(dumps(get_filter, sort_keys=True).encode()).hexdigest()
+    key = CLOSURE_KEY.format(digest)
+    cached = cache.get(key)
+    if cached is not None:
+        generations, result = cached
+        if get_name_generations(generations.keys()) == generations:
+            return result
+    catalog = get_generation()
+    result = resolve_closure(get_filter)
+    names = [get_filter.get("name", "")] if result is None else result["names"]
+    generations = get_name_generations(names)
+    if get_generation() == catalog:
+        # not cached if the catalog changed during the resolution
+        cache.set(key, (generations, result))
+    return result
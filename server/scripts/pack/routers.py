@@ -0,0 +1,38 @@
+"""
+Database routing of the read-only views.
+"""
+
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+# if the reads of the current view can go to the read-only connection
+reading_only = ContextVar("reading_only", default=False)
+
+
+class ReadOnlyRouter:
+    """
+    Send the reads to the 'readonly' database (query_only connection) inside the
+    views marked with read_only_database; everything else uses 'default'.
+    """
+
+    def db_for_read(self, model, **hints):
+        if (
+            reading_only.get()
+            and "readonly" in settings.DATABASES
+            # inside a transaction, the reads must see its modifications
+            and not connections["default"].in_atomic_block
+        ):
+            return "readonly"
+        return None
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases are the same database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
@@ -1,98 +1,299 @@
 """
 Simple long task manager.
+
+The long tasks are queued as Job entries in database, and run one at a time by
+the job worker (manage.py run_jobs), outside the web server processes. The
+worker also inspects the archives of the pushed packages.
 """
 
-from .db_repair import long_repair
+import logging
+import os
+from contextlib import redirect_stdout
+from fcntl import LOCK_EX, LOCK_NB, flock
+from time import monotonic
+
+from django.utils import timezone
+
+from scripts.settings import DATABASES_LOCK_PATH
 from .db_import import long_import
+from .db_locking import locker
+from .db_repair import inspect_package, long_repair
+from .logger import logger
+from .models import Job, PackageInspection
+
+# held by the job worker during its whole life
+WORKER_LOCK_PATH = DATABASES_LOCK_PATH.with_suffix(".worker")
+_worker_lock = None
+
+
+class JobCancelled(BaseException):
+    """
+    Raised in a running job when its cancellation is requested.
+
+    Not an Exception, so that it is not caught by the error handling of the tasks.
+    """
 
 
-def database_repair():
+class JobReporter(logging.Handler):
     """
+    Progress and output recorder of a running job.
 
-    :return:
+    It is called by the task with its progress, and records the pack logs and
+    the standard output, appended to the log file of the job. The job is saved
+    at most every ``save_interval`` seconds, when the cancellation request is
+    also checked.
     """
-    from .logger import logger
 
-    def async_repair():
+    save_interval = 1.0
+
+    def __init__(self, job: Job):
+        super().__init__(level=logging.INFO)
+        self.setFormatter(
+            logging.Formatter(
+                "{asctime} [{levelname}] {message}", "%Y/%m/%d %H:%M:%S", style="{"
+            )
+        )
+        self.job = job
+        self.lines = []
+        self.last_save = 0.0
+
+    def emit(self, record):
+        self.lines.append(self.format(record) + "\n")
+
+    def write(self, text: str):
+        """
+        Record the standard output.
+        :param text: The printed text.
         """
+        self.lines.append(text)
 
-        :return:
+    def flush(self):
+        pass
+
+    def write_log(self):
+        """
+        Append the recorded output to the log file of the job.
         """
-        from .db_locking import locker
+        if len(self.lines) > 0:
+            path = self.job.get_log_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as fp:
+                fp.write("".join(self.lines))
+            self.lines = []
 
-        if not locker.get_lock():
-            logger.warning("Cannot launch async database repair: cannot get the lock.")
-            return
-        try:
-            logger.info("Database lock acquired for database repair.")
-            long_repair(do_correct=True, skip_large_files=False)
-        except Exception as err_ar:
-            logger.error(f"Exception during database repair: {err_ar}")
-        finally:
-            locker.release_lock()
-            logger.info("Database lock released.")
+    def save(self):
+        """
+        Save the job progress and output, and check for a cancellation.
+        """
+        self.write_log()
+        self.job.save(update_fields=["progress", "total", "message"])
+        self.last_save = monotonic()
+        if Job.objects.filter(pk=self.job.pk, cancel_requested=True).exists():
+            raise JobCancelled()
 
-    logger.info(f"database_repair: Starting.")
-    use_thread = False
-    if use_thread:
-        from threading import Thread
+    def __call__(self, done: int, total: int, message: str = ""):
+        """
+        Report the progress of the task.
+        :param done: Number of done steps.
+        :param total: Total number of steps.
+        :param message: Current step.
+        """
+        self.job.progress = done
+        self.job.total = total
+        self.job.message = message[:255]
+        if monotonic() - self.last_save >= self.save_interval:
+            self.save()
 
-        try:
-            long_running_thread = Thread(target=async_repair)
-            long_running_thread.start()
-        except Exception as err:
-            logger.error(f"Exception while database repair invocation: {err}.")
-    else:
-        from multiprocessing import Process
 
-        long_running_process = Process(target=async_repair)
-        long_running_process.start()
-    logger.info(f"Continue view execution")
+def database_repair(full: bool = False):
+    """
+    Queue a repair of the database.
+    :param full: If all the archives must be read, even the unchanged ones.
+    :return: The job.
+    """
+    job = Job.objects.filter(kind="repair", status="q").first()
+    if job is None or job.params.get("full", False) != full:
+        job = Job.objects.create(kind="repair", params={"full": full})
+    logger.info(f"database_repair: queued as job {job.pk}.")
+    return job
 
 
 def database_import(url: str, user: str, password: str):
     """
-    Meta function to import data from another server.
-    :return:
+    Queue an import of data from another server.
+
+    The password is needed by the worker process, so it is kept in the job
+    only until the job ends, whatever the way (see forget_credentials).
+    :return: The job.
     """
-    from .logger import logger
+    job = Job.objects.create(
+        kind="import", params={"url": url, "user": user, "password": password}
+    )
+    logger.info(f"import from {url}: queued as job {job.pk}.")
+    return job
 
-    def async_repair():
-        """
 
-        :return:
-        """
-        from .db_locking import locker
+def forget_credentials(job: Job):
+    """
+    Remove the credentials of a job which will not run (anymore).
+    :param job: The job.
+    """
+    job.refresh_from_db(fields=["params"])
+    if "password" in job.params:
+        job.params.pop("password")
+        job.save(update_fields=["params"])
+
+
+def cancel_job(job: Job):
+    """
+    Request the cancellation of a job.
+    :param job: The job.
+    """
+    if job.status == "q":
+        if Job.objects.filter(pk=job.pk, status="q").update(
+            status="c", finished=timezone.now()
+        ):
+            forget_credentials(job)
+    Job.objects.filter(pk=job.pk).update(cancel_requested=True)
+    job.refresh_from_db()
 
-        if not locker.get_lock():
-            logger.warning(
-                f"Cannot launch async database import from {url}: cannot get the lock."
+
+def run_job(job: Job):
+    """
+    Run a job in the current process.
+    :param job: The job, must be queued.
+    :return: False if the job cannot start now (maintenance lock not available).
+    """
+    # a repair deletes the entries of missing files: no reading meanwhile
+    if job.exclusive and not locker.get_lock(exclusive=job.kind == "repair"):
+        return False
+    reporter = JobReporter(job)
+    pack_logger = logging.getLogger("pack")
+    pack_logger.addHandler(reporter)
+    try:
+        # the job may have been cancelled in the meantime
+        if Job.objects.filter(pk=job.pk, status="q").update(
+            status="r", started=timezone.now(), pid=os.getpid()
+        ):
+            job.refresh_from_db()
+            # output of a former database with the same job ids
+            job.get_log_path().unlink(missing_ok=True)
+            logger.info(f"Job {job.pk} ({job.get_kind_display()}) started.")
+            with redirect_stdout(reporter):
+                if job.kind == "repair":
+                    long_repair(
+                        do_correct=True,
+                        skip_large_files=False,
+                        progress=reporter,
+                        full=job.params.get("full", False),
+                    )
+                elif job.kind == "import":
+                    long_import(
+                        url=job.params["url"],
+                        user=job.params["user"],
+                        password=job.params["password"],
+                        progress=reporter,
+                    )
+                else:
+                    raise ValueError(f"Unknown job kind {job.kind}")
+            job.status = "d"
+            logger.info(f"Job {job.pk} done.")
+    except JobCancelled:
+        job.status = "c"
+        logger.warning(f"Job {job.pk} cancelled.")
+    except Exception as err:
+        job.status = "f"
+        job.message = f"{err}"[:255]
+        logger.error(f"Exception during job {job.pk}: {err}")
+    finally:
+        pack_logger.removeHandler(reporter)
+        if job.status in ["d", "f", "c"]:
+            job.finished = timezone.now()
+            # credentials are not kept once used
+            job.params.pop("password", None)
+            reporter.write_log()
+            job.save(
+                update_fields=[
+                    "status",
+                    "progress",
+                    "total",
+                    "message",
+                    "params",
+                    "finished",
+                ]
             )
-            return
-        try:
-            logger.info(f"Database lock acquired for import from {url}.")
-            long_import(url=url, user=user, password=password)
-        except Exception as err_ar:
-            logger.error(f"Exception during database import from {url}: {err_ar}")
-        finally:
+        if job.exclusive:
             locker.release_lock()
-            logger.info("Database lock released.")
+    return True
 
-    logger.info(f"import from {url}: Starting.")
-    use_thread = False
-    if use_thread:
-        from threading import Thread
 
+def acquire_worker_lock(path=WORKER_LOCK_PATH):
+    """
+    Take the lock of the job worker, released by the system when the worker
+    process ends, whatever the way.
+    :param path: The lock file.
+    :return: False if another worker holds it.
+    """
+    global _worker_lock
+    if _worker_lock is not None:
+        return True
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        flock(fd, LOCK_EX | LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _worker_lock = fd
+    return True
+
+
+def recover_jobs():
+    """
+    Mark as failed the running jobs of the former workers.
+
+    Must be called by the worker holding the worker lock, before it runs any
+    job: no other worker is alive, so every running job was interrupted (a
+    process id is not enough, it can be reused after a restart).
+    :return: The number of recovered jobs.
+    """
+    count = 0
+    for job in Job.objects.filter(status="r"):
+        job.status = "f"
+        job.message = "Interrupted: the worker process is gone."
+        job.finished = timezone.now()
+        job.params.pop("password", None)
+        job.save()
+        count += 1
+    return count
+
+
+def run_pending_jobs():
+    """
+    Run the queued jobs, oldest first.
+    :return: The number of run jobs.
+    """
+    count = 0
+    for job in Job.objects.filter(status="q").order_by("created"):
+        if not run_job(job):
+            break
+        count += 1
+    return count
+
+
+def inspect_pending_packages():
+    """
+    Inspect the archives of the pushed packages, oldest first.
+    :return: The number of inspected archives.
+    """
+    count = 0
+    query = PackageInspection.objects.filter(date=None).select_related("entry")
+    for inspection in query.order_by("pk"):
         try:
-            long_running_thread = Thread(target=async_repair)
-            long_running_thread.start()
+            inspect_package(inspection)
         except Exception as err:
             logger.error(
-                f"Exception while database import from {url} invocation: {err}."
+                f"Exception during inspection of entry {inspection.entry_id}: {err}"
             )
-    else:
-        from multiprocessing import Process
-
-        long_running_process = Process(target=async_repair)
-        long_running_process.start()
-    logger.info(f"Continue view execution")
+            continue
+        count += 1
+    return count
@@ -1,3 +1,1491 @@
 """
 Testing of django stuff.
 """
+
+import gzip
+import hashlib
+import os
+import tarfile
+from fcntl import LOCK_EX, LOCK_SH, LOCK_UN, flock
+from base64 import b64encode
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from json import dumps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep
+from unittest.mock import patch
+from urllib.parse import parse_qs
+
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.contrib.sessions.models import Session
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+
+from connector.decorators import get_capability, has_capability, toggle_capability
+from connector.models import ApiToken
+from connector.tokens import get_token_generation
+from scripts.settings import SQLITE_PRAGMAS
+from .catalog import get_generation
+from .db_import import import_path, long_import
+from .db_locking import DbLocking
+from .db_repair import get_file_infos, long_repair
+from .forms import PackageEntryForm
+
+from .models import (
+    ArchiveFingerprint,
+    CatalogStatistic,
+    Job,
+    PackageEntry,
+    PackageInspection,
+    PackageTombstone,
+    blob_name,
+    convert_filter,
+    filter_to_matcher,
+    filter_to_query,
+    fill_package_names,
+    get_entry_count,
+    get_package_list,
+    get_package_detail,
+    get_statistics,
+    parse_dependencies,
+    prune_tombstones,
+    rebuild_statistics,
+)
+from . import task
+from .task import (
+    JobCancelled,
+    JobReporter,
+    acquire_worker_lock,
+    cancel_job,
+    database_import,
+    database_repair,
+    inspect_pending_packages,
+    recover_jobs,
+    run_pending_jobs,
+)
+
+
+def make_entry(**kwargs):
+    """
+    Create a package entry with sensible defaults.
+    :param kwargs: Fields to override.
+    :return: The created entry.
+    """
+    data = {
+        "name": "pack",
+        "version": "1.0.0",
+        "os": "l",
+        "arch": "x",
+        "kind": "r",
+        "abi": "g",
+        "glibc": "",
+        "package": "packages/pack.tgz",
+    }
+    data.update(kwargs)
+    return PackageEntry.objects.create(**data)
+
+
+class FilterQueryTest(TestCase):
+    """
+    Check that the database filter gives the same result as PackageEntry.match().
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        entries = [
+            ("fmt", "10.1.0", "l", "x", "r", "g", "2.35"),
+            ("fmt", "10.1.0", "w", "x", "t", "m", ""),
+            ("fmt", "9.0.0", "l", "a", "h", "l", "2.31"),
+            ("Fmt", "1.0", "l", "x", "r", "g", ""),
+            ("glfw", "3.3.8", "a", "y", "a", "a", ""),
+            ("glm", "1.0.1", "l", "x", "h", "g", "2.35"),
+            ("spdlog", "1.12.0", "w", "a", "t", "l", ""),
+            ("spd[log]", "2.0", "l", "x", "t", "g", ""),
+            ("fmt_ext", "10.1.0", "l", "x", "r", "g", "2.35"),
+        ]
+        for index, (name, version, os, arch, kind, abi, glibc) in enumerate(entries):
+            make_entry(
+                name=name,
+                version=version,
+                os=os,
+                arch=arch,
+                kind=kind,
+                abi=abi,
+                glibc=glibc,
+                package=f"packages/p{index}.tgz",
+            )
+
+    def assertParity(self, raw_filter: dict, raw_override: bool = False):
+        true_filter = convert_filter(dict(raw_filter))
+        if raw_override:
+            # same override as in get_packages_urls and delete_packages
+            for key in true_filter.keys():
+                if raw_filter.get(key) not in [None, "", "any"]:
+                    true_filter[key] = raw_filter[key]
+        expected = {q.pk for q in PackageEntry.objects.all() if q.match(true_filter)}
+        found = set(
+            PackageEntry.objects.filter(filter_to_query(true_filter)).values_list(
+                "pk", flat=True
+            )
+        )
+        self.assertEqual(expected, found, f"filter: {true_filter}")
+        matcher = filter_to_matcher(true_filter)
+        found = {q.pk for q in PackageEntry.objects.all() if matcher(q)}
+        self.assertEqual(expected, found, f"matcher: {true_filter}")
+
+    def test_empty_filter(self):
+        self.assertParity({})
+
+    def test_exact(self):
+        self.assertParity({"name": "fmt"})
+        self.assertParity({"name": "fmt", "version": "10.1.0"})
+        self.assertParity({"name": "FMT"})
+        self.assertParity({"glibc": "2.35"})
+
+    def test_glob(self):
+        for pattern in [
+            "fm*",
+            "F*",
+            "*t",
+            "g?f*",
+            "gl[fm]*",
+            "*",
+            "**",
+            "spd[log]",
+            "",
+        ]:
+            self.assertParity({"name": pattern})
+        for pattern in ["10.*", "1*.0", "?.0.0", "1.*.1"]:
+            self.assertParity({"version": pattern})
+        self.assertParity({"glibc": "2.3*"})
+
+    def test_flavor(self):
+        for raw_filter in [
+            {"os": "Linux"},
+            {"os": "windows", "arch": "x86_64"},
+            {"os": "any", "arch": "aarch64"},
+            {"kind": "static"},
+            {"kind": "header", "abi": "llvm"},
+            {"abi": "msvc"},
+            {"compiler": "gnu"},
+        ]:
+            self.assertParity(raw_filter)
+
+    def test_raw_override(self):
+        for raw_filter in [
+            {"name": "fmt", "os": "l", "arch": "x", "kind": "r", "abi": "g"},
+            {"name": "fmt", "os": "l"},
+            {"name": "fm*", "kind": "*"},
+            {"name": "glfw", "os": "any", "arch": "y", "kind": "a", "abi": "a"},
+        ]:
+            self.assertParity(raw_filter, raw_override=True)
+
+
+class PackageNameTest(TestCase):
+    """
+    Check the indexed base name of package files.
+    """
+
+    def test_filled_on_save(self):
+        entry = make_entry(package="packages/sub/fmt-10.1.0.tgz")
+        self.assertEqual(entry.package_name, "fmt-10.1.0.tgz")
+
+    def test_backfill(self):
+        entry = make_entry(package="packages/glm.tgz")
+        PackageEntry.objects.filter(pk=entry.pk).update(package_name="")
+        self.assertEqual(fill_package_names(), 1)
+        self.assertEqual(PackageEntry.objects.get(package_name="glm.tgz").pk, entry.pk)
+
+
+class BenchIndexesTest(TransactionTestCase):
+    """
+    Check that the index benchmark still runs on the current schema (its schema
+    editor cannot run inside the transaction of a TestCase).
+    """
+
+    def test_smoke(self):
+        output = StringIO()
+        call_command("bench_indexes", "--rows", "50", "--repeat", "1", stdout=output)
+        self.assertIn("file name (repair)", output.getvalue())
+
+
+class PackageListTest(TestCase):
+    """
+    Check the package list of the packages page.
+    """
+
+    def test_constant_queries(self):
+        for index in range(20):
+            make_entry(name=f"pack{index % 5}", version=f"1.{index}")
+        with self.assertNumQueries(1):
+            result = get_package_list({})
+        self.assertEqual([it["name"] for it in result], [f"pack{i}" for i in range(5)])
+        self.assertEqual(
+            list(result[0]["versions"].keys()), ["1.15", "1.10", "1.5", "1.0"]
+        )
+
+    def test_filter(self):
+        make_entry(name="fmt", os="l")
+        make_entry(name="fmt", os="w")
+        make_entry(name="glm", os="w")
+        result = get_package_list({"os": "Linux"})
+        self.assertEqual(len(result), 1)
+        flavors = result[0]["versions"]["1.0.0"]["flavors"]
+        self.assertEqual([flavor["os"] for flavor in flavors], ["Linux"])
+
+
+class StatisticsTest(TestCase):
+    """
+    Check the statistics maintained at each modification of the catalog.
+    """
+
+    def snapshot(self):
+        return sorted(
+            CatalogStatistic.objects.filter(flavors__gt=0).values_list(
+                "dimension", "value", "flavors", "size", "packages"
+            )
+        )
+
+    def test_incremental(self):
+        self.assertEqual(get_entry_count(), 0)
+        fmt = make_entry(name="fmt", size=100)
+        make_entry(name="fmt", os="w", size=50)
+        glm = make_entry(name="glm", kind="h", size=10)
+        fmt.os = "a"
+        fmt.save()
+        glm.delete(keep_file=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_entry_count(), 1)
+        statistics = get_statistics(details=True)
+        self.assertEqual(statistics["flavors"], 2)
+        self.assertEqual(statistics["size"], 150)
+        self.assertEqual(statistics["os"], {"any": (1, 100), "Windows": (1, 50)})
+        incremental = self.snapshot()
+        rebuild_statistics()
+        self.assertEqual(self.snapshot(), incremental)
+        # shown on the administration page
+        self.client.force_login(User.objects.create_superuser("admin"))
+        self.assertContains(self.client.get("/admin_db"), "Windows: 1")
+        self.assertEqual(self.client.get("/").context["statistics"]["packages"], 1)
+
+
+class FileInfosTest(TestCase):
+    """
+    Check the size and checksum stored with the entries.
+    """
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmp_dir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmp_dir.cleanup()
+
+    def test_form_upload(self):
+        content = b"fake archive content" * 100
+        form = PackageEntryForm(
+            {
+                "name": "fmt",
+                "version": "10.1.0",
+                "glibc": "2.35",
+                "build_date": "2024-01-01T00:00:00+0000",
+                "os": "l",
+                "arch": "x",
+                "kind": "r",
+                "abi": "g",
+                "dependencies": "",
+            },
+            {"package": SimpleUploadedFile("fmt.tgz", content)},
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        entry = PackageEntry.objects.get(pk=form.save().pk)
+        self.assertEqual(entry.size, len(content))
+        self.assertEqual(entry.sha256, hashlib.sha256(content).hexdigest())
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.assertEqual(
+            entry.package.name, f"packages/{sha256[:2]}/{sha256[2:4]}/{sha256}.tgz"
+        )
+        self.assertEqual(entry.package_name, f"{sha256}.tgz")
+        self.assertEqual(entry.get_pretty_size_display(), "1.95 K")
+
+    def test_shared_archive(self):
+        content = b"header only archive" * 100
+        entries = []
+        for os_code in ["l", "w"]:
+            form = PackageEntryForm(
+                {
+                    "name": "glm",
+                    "version": "1.0.0",
+                    "glibc": "2.35",
+                    "build_date": "2024-01-01T00:00:00+0000",
+                    "os": os_code,
+                    "arch": "x",
+                    "kind": "h",
+                    "abi": "g",
+                },
+                {"package": SimpleUploadedFile("glm.tgz", content)},
+            )
+            self.assertTrue(form.is_valid(), form.errors)
+            entries.append(form.save())
+        self.assertEqual(entries[0].package.name, entries[1].package.name)
+        stored = [path for path in Path(self.tmp_dir.name).rglob("*") if path.is_file()]
+        self.assertEqual(len(stored), 1)
+        # the archive is removed with its last entry, once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            entries[0].delete()
+        self.assertTrue(stored[0].exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            entries[1].delete()
+            self.assertTrue(stored[0].exists())
+        self.assertFalse(stored[0].exists())
+        # an identical archive pushed before the removal is committed
+        entry = make_entry(package=SimpleUploadedFile("glm.tgz", content))
+        with self.captureOnCommitCallbacks(execute=True):
+            entry.delete()
+            make_entry(os="w", package=SimpleUploadedFile("glm.tgz", content))
+        self.assertTrue(stored[0].exists())
+
+    def test_dedup_store(self):
+        folder = Path(self.tmp_dir.name) / "packages"
+        folder.mkdir()
+        for name, content in [
+            ("a.tgz", b"same"),
+            ("b.tgz", b"same"),
+            ("c.tgz", b"other"),
+        ]:
+            (folder / name).write_bytes(content)
+            make_entry(name=name[0], package=f"packages/{name}")
+        make_entry(name="a", os="w", package="packages/a.tgz")
+        self.assertEqual(get_statistics()["size"], 0)
+        call_command("dedup_store", "--dry-run", stdout=StringIO())
+        self.assertEqual(len(list(folder.iterdir())), 3)
+        output = StringIO()
+        call_command("dedup_store", stdout=output)
+        self.assertIn("Moved 2 files, dropped 1 duplicates", output.getvalue())
+        # the sizes read from the files are in the statistics
+        self.assertEqual(get_statistics()["size"], 4 * 3 + 5)
+        self.assertEqual(PackageEntry.objects.values("package").distinct().count(), 2)
+        for entry in PackageEntry.objects.all():
+            self.assertEqual(
+                Path(entry.package.path).read_bytes(),
+                b"other" if entry.name == "c" else b"same",
+            )
+        self.assertEqual(
+            sorted(path.name for path in folder.iterdir() if path.is_file()), []
+        )
+
+    def test_dedup_store_error(self):
+        folder = Path(self.tmp_dir.name) / "packages"
+        folder.mkdir()
+        (folder / "a.tgz").write_bytes(b"same")
+        make_entry(name="a", package="packages/a.tgz")
+        with patch("django.db.models.QuerySet.update", side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                call_command("dedup_store", stdout=StringIO())
+        # the entry still references an existing file
+        entry = PackageEntry.objects.get(name="a")
+        self.assertEqual(Path(entry.package.path).read_bytes(), b"same")
+        call_command("dedup_store", stdout=StringIO())
+        entry.refresh_from_db()
+        self.assertEqual(Path(entry.package.path).read_bytes(), b"same")
+        self.assertFalse((folder / "a.tgz").exists())
+
+    def test_update_file_infos(self):
+        entry = make_entry(package="packages/missing.tgz")
+        self.assertFalse(entry.update_file_infos())
+        self.assertEqual(entry.get_pretty_size_display(), "(void)")
+
+
+def make_archive(path: Path, **infos):
+    """
+    Create a package archive with old format metadata.
+    :param path: The archive path.
+    :param infos: The metadata.
+    """
+    content = "".join(f"{key} = {val}\n" for key, val in infos.items()).encode()
+    with tarfile.open(path, "w:gz") as archive:
+        member = tarfile.TarInfo("./edp.info")
+        member.size = len(content)
+        archive.addfile(member, BytesIO(content))
+
+
+class RepairTest(TestCase):
+    """
+    Check the database repair against the package files.
+    """
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        override = override_settings(MEDIA_ROOT=self.tmp_dir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        folder = Path(self.tmp_dir.name) / "packages"
+        folder.mkdir()
+        self.infos = {
+            "version": "1.0.0",
+            "os": "Linux",
+            "arch": "x86_64",
+            "kind": "static",
+            "abi": "gnu",
+            "glibc": "2.35",
+            "build_date": "2024-01-01T00:00:00",
+        }
+        for name in ["fmt", "glm", "spdlog"]:
+            make_archive(folder / f"{name}.tgz", name=name, **self.infos)
+        (folder / "broken.tgz").write_bytes(b"not an archive")
+        flavor = {
+            "kind": "t",
+            "glibc": "2.35",
+            "build_date": datetime.fromisoformat("2024-01-01T00:00:00+00:00"),
+        }
+        make_entry(name="fmt", package="packages/fmt.tgz", **flavor)
+        make_entry(name="glm", version="0.9", package="packages/glm.tgz", **flavor)
+
+    def test_repair(self):
+        for workers in [1, 2]:
+            long_repair(do_correct=True, skip_large_files=False, workers=workers)
+            self.assertEqual(
+                sorted(PackageEntry.objects.values_list("name", "version")),
+                [("fmt", "1.0.0"), ("glm", "1.0.0"), ("spdlog", "1.0.0")],
+            )
+            self.assertFalse(PackageEntry.objects.filter(sha256="").exists())
+        # the archive without entry is moved into the content-addressed store
+        spdlog = PackageEntry.objects.get(name="spdlog")
+        self.assertEqual(spdlog.package.name, blob_name(spdlog.sha256))
+        self.assertTrue(Path(spdlog.package.path).exists())
+        self.assertFalse((Path(self.tmp_dir.name) / "packages/spdlog.tgz").exists())
+
+    def test_metadata_stream(self):
+        path = Path(self.tmp_dir.name) / "yaml.tgz"
+        members = [
+            (
+                "./info.yaml",
+                b"name: fmt\nversion: 10.0\nbuild_date: 2024-01-01T12:00:00\n",
+            ),
+            ("./description.md", b"# fmt"),
+            ("./lib/libfmt.a", os.urandom(512 * 1024)),
+        ]
+        with tarfile.open(path, "w:gz") as archive:
+            for name, content in members:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                archive.addfile(member, BytesIO(content))
+        # the end of the archive is never read
+        path.write_bytes(path.read_bytes()[:-4096])
+        data = get_file_infos(path)
+        self.assertEqual((data["name"], data["version"]), ("fmt", "10.0"))
+        self.assertEqual(
+            data["build_date"], datetime.fromisoformat("2024-01-01T12:00:00+00:00")
+        )
+        self.assertEqual(data["description"], "# fmt")
+
+    def test_metadata_order(self):
+        path = Path(self.tmp_dir.name) / "both.tgz"
+        members = [
+            ("./description.md", b"# fmt"),
+            ("./edp.info", b"name = fmt\nversion = 9.0\n"),
+            ("./info.yaml", b"name: fmt\nversion: 10.0\n"),
+        ]
+        with tarfile.open(path, "w:gz") as archive:
+            for name, content in members:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                archive.addfile(member, BytesIO(content))
+        # the new format is used, even after the old one in the archive
+        self.assertEqual(get_file_infos(path)["version"], "10.0")
+
+    def test_incremental(self):
+        folder = Path(self.tmp_dir.name) / "packages"
+        with patch("pack.db_repair.get_file_infos", wraps=get_file_infos) as reads:
+            long_repair(do_correct=True, skip_large_files=False, workers=1)
+            self.assertEqual(reads.call_count, 4)
+            # the unreadable archive is not fingerprinted
+            self.assertEqual(ArchiveFingerprint.objects.count(), 3)
+            reads.reset_mock()
+            long_repair(do_correct=True, skip_large_files=False, workers=1)
+            self.assertEqual(
+                [call.args[0].name for call in reads.call_args_list], ["broken.tgz"]
+            )
+            reads.reset_mock()
+            make_archive(folder / "glm.tgz", **(self.infos | {"version": "2.0.0"}))
+            (folder / "fmt.tgz").unlink()
+            long_repair(do_correct=True, skip_large_files=False, workers=1)
+            self.assertEqual(
+                [call.args[0].name for call in reads.call_args_list],
+                ["broken.tgz", "glm.tgz"],
+            )
+            self.assertEqual(ArchiveFingerprint.objects.count(), 2)
+            self.assertTrue(PackageEntry.objects.filter(version="2.0.0").exists())
+            reads.reset_mock()
+            long_repair(do_correct=True, skip_large_files=False, workers=1, full=True)
+            self.assertEqual(reads.call_count, 3)
+
+    def test_push_inspection(self):
+        entry = make_entry(
+            name="spdlog",
+            version="2.0.0",
+            package="packages/spdlog.tgz",
+            kind="t",
+            glibc="2.35",
+            build_date=datetime.fromisoformat("2024-01-01T00:00:00+00:00"),
+        )
+        PackageInspection.queue(entry)
+        self.assertEqual(inspect_pending_packages(), 1)
+        self.assertEqual(inspect_pending_packages(), 0)
+        inspection = PackageInspection.objects.get(entry=entry)
+        self.assertEqual(inspection.get_file_list(), ["edp.info"])
+        self.assertEqual(inspection.metadata["name"], "spdlog")
+        self.assertEqual(
+            inspection.mismatches,
+            [{"field": "version", "archive": "1.0.0", "database": "2.0.0"}],
+        )
+        flavor = get_package_detail("spdlog")["versions"]["2.0.0"]["flavors"][0]
+        self.assertEqual(flavor["mismatches"][0]["field"], "version")
+        # corrected by the repair, and inspected again
+        long_repair(do_correct=True, skip_large_files=False, workers=1)
+        self.assertEqual(inspect_pending_packages(), 1)
+        inspection.refresh_from_db()
+        self.assertEqual(inspection.mismatches, [])
+
+
+class DependenciesTest(TestCase):
+    """
+    Check the parsing and storage of the dependencies.
+    """
+
+    def test_parse(self):
+        deps = parse_dependencies(
+            "[{'name': 'fmt', 'version': '10.1.0', 'build_date':"
+            " datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)}]"
+        )
+        self.assertEqual(deps[0]["name"], "fmt")
+        self.assertEqual(deps[0]["build_date"].year, 2024)
+        self.assertEqual(parse_dependencies(""), [])
+        self.assertEqual(parse_dependencies("{'name': 'fmt'}"), [])
+        self.assertEqual(parse_dependencies("__import__('os').getcwd()"), [])
+        self.assertEqual(parse_dependencies("[{'name': ''.join(['a'])}]"), [])
+
+    def test_stored_and_reverse(self):
+        entry = make_entry(
+            name="spdlog",
+            dependencies="[{'name': 'fmt', 'version': '10.*', 'os': 'Linux'}]",
+        )
+        make_entry(name="fmt")
+        self.assertEqual(entry.requirements.count(), 1)
+        entry.dependencies = "[{'name': 'fmt'}, {'name': 'glm', 'kind': None}]"
+        entry.save()
+        self.assertEqual([dep.name for dep in entry.requirements.all()], ["fmt", "glm"])
+        detail = get_package_detail("spdlog")
+        flavor = detail["versions"]["1.0.0"]["flavors"][0]
+        self.assertEqual(flavor["dependencies"][1]["kind"], "")
+        self.assertEqual(get_package_detail("fmt")["used_by"], ["spdlog"])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class LockingTest(TestCase):
+    """
+    Check the maintenance lock, as seen from another process.
+    """
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.maintenance = DbLocking(Path(self.tmp.name) / "db.lock")
+        self.other = DbLocking(Path(self.tmp.name) / "db.lock")
+        self.other.state_ttl = 0
+
+    def test_shared_maintenance(self):
+        self.assertTrue(self.maintenance.get_lock(exclusive=False))
+        self.assertFalse(self.other.is_locked())
+        self.assertTrue(self.other.is_locked(writing=True))
+        with self.other.writing() as writable:
+            self.assertFalse(writable)
+        self.assertFalse(self.other.get_lock())
+        self.maintenance.release_lock()
+        self.assertFalse(self.other.is_locked(writing=True))
+
+    def test_probe(self):
+        fd = os.open(self.other.write_lockfile, os.O_RDWR | os.O_CREAT)
+        self.addCleanup(os.close, fd)
+        # probe of another process, ending during the grace delay
+        flock(fd, LOCK_SH)
+        Thread(target=lambda: (sleep(0.05), flock(fd, LOCK_UN))).start()
+        self.assertTrue(self.maintenance.get_lock())
+        self.maintenance.release_lock()
+
+    def test_exclusive_maintenance(self):
+        self.assertTrue(self.maintenance.get_lock())
+        self.assertTrue(self.other.is_locked())
+        self.assertFalse(self.other.get_lock(exclusive=False))
+        self.maintenance.release_lock()
+        self.assertFalse(self.other.is_locked())
+
+    def test_no_maintenance_during_write(self):
+        with self.other.writing() as writable:
+            self.assertTrue(writable)
+            self.assertFalse(self.maintenance.get_lock(exclusive=False))
+        self.assertTrue(self.maintenance.get_lock(exclusive=False))
+        self.maintenance.release_lock()
+
+    def test_state_cache(self):
+        self.maintenance.state_ttl = 60
+        self.assertFalse(self.maintenance.is_locked())
+        self.assertTrue(self.other.get_lock())
+        self.assertFalse(self.maintenance.is_locked())
+        self.other.release_lock()
+
+
+class ReadOnlyDatabaseTest(TransactionTestCase):
+    """
+    Check the connection settings and the read-only connection of the views.
+    """
+
+    databases = {"default", "readonly"}
+
+    def test_read_only_view(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], SQLITE_PRAGMAS["busy_timeout"])
+        make_entry(name="fmt")
+        self.client.force_login(User.objects.create_superuser("admin"))
+        with CaptureQueriesContext(connections["readonly"]) as queries:
+            response = self.client.get("/package/fmt")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(any("pack_packageentry" in q["sql"] for q in queries))
+        with self.assertRaises(OperationalError):
+            with connections["readonly"].cursor() as cursor:
+                cursor.execute("DELETE FROM pack_packageentry")
+        self.assertEqual(PackageEntry.objects.count(), 1)
+
+
+class CapabilityTest(TestCase):
+    """
+    Check the resolution of the user capabilities.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", password="secret")
+        self.client.force_login(self.admin)
+
+    def add_users(self, count: int):
+        group = Group.objects.create(name=f"viewers{count}")
+        group.permissions.add(Permission.objects.get(codename="view_packageentry"))
+        for i in range(count):
+            user = User.objects.create_user(f"user{count}_{i}")
+            user.user_permissions.add(Permission.objects.get(codename="view_user"))
+            user.groups.add(group)
+
+    def test_users_page(self):
+        self.add_users(2)
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(self.client.get("/users").status_code, 200)
+        self.add_users(8)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get("/users")
+        self.assertEqual(len(many), len(few))
+        user = next(u for u in response.context["users"] if u["name"] == "user2_0")
+        self.assertTrue(user["can_view_package"])
+        self.assertTrue(user["can_view_user"])
+        self.assertFalse(user["can_add_package"])
+
+    def test_toggle(self):
+        self.add_users(1)
+        user = User.objects.get(username="user1_0")
+        self.assertFalse(has_capability(user, "can_add_package"))
+        request = RequestFactory().post("/")
+        request.user = self.admin
+        request._messages = CookieStorage(request)
+        generation = get_token_generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            toggle_capability(request, user, "can_add_package")
+            # the verified tokens are forgotten after the modification only
+            self.assertEqual(get_token_generation(), generation)
+        self.assertNotEqual(get_token_generation(), generation)
+        self.assertTrue(has_capability(user, "can_add_package"))
+        # memoized until the next modification
+        with CaptureQueriesContext(connection) as queries:
+            get_capability(user)
+        self.assertEqual(len(queries), 0)
+
+
+class ApiTestCase(TestCase):
+    """
+    Base for the tests of the API, with a user allowed to view packages.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user("client", password="secret")
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="view_packageentry")
+        )
+        self.auth = "Basic " + b64encode(b"client:secret").decode("ascii")
+
+    def api_get(self, **headers):
+        return self.client.get("/api", HTTP_AUTHORIZATION=self.auth, **headers)
+
+    def api_post(self, data: dict, **headers):
+        return self.client.post("/api", data, HTTP_AUTHORIZATION=self.auth, **headers)
+
+
+class ApiTokenTest(ApiTestCase):
+    """
+    Check the authentication of the API calls, by password and by API tokens.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.token, raw = ApiToken.create_token(self.user, "ci")
+        self.bearer = f"Bearer {raw}"
+
+    def test_token(self):
+        make_entry(name="fmt")
+        with patch("django.contrib.auth.hashers.PBKDF2PasswordHasher.verify") as hasher:
+            response = self.client.get("/api", HTTP_AUTHORIZATION=self.bearer)
+            self.assertEqual(response.status_code, 200)
+            # verified once, then from the process memory
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api", HTTP_AUTHORIZATION=self.bearer)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(any("connector_apitoken" in q["sql"] for q in queries))
+            hasher.assert_not_called()
+        self.token.refresh_from_db()
+        self.assertIsNotNone(self.token.last_used)
+        response = self.client.get("/api", HTTP_AUTHORIZATION="Bearer dms_wrong")
+        self.assertEqual(response.status_code, 403)
+
+    def test_stateless(self):
+        make_entry(name="fmt")
+        for auth in (self.auth, self.bearer, self.auth):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api", HTTP_AUTHORIZATION=auth)
+                self.client.cookies.clear()
+            self.assertEqual(response.status_code, 200)
+        # no session nor last login written by the last call
+        writes = [
+            q["sql"]
+            for q in queries
+            if q["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+        ]
+        self.assertEqual(writes, [])
+        self.assertEqual(Session.objects.count(), 0)
+        self.user.refresh_from_db()
+        self.assertIsNone(self.user.last_login)
+        # the expired sessions left in database are purged
+        Session.objects.create(
+            session_key="old", session_data="", expire_date=timezone.now()
+        )
+        Session.objects.create(
+            session_key="web",
+            session_data="",
+            expire_date=timezone.now() + timedelta(days=1),
+        )
+        call_command("purge_db_sessions", stdout=StringIO())
+        self.assertEqual(list(Session.objects.values_list("pk", flat=True)), ["web"])
+        call_command("purge_db_sessions", "--all", stdout=StringIO())
+        self.assertEqual(Session.objects.count(), 0)
+
+    def test_web_session(self):
+        self.client.force_login(self.user)
+        # kept when the session cache is cleared
+        caches["sessions"].clear()
+        self.assertEqual(self.client.get("/profile/").status_code, 200)
+        self.assertTrue(self.client.get("/profile/").context["user"].is_authenticated)
+
+    def test_scope_and_revoke(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="add_packageentry")
+        )
+        response = self.client.post(
+            "/api", {"action": "push"}, HTTP_AUTHORIZATION=self.bearer
+        )
+        # a pull token cannot push, even if its user can
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(
+            self.client.get("/api", HTTP_AUTHORIZATION=self.bearer).status_code, 200
+        )
+        self.token.revoke()
+        self.assertEqual(
+            self.client.get("/api", HTTP_AUTHORIZATION=self.bearer).status_code, 403
+        )
+
+    def test_user_changes(self):
+        self.assertEqual(
+            self.client.get("/api", HTTP_AUTHORIZATION=self.bearer).status_code, 200
+        )
+        # e.g. from the administration site
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.user_permissions.clear()
+        self.assertEqual(
+            self.client.get("/api", HTTP_AUTHORIZATION=self.bearer).status_code, 403
+        )
+        group = Group.objects.create(name="viewers")
+        group.permissions.add(Permission.objects.get(codename="view_packageentry"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.groups.add(group)
+        self.assertEqual(
+            self.client.get("/api", HTTP_AUTHORIZATION=self.bearer).status_code, 200
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(
+            self.client.get("/api", HTTP_AUTHORIZATION=self.bearer).status_code, 403
+        )
+
+    def test_profile(self):
+        self.client.force_login(self.user)
+        response = self.client.post("/profile/token/new", {"name": "runner"})
+        self.assertEqual(response.status_code, 200)
+        token = ApiToken.objects.get(name="runner")
+        # the raw token is in this response only, never in a message
+        raw = response.context["new_token"]
+        self.assertTrue(raw.startswith(token.prefix))
+        self.assertIn(raw, response.content.decode())
+        self.assertIn("no-store", response["Cache-Control"])
+        self.assertNotIn(raw, str(response.cookies))
+        self.assertEqual(len(list(response.context["messages"])), 0)
+        page = self.client.get("/profile/").content.decode()
+        self.assertIn(token.prefix, page)
+        # scopes above the user capabilities are refused
+        self.client.post(
+            "/profile/token/new", {"name": "push", "scope": "can_add_package"}
+        )
+        self.assertFalse(ApiToken.objects.filter(name="push").exists())
+        self.client.post(f"/profile/token/{token.pk}/revoke")
+        token.refresh_from_db()
+        self.assertTrue(token.revoked)
+
+
+class ApiIndexTest(ApiTestCase):
+    """
+    Check the full index of the API.
+    """
+
+    def test_index(self):
+        make_entry(name="fmt", dependencies="[{'name': 'glm'}]")
+        make_entry(name="glm", glibc="2.35")
+        response = self.api_get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.getvalue().decode(),
+            "\n".join(entry.to_dep_entry() for entry in PackageEntry.objects.all()),
+        )
+        self.assertNotIn("deps:", response.getvalue().decode())
+        response = self.api_get(HTTP_X_API_VERSION="2.1.0")
+        self.assertIn("| deps: [{'name': 'glm'}]", response.getvalue().decode())
+
+    def test_gzip_stream(self):
+        for index in range(1200):
+            make_entry(name=f"pack{index}")
+        response = self.api_get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        lines = gzip.decompress(response.getvalue()).decode().split("\n")
+        self.assertEqual(len(lines), 1200)
+        self.assertTrue(lines[-1].startswith("pack1199/1.0.0 "))
+
+    def test_not_modified(self):
+        make_entry(name="fmt")
+        etag = self.api_get()["ETag"]
+        response = self.api_get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.api_get(HTTP_X_API_VERSION="2.1.0")["ETag"], etag)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_entry(name="glm")
+        response = self.api_get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("glm/1.0.0", response.getvalue().decode())
+
+    def test_bump_on_commit(self):
+        make_entry(name="fmt")
+        etag = self.api_get()["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                make_entry(name="glm")
+                fmt = PackageEntry.objects.get(name="fmt")
+                fmt.delete(keep_file=True)
+                # not committed: the generation is unchanged
+                self.assertEqual(self.api_get()["ETag"], etag)
+        self.assertNotEqual(self.api_get()["ETag"], etag)
+
+    def test_modified_since(self):
+        make_entry(name="fmt")
+        date = get_generation()["date"]
+        # modified during the current second: no Last-Modified, no false 304
+        with patch("pack.catalog.time", return_value=date):
+            self.assertFalse(self.api_get().has_header("Last-Modified"))
+            response = self.api_get(HTTP_IF_MODIFIED_SINCE=http_date(date + 1))
+            self.assertEqual(response.status_code, 200)
+        with patch("pack.catalog.time", return_value=date + 2):
+            last_modified = self.api_get()["Last-Modified"]
+            response = self.api_get(HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+
+
+class ApiChangesTest(ApiTestCase):
+    """
+    Check the incremental synchronization of the index.
+    """
+
+    def changes(self, since: int):
+        response = self.api_post({"action": "changes", "since": since})
+        self.assertEqual(response.status_code, 200)
+        lines = response.getvalue().decode().split("\n")
+        return int(lines[0].split(":")[1]), lines[1:]
+
+    def test_changes(self):
+        fmt = make_entry(name="fmt")
+        make_entry(name="glm")
+        revision, lines = self.changes(0)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.changes(revision), (revision, []))
+        fmt.version = "2.0.0"
+        fmt.save()
+        PackageEntry.objects.get(name="glm").delete(keep_file=True)
+        make_entry(name="spdlog")
+        new_revision, lines = self.changes(revision)
+        self.assertEqual(new_revision, revision + 3)
+        self.assertEqual(
+            [line.split(" (")[0] for line in lines],
+            ["- fmt/1.0.0", "+ fmt/2.0.0", "- glm/1.0.0", "+ spdlog/1.0.0"],
+        )
+        _, lines = self.changes(0)
+        self.assertEqual(len(lines), 2)
+
+    def test_pruned(self):
+        for name in ["fmt", "glm", "spdlog"]:
+            make_entry(name=name)
+        revision, _ = self.changes(0)
+        for name in ["fmt", "glm"]:
+            PackageEntry.objects.get(name=name).delete(keep_file=True)
+        self.assertEqual(prune_tombstones(1), 1)
+        self.assertEqual(PackageTombstone.objects.count(), 1)
+        self.assertEqual(prune_tombstones(1), 0)
+        # the removal of fmt is lost: the client gets the full index
+        _, lines = self.changes(revision)
+        self.assertEqual(lines[0], "full: true")
+        self.assertEqual(
+            [line.split(" (")[0] for line in lines[1:]], ["+ spdlog/1.0.0"]
+        )
+        _, lines = self.changes(revision + 1)
+        self.assertEqual([line.split(" (")[0] for line in lines], ["- glm/1.0.0"])
+
+    def test_ahead(self):
+        make_entry(name="fmt")
+        revision, _ = self.changes(0)
+        self.assertEqual(self.changes(revision), (revision, []))
+        # revision unknown to the server: the client gets the full index
+        _, lines = self.changes(revision + 10)
+        self.assertEqual(lines[0], "full: true")
+        self.assertEqual([line.split(" (")[0] for line in lines[1:]], ["+ fmt/1.0.0"])
+
+    def test_bad_revision(self):
+        response = self.api_post({"action": "changes", "since": "last"})
+        self.assertEqual(response.status_code, 406)
+
+
+class ApiPullManyTest(ApiTestCase):
+    """
+    Check the resolution of many specs in one request.
+    """
+
+    def setUp(self):
+        super().setUp()
+        fmt = make_entry(name="fmt", package="packages/fmt.tgz")
+        fmt_w = make_entry(name="fmt", os="w", abi="m", package="packages/fmt_w.tgz")
+        glm = make_entry(name="glm", package="packages/glm.tgz")
+        self.urls = {
+            entry.package.name: f"/download/{entry.pk}" for entry in [fmt, fmt_w, glm]
+        }
+
+    def test_pull_many(self):
+        specs = [
+            {"name": "fmt", "os": "l"},
+            {"name": "fmt"},
+            {"name": "gl*", "compiler": "g"},
+            {"name": "spdlog"},
+            {},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.api_post({"action": "pull_many", "specs": dumps(specs)})
+        lookups = [q for q in queries if "pack_packageentry" in q["sql"]]
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"],
+            [
+                [self.urls[name] for name in names]
+                for names in [
+                    ["packages/fmt.tgz"],
+                    ["packages/fmt.tgz", "packages/fmt_w.tgz"],
+                    ["packages/glm.tgz"],
+                    [],
+                    ["packages/fmt.tgz", "packages/fmt_w.tgz", "packages/glm.tgz"],
+                ]
+            ],
+        )
+        for spec, urls in zip(specs, response.json()["results"]):
+            if len(urls) > 0:
+                response = self.api_post({"action": "pull"} | spec)
+                self.assertEqual(response.content.decode().split(), urls)
+
+    def test_json_body(self):
+        response = self.client.post(
+            "/api",
+            dumps({"action": "pull_many", "specs": [{"name": "glm"}]}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=self.auth,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(), {"results": [[self.urls["packages/glm.tgz"]]]}
+        )
+        response = self.api_post({"action": "pull_many", "specs": "{"})
+        self.assertEqual(response.status_code, 406)
+
+
+class ApiClosureTest(ApiTestCase):
+    """
+    Check the server-side resolution of the dependency closure.
+    """
+
+    def setUp(self):
+        super().setUp()
+        make_entry(
+            name="app",
+            dependencies="[{'name': 'fmt', 'version': '10.*'}, {'name': 'glm'}]",
+            package="packages/app.tgz",
+        )
+        make_entry(name="fmt", version="9.0.0", package="packages/fmt9.tgz")
+        make_entry(
+            name="fmt",
+            version="10.2.0",
+            dependencies="[{'name': 'glm', 'kind': 'header'}]",
+            package="packages/fmt10.tgz",
+        )
+        make_entry(name="fmt", version="10.2.0", os="w", package="packages/fmt_w.tgz")
+        make_entry(name="glm", kind="h", os="a", arch="y", package="packages/glm.tgz")
+
+    def closure(self, **kwargs):
+        return self.api_post({"action": "closure"} | kwargs)
+
+    def test_closure(self):
+        response = self.closure(name="app", os="l")
+        self.assertEqual(response.status_code, 200)
+        closure = response.json()
+        self.assertEqual(
+            [(flavor["name"], flavor["url"]) for flavor in closure["closure"]],
+            [
+                (entry.name, f"/download/{entry.pk}")
+                for entry in [
+                    PackageEntry.objects.get(package=f"packages/{name}.tgz")
+                    for name in ["glm", "fmt10", "app"]
+                ]
+            ],
+        )
+        self.assertEqual(closure["missing"], [])
+        self.assertEqual(self.closure(name="spdlog").status_code, 406)
+
+    def test_missing_and_cache(self):
+        make_entry(
+            name="lib",
+            dependencies="[{'name': 'spdlog'}, {'name': 'app'}]",
+            package="packages/lib.tgz",
+        )
+        closure = self.closure(name="lib").json()
+        self.assertEqual(
+            [(dep["name"], dep["required_by"]) for dep in closure["missing"]],
+            [("spdlog", "lib")],
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.closure(name="lib").json(), closure)
+        self.assertFalse(any("pack_packageentry" in q["sql"] for q in queries))
+        with self.captureOnCommitCallbacks(execute=True):
+            make_entry(name="spdlog", package="packages/spdlog.tgz")
+        closure = self.closure(name="lib").json()
+        self.assertEqual(closure["missing"], [])
+        self.assertEqual(closure["closure"][0]["name"], "spdlog")
+        self.assertEqual(closure["closure"][-1]["name"], "lib")
+        # unrelated changes keep the closure cached
+        make_entry(name="other", package="packages/other.tgz")
+        with CaptureQueriesContext(connection) as queries:
+            self.closure(name="lib")
+        self.assertFalse(any("pack_packageentry" in q["sql"] for q in queries))
+
+
+class ApiDownloadTest(ApiTestCase):
+    """
+    Check the authorized download of the package files.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.entry = make_entry(
+            name="fmt", package="packages/ab/cd/abcd.tgz", sha256="abcd" * 16
+        )
+        self.etag = f'"{"abcd" * 16}"'
+
+    def download(self, pk: int, **headers):
+        return self.client.get(f"/download/{pk}", **headers)
+
+    def test_accel_redirect(self):
+        response = self.download(self.entry.pk, HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/media/packages/ab/cd/abcd.tgz")
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn('filename="abcd.tgz"', response["Content-Disposition"])
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        # nginx sends the file: nothing in the response body
+        self.assertEqual(response.content, b"")
+        self.assertEqual(
+            self.download(0, HTTP_AUTHORIZATION=self.auth).status_code, 404
+        )
+
+    def test_authorization(self):
+        self.assertEqual(self.download(self.entry.pk).status_code, 403)
+        User.objects.create_user("nobody", password="secret")
+        auth = "Basic " + b64encode(b"nobody:secret").decode("ascii")
+        response = self.download(self.entry.pk, HTTP_AUTHORIZATION=auth)
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn("X-Accel-Redirect", response)
+
+    def test_without_nginx(self):
+        with TemporaryDirectory() as tmp_dir:
+            file = Path(tmp_dir) / "packages" / "ab" / "cd" / "abcd.tgz"
+            file.parent.mkdir(parents=True)
+            file.write_bytes(b"archive")
+            with override_settings(MEDIA_ROOT=tmp_dir, DOWNLOAD_ACCEL_REDIRECT=False):
+                response = self.download(self.entry.pk, HTTP_AUTHORIZATION=self.auth)
+                self.assertEqual(b"".join(response.streaming_content), b"archive")
+                for headers, status, content in [
+                    ({"Range": "bytes=2-4"}, 206, b"chi"),
+                    ({"Range": "bytes=4-"}, 206, b"ive"),
+                    ({"Range": "bytes=-2"}, 206, b"ve"),
+                    ({"Range": "bytes=2-", "If-Range": self.etag}, 206, b"chive"),
+                    # changed file: the whole file is sent
+                    ({"Range": "bytes=2-", "If-Range": '"other"'}, 200, b"archive"),
+                    ({"Range": "bytes=0-1,4-5"}, 200, b"archive"),
+                    # invalid ranges are ignored
+                    ({"Range": "bytes=4-2"}, 200, b"archive"),
+                    ({"Range": "bytes=-"}, 200, b"archive"),
+                    ({"Range": "bytes=--2"}, 200, b"archive"),
+                    ({"Range": "bytes=x-"}, 200, b"archive"),
+                    ({"Range": "items=0-1"}, 200, b"archive"),
+                ]:
+                    response = self.download(
+                        self.entry.pk, HTTP_AUTHORIZATION=self.auth, headers=headers
+                    )
+                    self.assertEqual(response.status_code, status, headers)
+                    self.assertEqual(b"".join(response.streaming_content), content)
+                    self.assertEqual(response["Content-Length"], str(len(content)))
+                for asked in ["bytes=9-", "bytes=-0"]:
+                    response = self.download(
+                        self.entry.pk, HTTP_AUTHORIZATION=self.auth, HTTP_RANGE=asked
+                    )
+                    self.assertEqual(response.status_code, 416)
+                    self.assertEqual(response["Content-Range"], "bytes */7")
+                response = self.download(
+                    self.entry.pk,
+                    HTTP_AUTHORIZATION=self.auth,
+                    HTTP_IF_NONE_MATCH=self.etag,
+                )
+                self.assertEqual(response.status_code, 304)
+
+
+class StandInServer(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in of a remote server, for import tests.
+    """
+
+    files = {
+        "fmt.tgz": b"fmt content" * 1000,
+        "glm.tgz": b"glm content" * 2000,
+    }
+    index = [
+        "fmt/10.1.0 (2024-01-02T00:00:00+00:00) [x86_64, shared, Linux, gnu-like]",
+        "glm/1.0.1 (2024-01-03T00:00:00+00:00) [any, header, any, any, 2.35]"
+        " | deps: [{'name': 'fmt'}]",
+    ]
+    ranges = []
+    downloads = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_content(self, status: int, content: bytes, etag: str = None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/api":
+            self.send_content(200, "\n".join(self.index).encode())
+        elif self.path.startswith("/media/packages/"):
+            self.downloads.append(self.path)
+            content = self.files[self.path.rsplit("/", 1)[-1]]
+            etag = f'"{hashlib.sha256(content).hexdigest()}"'
+            if_range = self.headers.get("If-Range", etag)
+            if "Range" in self.headers and if_range == etag:
+                self.ranges.append(self.headers["Range"])
+                start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+                self.send_content(206, content[start:], etag)
+            else:
+                self.send_content(200, content, etag)
+        else:
+            self.send_content(404, b"")
+
+    def do_HEAD(self):
+        content = self.files[self.path.rsplit("/", 1)[-1]]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", f'"{hashlib.sha256(content).hexdigest()}"')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        data = parse_qs(self.rfile.read(length).decode())
+        self.send_content(200, f"/media/packages/{data['name'][0]}.tgz".encode())
+
+
+class ImportTest(TestCase):
+    """
+    Check the import from another server.
+    """
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.tmp_dir.name, JOB_LOG_DIR=Path(self.tmp_dir.name) / "jobs"
+        )
+        self.settings_override.enable()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInServer)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        StandInServer.ranges.clear()
+        StandInServer.downloads.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.settings_override.disable()
+        self.tmp_dir.cleanup()
+
+    def test_import(self):
+        self.assertEqual(long_import(self.url, "user", "pass", workers=2), 2)
+        glm = PackageEntry.objects.get(name="glm")
+        self.assertEqual(glm.glibc, "2.35")
+        self.assertEqual(
+            glm.sha256, hashlib.sha256(StandInServer.files["glm.tgz"]).hexdigest()
+        )
+        self.assertEqual([dep.name for dep in glm.requirements.all()], ["fmt"])
+        # nothing more to import
+        self.assertEqual(long_import(self.url, "user", "pass"), 0)
+
+    def test_shared_file(self):
+        # flavors pulled from the same remote file (one archive per name)
+        index = StandInServer.index + [
+            "fmt/10.1.0 (2024-01-02T00:00:00+00:00) [x86_64, shared, Windows, msvc-like]",
+            "fmt/10.1.0 (2024-01-02T00:00:00+00:00) [aarch64, shared, Linux, gnu-like]",
+        ]
+        with patch.object(StandInServer, "index", index):
+            self.assertEqual(long_import(self.url, "user", "pass", workers=4), 4)
+        self.assertEqual(StandInServer.downloads.count("/media/packages/fmt.tgz"), 1)
+        self.assertEqual(
+            PackageEntry.objects.filter(name="fmt")
+            .values_list("package", flat=True)
+            .distinct()
+            .count(),
+            1,
+        )
+
+    def test_resume(self):
+        part = import_path(f"{self.url}/media/packages/fmt.tgz").with_suffix(".part")
+        part.parent.mkdir(parents=True)
+        part.write_bytes(StandInServer.files["fmt.tgz"][:3000])
+        self.assertEqual(long_import(self.url, "user", "pass"), 2)
+        self.assertEqual(StandInServer.ranges, ["bytes=3000-"])
+        self.assertFalse(part.exists())
+        self.assertEqual(
+            Path(PackageEntry.objects.get(name="fmt").package.path).read_bytes(),
+            StandInServer.files["fmt.tgz"],
+        )
+
+    def test_resume_changed(self):
+        part = import_path(f"{self.url}/media/packages/fmt.tgz").with_suffix(".part")
+        part.parent.mkdir(parents=True)
+        part.write_bytes(b"old fmt content")
+        part.with_name(f"{part.name}.etag").write_text('"old"')
+        self.assertEqual(long_import(self.url, "user", "pass"), 2)
+        # not resumed: the remote file has changed
+        self.assertEqual(StandInServer.ranges, [])
+        self.assertEqual(
+            Path(PackageEntry.objects.get(name="fmt").package.path).read_bytes(),
+            StandInServer.files["fmt.tgz"],
+        )
+        self.assertEqual(list(part.parent.iterdir()), [])
+
+    def test_former_download(self):
+        fmt = import_path(f"{self.url}/media/packages/fmt.tgz")
+        glm = import_path(f"{self.url}/media/packages/glm.tgz")
+        fmt.parent.mkdir(parents=True)
+        fmt.write_bytes(StandInServer.files["fmt.tgz"])
+        # left by an import of another file with the same name
+        glm.write_bytes(b"other glm")
+        self.assertEqual(long_import(self.url, "user", "pass"), 2)
+        self.assertEqual(StandInServer.downloads, ["/media/packages/glm.tgz"])
+        for name in ["fmt", "glm"]:
+            self.assertEqual(
+                Path(PackageEntry.objects.get(name=name).package.path).read_bytes(),
+                StandInServer.files[f"{name}.tgz"],
+            )
+        # only the content-addressed store is left
+        self.assertEqual(list(fmt.parent.iterdir()), [])
+        stored = Path(self.tmp_dir.name).glob("packages/**/*.tgz")
+        self.assertEqual(
+            sorted(path.relative_to(self.tmp_dir.name).as_posix() for path in stored),
+            sorted(PackageEntry.objects.values_list("package", flat=True)),
+        )
+
+    def test_import_job(self):
+        job = database_import(self.url, "user", "pass")
+        self.assertEqual(run_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.get_status_display(), "done")
+        self.assertEqual((job.progress, job.total), (2, 2))
+        self.assertIn("Imported 2 packages", job.get_log())
+        self.assertNotIn("password", job.params)
+
+
+class JobTest(TestCase):
+    """
+    Check the background jobs.
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", password="secret")
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        override = override_settings(JOB_LOG_DIR=Path(tmp_dir.name))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_log(self):
+        job = Job.objects.create(kind="repair", status="r")
+        reporter = JobReporter(job)
+        reporter.write("first\n")
+        reporter(1, 10)
+        reporter.write("second\n")
+        reporter.save()
+        # appended to the file, not rewritten in database
+        self.assertEqual(job.get_log(), "first\nsecond\n")
+        self.assertEqual(reporter.lines, [])
+        self.client.force_login(self.admin)
+        response = self.client.get(f"/job/{job.pk}/log")
+        self.assertEqual(response.content.decode(), "first\nsecond\n")
+
+    def test_failed_job(self):
+        job = database_import("http://127.0.0.1:1", "user", "pass")
+        self.assertEqual(run_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.get_status_display(), "failed")
+        self.assertIsNotNone(job.finished)
+        self.assertNotIn("password", job.params)
+
+    def test_exclusive_repair(self):
+        other = DbLocking()
+        other.state_ttl = 0
+        locked = []
+        database_repair()
+        with patch(
+            "pack.task.long_repair", lambda **kwargs: locked.append(other.is_locked())
+        ):
+            self.assertEqual(run_pending_jobs(), 1)
+        # no reading during a repair, which deletes entries
+        self.assertEqual(locked, [True])
+        self.assertFalse(other.is_locked())
+
+    def test_cancel(self):
+        job = database_repair()
+        self.assertEqual(database_repair(), job)
+        cancel_job(job)
+        self.assertEqual(job.get_status_display(), "cancelled")
+        self.assertEqual(run_pending_jobs(), 0)
+        # a running job is cancelled at its next progress report
+        job = Job.objects.create(kind="repair", status="r")
+        reporter = JobReporter(job)
+        reporter(1, 10)
+        cancel_job(job)
+        reporter.last_save = 0
+        with self.assertRaises(JobCancelled):
+            reporter(2, 10)
+
+    def test_recover(self):
+        # even with the process id of the new worker (reused after a restart)
+        job = Job.objects.create(kind="repair", status="r", pid=os.getpid())
+        self.assertEqual(recover_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.get_status_display(), "failed")
+
+    def test_worker_lock(self):
+        with TemporaryDirectory() as tmp:
+            path = Path(tmp) / "worker.lock"
+            other = os.open(path, os.O_RDWR | os.O_CREAT)
+            flock(other, LOCK_EX)
+            self.assertFalse(acquire_worker_lock(path))
+            os.close(other)
+            try:
+                self.assertTrue(acquire_worker_lock(path))
+            finally:
+                os.close(task._worker_lock)
+                task._worker_lock = None
+
+    def test_credentials_forgotten(self):
+        # cancelled before running
+        job = database_import("http://127.0.0.1:1", "user", "pass")
+        cancel_job(job)
+        self.assertNotIn("password", Job.objects.get(pk=job.pk).params)
+        # interrupted while running
+        job = database_import("http://127.0.0.1:1", "user", "pass")
+        Job.objects.filter(pk=job.pk).update(status="r", pid=None)
+        recover_jobs()
+        self.assertNotIn("password", Job.objects.get(pk=job.pk).params)
+
+    def test_status(self):
+        job = Job.objects.create(
+            kind="repair", status="r", progress=25, total=100, started=timezone.now()
+        )
+        self.client.force_login(self.admin)
+        data = self.client.get("/jobs?active=1").json()
+        self.assertEqual([it["id"] for it in data["jobs"]], [job.pk])
+        data = self.client.get(f"/job/{job.pk}").json()
+        self.assertEqual(data["percent"], 25.0)
+        self.assertIsNotNone(data["eta"])
+        self.assertEqual(self.client.get(f"/job/{job.pk}/cancel").status_code, 405)
+        data = self.client.post(f"/job/{job.pk}/cancel").json()
+        self.assertTrue(data["cancel_requested"])
+        self.assertEqual(self.client.get("/job/0").status_code, 404)
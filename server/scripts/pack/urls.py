@@ -2,8 +2,6 @@
 Fichier définissant les urls
 """
 
-from django.conf import settings as main_settings
-from django.conf.urls.static import static
 from django.urls import path
 
 from .views import *
@@ -17,7 +15,12 @@ urlpatterns = [
     path("users", users, name="users"),
     path("user/<int:pk>", modif_user, name="modif_user"),
     path("api", api),
+    path("download/<int:pk>", download_package, name="download_package"),
     path("admin_db", admin_db, name="admin_db"),
     path("db_repair", db_repair, name="db_repair"),
     path("repo_clone", repo_clone, name="clone_repository"),
-] + static(main_settings.MEDIA_URL, document_root=main_settings.MEDIA_ROOT)
+    path("jobs", jobs_status, name="jobs_status"),
+    path("job/<int:pk>", job_status, name="job_status"),
+    path("job/<int:pk>/log", job_log, name="job_log"),
+    path("job/<int:pk>/cancel", job_cancel, name="job_cancel"),
+]
@@ -3,25 +3,45 @@ Package views
 """
 
 from base64 import b64decode
+from json import loads, JSONDecodeError
+from itertools import chain
 from pathlib import Path
-from shutil import move
+from re import compile as re_compile
 from subprocess import run
+from urllib.parse import quote
 
-from django.contrib.auth import authenticate, login
+from django.conf import settings
+from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from django.http import HttpResponseForbidden, HttpResponseRedirect
+from django.http import (
+    HttpResponseForbidden,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render, HttpResponse, redirect
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import content_disposition_header, http_date
+from django.utils.text import compress_sequence
 from django.views.decorators.csrf import csrf_exempt
 
 from connector.decorators import (
     get_capability,
     user_capability_required,
     toggle_capability,
+    load_capabilities,
     has_capability,
 )
+from connector.tokens import verify_token
 from scripts.settings import MEDIA_ROOT, SITE_VERSION, SITE_HASH, SITE_API_VERSION
+from .catalog import get_generation, get_last_modified
 from .db_locking import locker
-from .decorators.database import require_not_locked
+from .decorators.database import (
+    read_only_database,
+    require_not_locked,
+    require_writable,
+)
 from .forms import PackageEntryForm
 from .logger import logger
 from .models import (
@@ -29,10 +49,18 @@ from .models import (
     get_package_detail,
     PackageEntry,
     get_packages_urls,
-    get_entry_count,
+    get_packages_urls_many,
+    get_statistics,
     delete_packages,
+    iter_index_lines,
+    iter_changes,
+    get_pruned_revision,
+    get_revision,
+    Job,
+    PackageInspection,
 )
-from .task import database_repair, database_import
+from .resolver import get_closure
+from .task import database_repair, database_import, cancel_job
 
 
 def index(request):
@@ -52,7 +80,7 @@ def index(request):
                 "api": SITE_API_VERSION,
             },
             "user_capabilities": get_capability(request.user),
-            "pack_number": get_entry_count(),
+            "statistics": get_statistics(),
         },
     )
 
@@ -62,6 +90,7 @@ def index(request):
 
 @user_capability_required("can_view_package")
 @require_not_locked
+@read_only_database
 def packages(request):
     """
 
@@ -103,6 +132,7 @@ def packages(request):
 
 @user_capability_required("can_view_package")
 @require_not_locked
+@read_only_database
 def detail_package(request, name):
     """
 
@@ -131,7 +161,7 @@ def detail_package(request, name):
 
 
 @user_capability_required("can_delete_package")
-@require_not_locked
+@require_writable
 def delete_package(request, pk):
     """
 
@@ -140,8 +170,11 @@ def delete_package(request, pk):
     :return:
     """
     if request.method == "POST":
-        pack = PackageEntry.objects.get(pk=pk)
-        pack.delete()
+        with locker.writing() as writable:
+            if not writable:
+                return redirect("maintenance")
+            pack = PackageEntry.objects.get(pk=pk)
+            pack.delete()
         # Récupérer l'URL de la page précédente
         previous_page = request.META.get("HTTP_REFERER")
 
@@ -162,7 +195,9 @@ def users(request):
     :param request:
     :return:
     """
-    entries = User.objects.all()
+    entries = list(User.objects.all())
+    # the permissions of all the users in one query
+    load_capabilities(entries)
     p_users = []
     for entry in entries:
 
@@ -235,7 +270,9 @@ def maintenance_page(request):
     :param request:
     :return:
     """
-    if not locker.is_locked():  # the lock has been released go back to packages
+    # the lock has been released and no job is waiting: go back to packages
+    active = Job.objects.filter(status__in=["q", "r"])
+    if not locker.is_locked(writing=True) and not active.exists():
         return redirect("package")
     return render(
         request,
@@ -253,13 +290,14 @@ def maintenance_page(request):
 
 
 @user_capability_required("can_delete_package")
-@require_not_locked
+@require_writable
 def admin_db(request):
     """
 
     :param request:
     :return:
     """
+    statistics = get_statistics(details=True)
     return render(
         request,
         "admin.html",
@@ -272,24 +310,28 @@ def admin_db(request):
                 "api": SITE_API_VERSION,
             },
             "user_capabilities": get_capability(request.user),
+            "statistics": statistics,
+            "statistics_breakdowns": [
+                statistics[key] for key in ["os", "arch", "kind", "abi"]
+            ],
         },
     )
 
 
 @user_capability_required("can_delete_package")
-@require_not_locked
+@require_writable
 def db_repair(request):
     """
 
     :param request:
     :return:
     """
-    database_repair()
-    return redirect("admin_db")
+    database_repair(full=request.GET.get("full", "") == "1")
+    return redirect("maintenance")
 
 
 @user_capability_required("can_delete_package")
-@require_not_locked
+@require_writable
 def repo_clone(request):
     """
     Clone a repository from the server.
@@ -303,7 +345,66 @@ def repo_clone(request):
         request.POST.get("login", ""),
         request.POST.get("password", ""),
     )
-    return redirect("admin_db")
+    return redirect("maintenance")
+
+
+@user_capability_required("can_delete_package")
+def jobs_status(request):
+    """
+    Status of the recent jobs, in JSON.
+    :param request:
+    :return:
+    """
+    query = Job.objects.all()
+    if request.GET.get("active", "") not in ["", "0"]:
+        query = query.filter(status__in=["q", "r"])
+    return JsonResponse({"jobs": [job.to_dict() for job in query[:20]]})
+
+
+@user_capability_required("can_delete_package")
+def job_status(request, pk):
+    """
+    Status of a job, in JSON.
+    :param request:
+    :param pk:
+    :return:
+    """
+    job = Job.objects.filter(pk=pk).first()
+    if job is None:
+        return JsonResponse({"error": "No such job."}, status=404)
+    return JsonResponse(job.to_dict())
+
+
+@user_capability_required("can_delete_package")
+def job_log(request, pk):
+    """
+    Output of a job, in text.
+    :param request:
+    :param pk:
+    :return:
+    """
+    job = Job.objects.filter(pk=pk).first()
+    if job is None:
+        return HttpResponse("No such job.", status=404, content_type="text/plain")
+    return HttpResponse(job.get_log(), content_type="text/plain; charset=utf-8")
+
+
+@user_capability_required("can_delete_package")
+def job_cancel(request, pk):
+    """
+    Request the cancellation of a job.
+    :param request:
+    :param pk:
+    :return:
+    """
+    job = Job.objects.filter(pk=pk).first()
+    if job is None:
+        return JsonResponse({"error": "No such job."}, status=404)
+    if request.method != "POST":
+        return JsonResponse({"error": "Cancellation must be posted."}, status=405)
+    if job.is_active():
+        cancel_job(job)
+    return JsonResponse(job.to_dict())
 
 
 # ============================== SECTION API ===================================
@@ -317,7 +418,14 @@ def auths_required(request):
     :return: HttpResponse
     """
     if not request.user.is_authenticated:
-        if "Authorization" in request.headers:
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() in ["bearer", "token"]:
+            # API token: no password hashing, verification cached in process
+            user = verify_token(credentials.strip())
+            if user is None:
+                return HttpResponseForbidden("Invalid or revoked API token.")
+            request.user = user
+        elif "Authorization" in request.headers:
             try:
                 key, dec = (
                     b64decode(request.headers["Authorization"].split()[-1])
@@ -330,7 +438,8 @@ def auths_required(request):
                         f"""Only authenticated user allowed
     Login: {key}, password: {dec} is invalid."""
                     )
-                login(request, user)
+                # authenticated for this request only: no session is stored
+                request.user = user
             except Exception as err:
                 return HttpResponseForbidden(
                     f"""Only authenticated user allowed
@@ -362,23 +471,41 @@ def api(request):
                 f"ERROR: Server is under maintenance, try again later.", status=406
             )
         if request.method == "GET":
-            entries = PackageEntry.objects.all()
-            resp = "\n".join(pack.to_dep_entry() for pack in entries)
             client_api_version = request.headers.get("X-API-Version", "1.0.0")
             logger.debug(f"Client API : {client_api_version} ({SITE_VERSION})")
-            if _version_supports_dependencies(client_api_version):
-                resp = "\n".join(
-                    f"{pack.to_dep_entry()} | deps: {pack.dependencies}"
-                    for pack in entries
-                )
+            with_dependencies = _version_supports_dependencies(client_api_version)
+            variant = "deps" if with_dependencies else "base"
+            generation = get_generation()
+            etag = f'"{generation["token"]}-{variant}"'
+            last_modified = get_last_modified(generation)
+            not_modified = get_conditional_response(
+                request, etag=etag, last_modified=last_modified
+            )
+            if not_modified is not None:
+                return not_modified
+            content = _iter_chunks(iter_index_lines(with_dependencies))
+            if "gzip" in request.headers.get("Accept-Encoding", ""):
+                response = StreamingHttpResponse(compress_sequence(content))
+                response["Content-Encoding"] = "gzip"
             else:
-                resp = "\n".join(pack.to_dep_entry() for pack in entries)
-
-            return HttpResponse(resp)
+                response = StreamingHttpResponse(content)
+            patch_vary_headers(response, ["Accept-Encoding"])
+            response["ETag"] = etag
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified)
+            return response
         if request.method == "POST":
             logger.debug(f"POST request on API")
             logger.debug(f"request.body: {request.body}")
-            data = request.POST.dict()
+            if request.content_type == "application/json":
+                try:
+                    data = loads(request.body)
+                except JSONDecodeError as err:
+                    return HttpResponse(f"ERROR invalid JSON body: {err}.", status=406)
+                if not isinstance(data, dict):
+                    return HttpResponse(f"ERROR invalid JSON body.", status=406)
+            else:
+                data = request.POST.dict()
             logger.debug(f"request.POST: {data}")
 
             if "action" not in data:
@@ -386,7 +513,15 @@ def api(request):
                     f"ERROR no asked action.\nPOST: {data}\nheaders: {request.headers}",
                     status=406,
                 )
-            if data["action"] not in ["pull", "version", "push", "delete"]:
+            if data["action"] not in [
+                "pull",
+                "pull_many",
+                "closure",
+                "version",
+                "push",
+                "delete",
+                "changes",
+            ]:
                 return HttpResponse(
                     f"ERROR invalid action.\nPOST: {data}\nheaders: {request.headers}",
                     status=406,
@@ -404,113 +539,96 @@ def api(request):
                     return HttpResponse(f"""ERROR No matching package.""", status=406)
                 resp = ""
                 for pack in package:
-                    pack_u = f"{pack}".replace(str(MEDIA_ROOT), "/media/")
-                    if not pack_u.startswith("/media/"):
-                        pack_u = f"/media/{pack_u}"
-                    resp += f"{pack_u}\n"
+                    resp += f"{_package_url(pack.instance.pk)}\n"
                 return HttpResponse(resp, status=200)
+            elif data["action"] == "pull_many":
+                specs = data.get("specs", [])
+                if isinstance(specs, str):
+                    try:
+                        specs = loads(specs)
+                    except JSONDecodeError as err:
+                        return HttpResponse(f"ERROR invalid specs: {err}.", status=406)
+                if not isinstance(specs, list) or not all(
+                    isinstance(spec, dict) for spec in specs
+                ):
+                    return HttpResponse(
+                        f"ERROR specs must be a list of filters.", status=406
+                    )
+                for spec in specs:
+                    if "compiler" in spec:
+                        spec["abi"] = spec.pop("compiler")
+                results = [
+                    [_package_url(pack.instance.pk) for pack in package]
+                    for package in get_packages_urls_many(specs)
+                ]
+                return JsonResponse({"results": results}, status=200)
+            elif data["action"] == "closure":
+                if data.get("name", "") in ["", "*"]:
+                    return HttpResponse(f"ERROR no package name.", status=406)
+                closure = get_closure(
+                    {
+                        key: data[key]
+                        for key in [
+                            "name",
+                            "version",
+                            "os",
+                            "arch",
+                            "kind",
+                            "abi",
+                            "glibc",
+                        ]
+                        if key in data
+                    }
+                )
+                if closure is None:
+                    return HttpResponse(f"""ERROR No matching package.""", status=406)
+                flavors = []
+                for flavor in closure["closure"]:
+                    flavor = dict(flavor)
+                    flavor.pop("package")
+                    flavor["url"] = _package_url(flavor.pop("pk"))
+                    flavors.append(flavor)
+                return JsonResponse(
+                    {"closure": flavors, "missing": closure["missing"]}, status=200
+                )
+            elif data["action"] == "changes":
+                try:
+                    since = int(data.get("since", "0"))
+                except ValueError:
+                    return HttpResponse(
+                        f"ERROR invalid revision: {data['since']}.", status=406
+                    )
+                with_dependencies = _version_supports_dependencies(
+                    request.headers.get("X-API-Version", "1.0.0")
+                )
+                revision = get_revision()
+                header = [f"revision: {revision}"]
+                if 0 < since < get_pruned_revision() or since > revision:
+                    # removals after this revision are pruned, or the client
+                    # knows another catalog (restored database): full index
+                    since = 0
+                    header.append("full: true")
+                content = _iter_chunks(
+                    chain(header, iter_changes(since, with_dependencies))
+                )
+                return StreamingHttpResponse(content, status=200)
             elif data["action"] == "version":
                 return HttpResponse(
                     f"version: {SITE_VERSION}\napi_version: {SITE_API_VERSION}\n",
                     status=200,
                 )
             #
-            # Need credentials of adding a package
-            elif data["action"] == "push":
-                if not has_capability(request.user, "can_add_package"):
-                    return HttpResponseForbidden(
-                        "Please ask the right to push packages"
-                    )
-                try:
-                    if len(request.FILES.dict()) > 0:
-                        form = PackageEntryForm(request.POST, request.FILES)
-                        if form.is_valid():
-                            form.save()
-                            return HttpResponse(
-                                f"GOOD.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
-                                status=200,
-                            )
-                        else:
-                            form.full_clean()
-                            return HttpResponse(
-                                f"INVALID FORM.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
-                                status=406,
-                            )
-                    elif "package.path" in data:
-                        # temp file to destination folder
-                        origin_path = Path((data["package.path"]))
-                        new_path = (
-                            Path(MEDIA_ROOT) / "packages" / request.POST["package.name"]
+            # Modifications, refused during a maintenance
+            elif data["action"] in ["push", "delete"]:
+                with locker.writing() as writable:
+                    if not writable:
+                        return HttpResponse(
+                            f"ERROR: Server is under maintenance, try again later.",
+                            status=406,
                         )
-                        move(origin_path, new_path)
-
-                        entry_data = {
-                            "name": data["name"],
-                            "version": data["version"],
-                            "os": data["os"],
-                            "arch": data["arch"],
-                            "kind": data["kind"],
-                            "abi": data["abi"],
-                            "glibc": data.get("glibc", ""),
-                            "package": str(new_path),
-                        }
-                        old_format = False
-                        if "build_date" in data:
-                            entry_data["build_date"] = data["build_date"]
-                        else:
-                            logger.info(f"Pushing without build_date field.")
-                            old_format = True
-
-                        if "dependencies" in data:
-                            entry_data["dependencies"] = data["dependencies"]
-                            logger.info(
-                                f"Package with dependencies: {data['dependencies']}"
-                            )
-                        else:
-                            logger.info(f"Pushing without dependencies field.")
-                            old_format = True
-                        if "description" in data:
-                            entry_data["description"] = data["description"]
-
-                        entry = PackageEntry.objects.create(**entry_data)
-                        entry.save()
-
-                        if not old_format:
-                            return HttpResponse(
-                                "GOOD.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
-                                status=200,
-                            )
-                        else:
-                            return HttpResponse(
-                                f"GOOD with warnings: old format without all fields.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
-                                status=201,
-                            )
-                    return HttpResponse(
-                        f"INVALID REQUEST.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
-                        status=406,
-                    )
-                except Exception as err:
-                    oo = run("ls /tmp", shell=True, capture_output=True)
-                    return HttpResponse(
-                        f"ERROR problem with the data: {err}.\ntemp: {oo.stdout}\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
-                        status=406,
-                    )
-            #
-            # Require full credentials on database
-            elif data["action"] == "delete":
-                if not has_capability(request.user, "can_delete_package"):
-                    return HttpResponseForbidden(
-                        "Please ask the right to push packages"
-                    )
-                package = get_packages_urls(data)
-                if len(package) == 0:
-                    return HttpResponse(f"""ERROR No matching package.""", status=406)
-                if len(package) > 1:
-                    return HttpResponse(
-                        f"""ERROR more than one package match the query.""", status=406
-                    )
-                delete_packages(data)
-                return HttpResponse(f"Entry deleted", status=200)
+                    if data["action"] == "push":
+                        return _api_push(request, data)
+                    return _api_delete(request, data)
             return HttpResponse(
                 f'ERROR action {data["action"]} not yet implemented.\nPOST: {data}\nheaders: {request.headers}',
                 status=406,
@@ -520,6 +638,251 @@ def api(request):
         return HttpResponse(f"""Exception during treatment {err}.""", status=406)
 
 
+def _api_push(request, data: dict):
+    """
+    Push a package through the API; needs credentials of adding a package.
+    :param request:
+    :param data: The posted data.
+    :return:
+    """
+    if not has_capability(request.user, "can_add_package"):
+        return HttpResponseForbidden("Please ask the right to push packages")
+    try:
+        if len(request.FILES.dict()) > 0:
+            form = PackageEntryForm(request.POST, request.FILES)
+            if form.is_valid():
+                # the archive is checked by the job worker, not during the upload
+                PackageInspection.queue(form.save())
+                return HttpResponse(
+                    f"GOOD.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
+                    status=200,
+                )
+            else:
+                form.full_clean()
+                return HttpResponse(
+                    f"INVALID FORM.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
+                    status=406,
+                )
+        elif "package.path" in data:
+            # temp file of the upload module
+            origin_path = Path((data["package.path"]))
+
+            entry_data = {
+                "name": data["name"],
+                "version": data["version"],
+                "os": data["os"],
+                "arch": data["arch"],
+                "kind": data["kind"],
+                "abi": data["abi"],
+                "glibc": data.get("glibc", ""),
+            }
+            old_format = False
+            if "build_date" in data:
+                entry_data["build_date"] = data["build_date"]
+            else:
+                logger.info(f"Pushing without build_date field.")
+                old_format = True
+
+            if "dependencies" in data:
+                entry_data["dependencies"] = data["dependencies"]
+                logger.info(f"Package with dependencies: {data['dependencies']}")
+            else:
+                logger.info(f"Pushing without dependencies field.")
+                old_format = True
+            if "description" in data:
+                entry_data["description"] = data["description"]
+
+            entry = PackageEntry(**entry_data)
+            entry.store_file(origin_path)
+            entry.save()
+            PackageInspection.queue(entry)
+
+            if not old_format:
+                return HttpResponse(
+                    "GOOD.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
+                    status=200,
+                )
+            else:
+                return HttpResponse(
+                    f"GOOD with warnings: old format without all fields.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
+                    status=201,
+                )
+        return HttpResponse(
+            f"INVALID REQUEST.\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
+            status=406,
+        )
+    except Exception as err:
+        oo = run("ls /tmp", shell=True, capture_output=True)
+        return HttpResponse(
+            f"ERROR problem with the data: {err}.\ntemp: {oo.stdout}\nPOST: {data}\nFILES: {request.FILES.dict()}\nheaders: {request.headers}",
+            status=406,
+        )
+
+
+def _api_delete(request, data: dict):
+    """
+    Delete a package through the API; requires full credentials on database.
+    :param request:
+    :param data: The posted data.
+    :return:
+    """
+    if not has_capability(request.user, "can_delete_package"):
+        return HttpResponseForbidden("Please ask the right to push packages")
+    package = get_packages_urls(data)
+    if len(package) == 0:
+        return HttpResponse(f"""ERROR No matching package.""", status=406)
+    if len(package) > 1:
+        return HttpResponse(
+            f"""ERROR more than one package match the query.""", status=406
+        )
+    delete_packages(data)
+    return HttpResponse(f"Entry deleted", status=200)
+
+
+def _package_url(pk: int) -> str:
+    """
+    Get the url of the download of a package, relative to the server.
+    :param pk: The package entry.
+    :return: The url.
+    """
+    return reverse("download_package", args=[pk])
+
+
+def _media_url(pack) -> str:
+    """
+    Get the url of a package file in the internal location of nginx.
+    :param pack: The package file.
+    :return: The url.
+    """
+    pack_u = f"{pack}".replace(str(MEDIA_ROOT), "/media/")
+    if not pack_u.startswith("/media/"):
+        pack_u = f"/media/{pack_u}"
+    return quote(pack_u)
+
+
+@read_only_database
+def download_package(request, pk):
+    """
+    Download of a package file, for the users allowed to see the packages.
+
+    Only the authorization is done here: the file is sent by nginx from its
+    internal location, given in the X-Accel-Redirect header.
+    :param request:
+    :param pk: The package entry.
+    :return:
+    """
+    auth_response = auths_required(request)
+    if auth_response is not None:
+        return auth_response
+    if not has_capability(request.user, "can_view_package"):
+        return HttpResponseForbidden("Please ask the right to see packages")
+    if locker.is_locked():
+        return HttpResponse(
+            f"ERROR: Server is under maintenance, try again later.", status=406
+        )
+    entry = PackageEntry.objects.filter(pk=pk).first()
+    if entry is None:
+        return HttpResponse(f"ERROR No matching package.", status=404)
+    entry.check_file()
+    # strong validator of the content, for the resumed downloads (If-Range)
+    etag = f'"{entry.sha256}"' if entry.sha256 != "" else None
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    if not settings.DOWNLOAD_ACCEL_REDIRECT:
+        response = _ranged_file_response(request, Path(entry.package.path), etag)
+    else:
+        # nginx sends the file, and the ranges asked by the client
+        response = HttpResponse(content_type="application/gzip")
+        response["X-Accel-Redirect"] = _media_url(entry.package)
+    response["Content-Disposition"] = content_disposition_header(
+        True, entry.package_name
+    )
+    response["Accept-Ranges"] = "bytes"
+    if etag is not None:
+        response["ETag"] = etag
+    return response
+
+
+# single byte range of a Range header
+BYTE_RANGE = re_compile(r"bytes=([0-9]*)-([0-9]*)")
+
+
+def _ranged_file_response(request, file: Path, etag: str = None):
+    """
+    Stream a file, or the byte range asked by the Range header.
+
+    Only single ranges are served, and only if the If-Range header, when given,
+    is the ETag of the file; the whole file is sent otherwise.
+    :param request:
+    :param file: The file.
+    :param etag: The ETag of the file.
+    :return:
+    """
+    size = file.stat().st_size
+    start, end = 0, size - 1
+    status = 200
+    asked = BYTE_RANGE.fullmatch(request.headers.get("Range", "").strip())
+    if_range = request.headers.get("If-Range")
+    # invalid or multiple ranges are ignored (RFC 9110, 14.2)
+    if (
+        asked is not None
+        and asked[1] + asked[2] != ""
+        and (asked[1] == "" or asked[2] == "" or int(asked[1]) <= int(asked[2]))
+        and (if_range is None or (etag is not None and if_range == etag))
+    ):
+        if asked[1] == "":
+            start = max(size - int(asked[2]), 0) if int(asked[2]) > 0 else size
+        else:
+            start = int(asked[1])
+            if asked[2] != "":
+                end = min(int(asked[2]), size - 1)
+        if start >= size:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+        status = 206
+
+    def content():
+        with open(file, "rb") as fp:
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fp.read(min(remaining, 1024 * 1024))
+                if len(chunk) == 0:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    response = StreamingHttpResponse(
+        content(), status=status, content_type="application/gzip"
+    )
+    response["Content-Length"] = str(end - start + 1)
+    if status == 206:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
+
+
+def _iter_chunks(lines, lines_per_chunk: int = 500):
+    """
+    Group text lines into encoded chunks for a streaming response.
+
+    :param lines: Iterable over the lines.
+    :param lines_per_chunk: Number of lines sent at once.
+    :return: Generator of encoded chunks.
+    """
+    chunk = []
+    separator = ""
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= lines_per_chunk:
+            yield (separator + "\n".join(chunk)).encode("utf-8")
+            separator = "\n"
+            chunk = []
+    if len(chunk) > 0:
+        yield (separator + "\n".join(chunk)).encode("utf-8")
+
+
 def _version_supports_dependencies(version: str) -> bool:
     """
     Check if client API version supports dependencies field.
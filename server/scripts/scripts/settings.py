@@ -179,14 +179,92 @@ WSGI_APPLICATION = "scripts.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# SQLite tuning, applied to each new connection: write-ahead log (readers do not
+# wait for the writer), wait for the lock instead of failing, memory-mapped reads
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", "20000")),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # negative: size in KiB
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", "-65536")),
+    "temp_store": "MEMORY",
+}
+SQLITE_INIT_COMMAND = ";".join(
+    f"PRAGMA {pragma}={value}" for pragma, value in SQLITE_PRAGMAS.items()
+)
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": DATA_DIR / "packages.db",
-    }
+        "OPTIONS": {
+            "init_command": SQLITE_INIT_COMMAND,
+            # writers take the lock when their transaction begins, so they wait
+            # for it (busy_timeout) instead of failing in the middle
+            "transaction_mode": "IMMEDIATE",
+        },
+        # persistent connections: the pragmas are not applied at each request
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", "600")),
+        "CONN_HEALTH_CHECKS": True,
+    },
 }
+# same database, with a connection refusing any modification, for the read-only
+# views (see pack.decorators.database.read_only_database)
+DATABASES["readonly"] = DATABASES["default"] | {
+    "OPTIONS": {"init_command": SQLITE_INIT_COMMAND + ";PRAGMA query_only=ON"},
+    "TEST": {"MIRROR": "default"},
+}
+DATABASE_ROUTERS = ["pack.routers.ReadOnlyRouter"]
 DATABASES_LOCK_PATH = DATA_DIR / "packages.lock"
 
+# Number of concurrent downloads when cloning another server
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", "4"))
+
+# Number of processes reading the package archives during a database repair
+REPAIR_WORKERS = int(os.environ.get("REPAIR_WORKERS", str(os.cpu_count() or 1)))
+
+# Delay in seconds between two checks of the job queue by the job worker
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "2"))
+
+# Number of the last catalog revisions whose removals are kept for the incremental
+# synchronization (pruned by the database repair); older clients resynchronize
+TOMBSTONE_RETENTION = int(os.environ.get("TOMBSTONE_RETENTION", "100000"))
+
+# Output of the maintenance jobs, one file per job
+JOB_LOG_DIR = DATA_DIR / "log" / "jobs"
+
+# Package files sent by nginx (X-Accel-Redirect) after the authorization, instead
+# of being streamed by Django (development server without nginx)
+DOWNLOAD_ACCEL_REDIRECT = (
+    os.environ.get("DOWNLOAD_ACCEL_REDIRECT", "true").lower() == "true"
+)
+
+# Cache, shared between the server workers
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": DATA_DIR / "cache",
+        # above the default (300): the catalog and token generations live here
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # cache of the browser sessions, kept apart from the shared cache
+    "sessions": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": DATA_DIR / "sessions",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# Sessions of the web interface, stored in database and read through the cache:
+# a culled or cleared cache does not log the users out. The API calls are
+# authenticated at each request and do not use any session
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = "sessions"
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 